@@ -1,16 +1,16 @@
 """ This module implements the AccountCollection class """
-from dataclasses import dataclass
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime
 import logging
+import threading
+import zlib
 
-from account_store import AccountStore, AccountStoreCreateError, AccountStoreGetError, AccountStoreUpdateError
+from account_store import AccountStore, Account, UserSummary, AccountStoreCreateError, AccountStoreGetError, AccountStoreUpdateError, AccountStoreConflictError
+from transaction_store import TransactionStore, Transaction, TransactionStoreError, format_timestamp
+from in_memory_transaction_store import InMemoryTransactionStore
 from errors import APIError
 
-@dataclass
-class Account:
-    id: str
-    user_id: str
-    balance: int
-
 class AccountLookupError(APIError):
     def __init__(self, account_id: str):
         super().__init__("Unexpected error. Unable to look up account.", 500, account_id=account_id)
@@ -47,14 +47,106 @@ class TransferError(APIError):
     def __init__(self, from_account_id: str, to_account_id: str):
         super().__init__("Unexpected error. Transfer failed", 500, from_account_id=from_account_id, to_account_id=to_account_id)
 
+class TransferConflictError(APIError):
+    def __init__(self, from_account_id: str):
+        super().__init__("Account was changed by another request during the transfer. Nothing was transfered, please retry.", 409, from_account_id=from_account_id)
+
+class BatchTransferError(APIError):
+    def __init__(self, transfer_count: int):
+        super().__init__("Unexpected error. Batch transfer failed", 500, transfer_count=transfer_count)
+
+class EmptyBatchError(APIError):
+    def __init__(self):
+        super().__init__("A batch must contain at least one transfer.", 400)
+
+class TransferBatchTooLargeError(APIError):
+    def __init__(self, count: int, max_count: int):
+        super().__init__(f"A batch may contain at most {max_count} transfers.", 400, count=count)
+
+class InvalidBatchTransferError(APIError):
+    def __init__(self, index: int):
+        super().__init__("Every transfer in a batch needs string account ids and an integer amount above zero.", 400, index=index)
+
+class InvalidAccountBatchError(APIError):
+    def __init__(self, count, max_count: int):
+        super().__init__(f"balances must be a list of between 1 and {max_count} balances.", 400, count=count)
+
+class InvalidPageLimitError(APIError):
+    def __init__(self, limit, max_limit: int):
+        super().__init__(f"limit must be an integer between 1 and {max_limit}.", 400, limit=limit)
+
+class InvalidCursorError(APIError):
+    def __init__(self, after: str):
+        super().__init__("after must be the id of one of your accounts.", 400, after=after)
+
+class InvalidTransactionCursorError(APIError):
+    def __init__(self, after):
+        super().__init__("after must be the id of one of the account's transactions.", 400, after=after)
+
+class InvalidTransactionTimeError(APIError):
+    def __init__(self, name: str, value):
+        super().__init__(f"{name} must be an ISO 8601 date or time, like 2024-05-01 or 2024-05-01T12:00:00Z.", 400, **{name: value})
+
+class TransactionLookupError(APIError):
+    def __init__(self, account_id: str):
+        super().__init__("Unexpected error. Unable to look up transactions.", 500, account_id=account_id)
+
+def transaction_time_bound(name: str, value: str | None) -> str | None:
+    """ Turns a from or to query parameter into the timestamp format transactions are stored with. Times without a time zone are taken to be UTC """
+    if value is None:
+        return None
+    try:
+        return format_timestamp(datetime.fromisoformat(value))
+    except (TypeError, ValueError) as e:
+        raise InvalidTransactionTimeError(name, value) from e
+
+@dataclass
+class TransferRequest:
+    """ A single transfer within a batch """
+    from_account_id: str
+    to_account_id: str
+    amount: int
+
+@dataclass
+class SummaryDrift:
+    """ A user whose stored summary disagrees with their accounts """
+    user_id: str
+    stored: UserSummary
+    actual: UserSummary
+
 class AccountCollection():
     """
     Collection for interacting with accounts.
     """
-    def __init__(self, account_store: AccountStore):
+    max_page_limit = 1000
+    max_create_batch = 10000
+    max_transfer_batch = 10000
+    verify_attempts = 3
+    def __init__(self, account_store: AccountStore, lock_stripes: int = 64, transaction_store: TransactionStore = None):
         self.__account_store = account_store
+        # Every change to a balance is recorded here, so that an account's history can be queried by time
+        self.__transaction_store = transaction_store or InMemoryTransactionStore()
         self.root_logger = logging.getLogger("root")
         self.audit_logger = logging.getLogger("audit")
+        # Transfers lock the stripes of both accounts involved. Accounts are spread over a fixed number of locks,
+        # so transfers between unrelated accounts can run in parallel without keeping a lock per account around.
+        # A store shared by several processes hands out locks that also hold off transfers in the other processes.
+        self.__lock_stripes = account_store.transfer_locks(max(1, lock_stripes)) or [threading.Lock() for _ in range(max(1, lock_stripes))]
+
+    @contextmanager
+    def __locked_accounts(self, *account_ids: str):
+        # Stripes are always acquired in ascending index order, so two transfers can never wait on each other in a cycle
+        # crc32 rather than hash(), which is salted differently in every process, so that all processes agree on an account's stripe.
+        # str(), as ids come straight from request bodies, and one that isn't a string is left for the lookup to not find
+        stripe_indexes = sorted({zlib.crc32(str(account_id).encode()) % len(self.__lock_stripes) for account_id in account_ids})
+        locks = [self.__lock_stripes[i] for i in stripe_indexes]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
 
     def __internal_get_account(self, account_id, user_id = None) -> Account | None:
         try:
@@ -64,6 +156,13 @@ class AccountCollection():
             self.root_logger.warning("Unexpected error occurred when trying to perform an account lookup. account_id='%s', user_id='%s", account_id, user_id_str)
             raise(AccountLookupError(account_id)) from e
 
+    def __record_transactions(self, transactions: list[Transaction]):
+        try:
+            self.__transaction_store.add_transactions(transactions)
+        except TransactionStoreError as e:
+            # The balances have already changed, so failing the request would only invite a retry of something that went through
+            self.root_logger.error("Failed to record transactions. account_ids='%s', e='%s'", ",".join(dict.fromkeys(t.account_id for t in transactions)), e)
+
     def create_account(self, user_id: str, initial_balance: int) -> str:
         """ Creates a new account for a user """
         if(not isinstance(initial_balance, int) or initial_balance < 0):
@@ -74,8 +173,26 @@ class AccountCollection():
         except AccountStoreCreateError as e:
             self.root_logger.warning("Unexpected error occurred when trying to create account. e='%s'", e)
             raise AccountCreateError() from e
+        self.__record_transactions([Transaction(account.id, None, initial_balance, initial_balance)])
         return account
 
+    def create_accounts(self, user_id: str, initial_balances: list[int]) -> list[Account]:
+        """ Creates several accounts for a user all-or-nothing, with a single store operation and a single audit record """
+        if(not isinstance(initial_balances, list) or not 1 <= len(initial_balances) <= self.max_create_batch):
+            raise InvalidAccountBatchError(len(initial_balances) if isinstance(initial_balances, list) else None, self.max_create_batch)
+        for initial_balance in initial_balances:
+            if(not isinstance(initial_balance, int) or initial_balance < 0):
+                raise InvalidInitialBalanceError(initial_balance)
+        try:
+            accounts = self.__account_store.create_accounts(user_id, initial_balances)
+        except AccountStoreCreateError as e:
+            self.root_logger.warning("Unexpected error occurred when trying to create accounts in bulk. user_id='%s', account_count='%s', e='%s'", user_id, len(initial_balances), e)
+            raise AccountCreateError() from e
+        self.__record_transactions([Transaction(account.id, None, account.balance, account.balance) for account in accounts])
+        self.audit_logger.info("Accounts created in bulk. user_id=%s, account_count=%s, accounts=%s", user_id, len(accounts),
+                               ";".join(f"{account.id}:{account.balance}" for account in accounts), extra={"account_ids": [account.id for account in accounts]})
+        return accounts
+
     def get_user_account(self, user_id: str, account_id: str) -> Account:
         """Gets a user's account by id """
         account = self.__internal_get_account(account_id, user_id)
@@ -92,45 +209,162 @@ class AccountCollection():
             self.root_logger.warning("Failed to list accounts for user. user_id='%s', e='%s'", user_id, e)
             raise AccountListLookupError(user_id) from e
 
+    def get_user_accounts_page(self, user_id: str, limit: int, after: str = None) -> list[Account]:
+        """Lists up to limit of a user's accounts, starting after the account with id after. Pass the id of the last account in a page to get the next one"""
+        if(not isinstance(limit, int) or limit < 1 or limit > self.max_page_limit):
+            raise InvalidPageLimitError(limit, self.max_page_limit)
+        try:
+            accounts = self.__account_store.get_accounts_page(user_id, limit, after)
+        except AccountStoreGetError as e:
+            self.root_logger.warning("Failed to list a page of accounts for user. user_id='%s', e='%s'", user_id, e)
+            raise AccountListLookupError(user_id) from e
+        if accounts is None:
+            raise InvalidCursorError(after)
+        return accounts
+
+    def iter_user_accounts(self, user_id: str, page_size: int = 500):
+        """Yields all of a user's accounts, fetching them from the store one page at a time"""
+        after = None
+        while True:
+            accounts = self.get_user_accounts_page(user_id, page_size, after)
+            yield from accounts
+            if len(accounts) < page_size:
+                return
+            after = accounts[-1].id
+
+    def get_user_summary(self, user_id: str) -> UserSummary:
+        """Gets a user's account count and total balance, without reading their accounts"""
+        try:
+            return self.__account_store.get_user_summary(user_id)
+        except AccountStoreGetError as e:
+            self.root_logger.warning("Failed to look up account summary for user. user_id='%s', e='%s'", user_id, e)
+            raise AccountListLookupError(user_id) from e
+
+    def verify_user_summaries(self, user_ids: list[str] = None) -> list[SummaryDrift]:
+        """Recomputes the summaries of the given users, or of every user with a stored summary, from their accounts, and returns those that have drifted.
+        A user whose summary changes while their accounts are read is checked again, and skipped after a few attempts"""
+        if user_ids is None:
+            user_ids = [summary.user_id for summary in self.__account_store.get_user_summaries()]
+        drifts = []
+        for user_id in user_ids:
+            for _ in range(self.verify_attempts):
+                stored = self.__account_store.get_user_summary(user_id)
+                accounts = self.__account_store.get_accounts(user_id)
+                # A transfer between the two reads would look like drift, so the check only counts if the summary held still
+                if self.__account_store.get_user_summary(user_id) == stored:
+                    break
+            else:
+                self.root_logger.warning("Account summary kept changing during verification. user_id='%s'", user_id)
+                continue
+            actual = UserSummary(user_id, len(accounts), sum(account.balance for account in accounts))
+            if actual != stored:
+                self.root_logger.error("Account summary has drifted from the accounts. user_id='%s', stored='%s', actual='%s'", user_id, stored, actual)
+                drifts.append(SummaryDrift(user_id, stored, actual))
+        return drifts
+
+    def get_account_transactions(self, user_id: str, account_id: str, start: str = None, end: str = None, limit: int = 100, after: int = None) -> list[Transaction]:
+        """Lists up to limit of the transactions on a user's account from start up to but not including end, oldest first, starting after the transaction with id after.
+        start and end are ISO 8601 dates or times, and either may be left out. Pass the id of the last transaction in a page to get the next one"""
+        if(not isinstance(limit, int) or limit < 1 or limit > self.max_page_limit):
+            raise InvalidPageLimitError(limit, self.max_page_limit)
+        if(after is not None and not isinstance(after, int)):
+            raise InvalidTransactionCursorError(after)
+        start, end = transaction_time_bound("from", start), transaction_time_bound("to", end)
+        self.get_user_account(user_id, account_id)
+        try:
+            transactions = self.__transaction_store.get_transactions(account_id, start, end, limit, after)
+        except TransactionStoreError as e:
+            self.root_logger.warning("Failed to look up transactions for account. account_id='%s', e='%s'", account_id, e)
+            raise TransactionLookupError(account_id) from e
+        if transactions is None:
+            raise InvalidTransactionCursorError(after)
+        return transactions
+
     def transfer(self, user_id: str, from_account_id: str, to_account_id: str, amount: int) -> Account:
         """Transfers an amount betweeen two accounts"""
         # Validate that transfer is possible and allowed
         if(from_account_id == to_account_id):
             raise SelfTransferError(from_account_id)
 
-        from_account = self.get_user_account(user_id, from_account_id)
+        with self.__locked_accounts(from_account_id, to_account_id):
+            from_account = self.get_user_account(user_id, from_account_id)
 
-        if(not isinstance(amount, int) or amount <= 0 or from_account.balance < amount):
-            raise IllegalTransferAmountError(amount, from_account.balance)
+            if(not isinstance(amount, int) or amount <= 0 or from_account.balance < amount):
+                raise IllegalTransferAmountError(amount, from_account.balance)
 
-        to_account = self.__internal_get_account(account_id=to_account_id)
-        if(not to_account):
-            raise AccountNotFoundError(to_account_id)
+            to_account = self.__internal_get_account(account_id=to_account_id)
+            if(not to_account):
+                raise AccountNotFoundError(to_account_id)
 
-        # Start the transfer
-        original_from_account = from_account
-        from_account.balance = from_account.balance - amount
-        to_account.balance = to_account.balance + amount
+            # Start the transfer. Work on copies, as the store may hand out the very objects it keeps.
+            # Both accounts are written in one store operation, so a failure can't leave the money half-moved.
+            updated_from_account = replace(from_account, balance=from_account.balance - amount)
+            updated_to_account = replace(to_account, balance=to_account.balance + amount)
 
-        try:
-            self.__account_store.update_account(from_account)
-        except AccountStoreUpdateError as e:
-            self.root_logger.warning("Unexpected error occurred when attempting to update the from-account during a transfer. from_account_id='%s', to_account_id='%s',  e='%s'", from_account_id, to_account_id, e)
-            raise TransferError(from_account_id, to_account_id) from e
-        try:
-            self.__account_store.update_account(to_account)
-        except AccountUpdateError as e:
-            self.root_logger.warning("Unexpected error when attempting to update to-account during transfer. Attempting a roll-back. from_account_id='%s', to_account_id='%s',  e='%s'", from_account_id, to_account_id, e)
-            self.__rollback(original_from_account, to_account_id)
+            try:
+                self.__account_store.update_accounts([updated_from_account, updated_to_account])
+            except AccountStoreConflictError as e:
+                self.root_logger.info("Accounts were changed concurrently during a transfer. from_account_id='%s', to_account_id='%s'", from_account_id, to_account_id)
+                raise TransferConflictError(from_account_id) from e
+            except AccountStoreUpdateError as e:
+                self.root_logger.warning("Unexpected error occurred when attempting to update the accounts during a transfer. from_account_id='%s', to_account_id='%s',  e='%s'", from_account_id, to_account_id, e)
+                raise TransferError(from_account_id, to_account_id) from e
+            updated_from_account.version += 1
+            # Still under the locks, so every account's transactions are recorded in the order its balance changed
+            self.__record_transactions([Transaction(from_account_id, to_account_id, -amount, updated_from_account.balance),
+                                        Transaction(to_account_id, from_account_id, amount, updated_to_account.balance)])
 
         self.audit_logger.info("Transfered an amount between two accounts. from_account_id=%s, to_account_id=%s, user_id=%s, amount=%s", from_account_id, to_account_id, user_id, amount)
-        return from_account
+        return updated_from_account
     
-    def __rollback(self, original_from_account: Account, to_account_id: str):
-        try:
-            self.__account_store.update_account(original_from_account)
-            self.root_logger.info("Successfully rolled back the transfer. from_account_id='%s', to_account_id='%s'", original_from_account.id, to_account_id) 
-            raise TransferError(to_account_id, original_from_account.id)
-        except Exception as e:
-            self.root_logger.error("Unsuccessfully rolled back the transfer. Store is in a corrupted state. from_account_id='%s', to_account_id='%s' e='%s'", original_from_account.id, to_account_id, e) 
-            raise TransferError(to_account_id, original_from_account.id) from e
\ No newline at end of file
+    def transfer_many(self, user_id: str, transfers: list[TransferRequest]) -> list[Account]:
+        """Applies a batch of transfers all-or-nothing. Transfers are applied in the given order, so later transfers can spend money moved by earlier ones"""
+        if(not transfers):
+            raise EmptyBatchError()
+        if(len(transfers) > self.max_transfer_batch):
+            raise TransferBatchTooLargeError(len(transfers), self.max_transfer_batch)
+
+        # Reject obviously invalid transfers before taking any locks
+        for index, transfer in enumerate(transfers):
+            if(not isinstance(transfer.from_account_id, str) or not isinstance(transfer.to_account_id, str) or not isinstance(transfer.amount, int) or transfer.amount <= 0):
+                raise InvalidBatchTransferError(index)
+            if(transfer.from_account_id == transfer.to_account_id):
+                raise SelfTransferError(transfer.from_account_id)
+
+        from_account_ids = {transfer.from_account_id for transfer in transfers}
+        involved_account_ids = from_account_ids | {transfer.to_account_id for transfer in transfers}
+
+        with self.__locked_accounts(*involved_account_ids):
+            balances: dict[str, Account] = {}
+            for account_id in involved_account_ids:
+                account = self.__internal_get_account(account_id, user_id if account_id in from_account_ids else None)
+                if(not account):
+                    raise AccountNotFoundError(account_id)
+                balances[account_id] = replace(account)
+
+            transactions = []
+            for transfer in transfers:
+                from_account = balances[transfer.from_account_id]
+                to_account = balances[transfer.to_account_id]
+                if(not isinstance(transfer.amount, int) or transfer.amount <= 0 or from_account.balance < transfer.amount):
+                    raise IllegalTransferAmountError(transfer.amount, from_account.balance)
+                from_account.balance -= transfer.amount
+                to_account.balance += transfer.amount
+                transactions.append(Transaction(transfer.from_account_id, transfer.to_account_id, -transfer.amount, from_account.balance))
+                transactions.append(Transaction(transfer.to_account_id, transfer.from_account_id, transfer.amount, to_account.balance))
+
+            try:
+                self.__account_store.update_accounts(list(balances.values()))
+            except AccountStoreConflictError as e:
+                self.root_logger.info("Accounts were changed concurrently during a batch of transfers. user_id='%s', transfer_count='%s'", user_id, len(transfers))
+                raise TransferConflictError(transfers[0].from_account_id) from e
+            except AccountStoreUpdateError as e:
+                self.root_logger.warning("Unexpected error occurred when attempting to apply a batch of transfers. user_id='%s', transfer_count='%s', e='%s'", user_id, len(transfers), e)
+                raise BatchTransferError(len(transfers)) from e
+            for account in balances.values():
+                account.version += 1
+            self.__record_transactions(transactions)
+
+        self.audit_logger.info("Transfered amounts in a batch. user_id=%s, transfer_count=%s, transfers=%s", user_id, len(transfers),
+                               ";".join(f"{t.from_account_id}>{t.to_account_id}:{t.amount}" for t in transfers), extra={"account_ids": sorted(involved_account_ids)})
+        return [balances[account_id] for account_id in dict.fromkeys(t.from_account_id for t in transfers)]
@@ -1,6 +1,8 @@
 """ This module defines the abstract AccountStore class"""
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+import os
+import uuid
 
 @dataclass
 class Account:
@@ -8,6 +10,19 @@ class Account:
     id: str
     user_id: str
     balance: int
+    version: int = 0
+
+@dataclass
+class UserSummary:
+    """ A user's account count and total balance, as kept up to date by the store """
+    user_id: str
+    account_count: int = 0
+    total_balance: int = 0
+
+def new_account_ids(count: int) -> list[uuid.UUID]:
+    """ Generates count random account ids, like uuid4() but drawing the randomness for all of them in one go """
+    random_bytes = os.urandom(16 * count)
+    return [uuid.UUID(bytes=random_bytes[i:i + 16], version=4) for i in range(0, 16 * count, 16)]
 
 class AccountStoreError(Exception):
     """ Base exception for account stores """
@@ -34,6 +49,11 @@ class AccountStoreUpdateError(AccountStoreError):
     def __init__(self, original_exception, message = "Operation failed unexpectedly, when attempting to update account."):
         super().__init__(original_exception, message)
 
+class AccountStoreConflictError(AccountStoreUpdateError):
+    """Exception raised when an account was changed by someone else since it was read """
+    def __init__(self, original_exception, message = "Account was changed since it was read, when attempting to update account."):
+        super().__init__(original_exception, message)
+
 class AccountStore(ABC):
     """ Abstract class, which all account stores will inherit from """
 
@@ -41,9 +61,18 @@ class AccountStore(ABC):
     def create_account(self, user_id: str, initial_balance: int):
         """ Abstract method for creating account in store"""
 
+    @abstractmethod
+    def create_accounts(self, user_id: str, initial_balances: list[int]):
+        """ Abstract method for creating several accounts for a user in store as one operation, returned in the order of initial_balances. Either all accounts are created or none are"""
+
     @abstractmethod
     def update_account(self, account: Account):
-        """ Abstract method for updating an account in store"""
+        """ Abstract method for updating an account in store.
+        The account's version must be the version last read from the store, which then bumps it by one. Raises AccountStoreConflictError otherwise"""
+
+    @abstractmethod
+    def update_accounts(self, accounts: list[Account]):
+        """ Abstract method for updating several accounts in store as one operation, with the same version check as update_account. Either all accounts are updated or none are"""
 
     @abstractmethod
     def get_account(self, account_id: str, user_id: str = None):
@@ -52,3 +81,22 @@ class AccountStore(ABC):
     @abstractmethod
     def get_accounts(self, user_id: str):
         """ Abstract method for getting all accounts belonging to a user"""
+
+    @abstractmethod
+    def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        """ Abstract method for getting up to limit of a user's accounts, in creation order, starting after the account with id after.
+        Returns None if after is not one of the user's accounts"""
+
+    @abstractmethod
+    def get_user_summary(self, user_id: str):
+        """ Abstract method for getting a user's account count and total balance as a UserSummary, without reading the user's accounts.
+        The store updates it in the same operation as the accounts it sums up. Users without accounts get a summary of zeroes"""
+
+    @abstractmethod
+    def get_user_summaries(self):
+        """ Abstract method for getting the summary of every user with accounts"""
+
+    def transfer_locks(self, count: int) -> list | None:
+        """ Returns count locks that exclude each other across every process using the store, for AccountCollection to lock transfers with.
+        Returns None for stores where every process has its own accounts, or where the version check is all that guards other processes"""
+        return None
@@ -0,0 +1,107 @@
+""" This module implements admission control, which turns requests away with 429 or 503 instead of letting them queue up behind expensive work """
+import base64
+from collections.abc import Callable
+from dataclasses import dataclass
+import math
+import threading
+import time
+from errors import APIError
+
+class TooManyRequestsError(APIError):
+    def __init__(self, retry_after: int):
+        super().__init__("Too many requests. Try again later.", 429, retry_after=retry_after)
+        self.headers["Retry-After"] = str(retry_after)
+
+class ServiceBusyError(APIError):
+    def __init__(self, retry_after: int):
+        super().__init__("The service is busy. Try again later.", 503, retry_after=retry_after)
+        self.headers["Retry-After"] = str(retry_after)
+
+class RateLimiter():
+    """ A token bucket per client. Every client may make burst requests at once, and rate requests per second after that.
+    Buckets are created on a client's first request. Once there are more than max_clients, the buckets that have filled up again are dropped,
+    as a full bucket is no different from a new one."""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 100000):
+        self.__rate = rate
+        self.__burst = burst
+        self.__max_clients = max_clients
+        self.__buckets: dict[object, list[float]] = {}     # client -> [tokens, monotonic time of the last update]
+        self.__lock = threading.Lock()
+
+    def take(self, client) -> float:
+        """ Takes a token from the client's bucket. Returns 0 if there was one, and otherwise the seconds until there will be """
+        now = time.monotonic()
+        with self.__lock:
+            bucket = self.__buckets.get(client)
+            if bucket is None:
+                if len(self.__buckets) >= self.__max_clients:
+                    self.__drop_full_buckets(now)
+                bucket = self.__buckets[client] = [self.__burst, now]
+            tokens = min(self.__burst, bucket[0] + (now - bucket[1]) * self.__rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / self.__rate
+
+    def __drop_full_buckets(self, now: float):
+        self.__buckets = {client: bucket for client, bucket in self.__buckets.items() if bucket[0] + (now - bucket[1]) * self.__rate < self.__burst}
+        if len(self.__buckets) >= self.__max_clients:
+            # Every client is busy. Forgetting them lets them all start over with a full bucket, which beats running out of memory.
+            self.__buckets.clear()
+
+@dataclass
+class RouteLimits:
+    """ The limits of one route. concurrency caps the requests it runs at once, and rate and burst configure a RateLimiter per client.
+    Requests over the concurrency limit are told to retry after retry_after seconds """
+    concurrency: int = None
+    rate: float = None
+    burst: float = None
+    retry_after: int = 1
+
+class AdmissionControl():
+    """ Admits or turns away requests, based on per-route limits configured as {"<METHOD> <rule>": {"concurrency": ..., "rate": ..., "burst": ...}},
+    e.g. {"GET /auth": {"concurrency": 8, "rate": 1, "burst": 5}}. Routes without limits are always admitted.
+    Rate limits are checked first, so that requests turned away by them never take a concurrency slot."""
+
+    def __init__(self, limits: dict[str, dict] = None):
+        self.__routes: dict[tuple[str, str], tuple[RouteLimits, threading.BoundedSemaphore | None, RateLimiter | None]] = {}
+        for route, settings in (limits or {}).items():
+            method, _, rule = route.partition(" ")
+            route_limits = RouteLimits(**settings)
+            slots = threading.BoundedSemaphore(route_limits.concurrency) if route_limits.concurrency else None
+            rate_limiter = None
+            if route_limits.rate:
+                rate_limiter = RateLimiter(route_limits.rate, route_limits.burst or max(1, route_limits.rate))
+            self.__routes[(method.upper(), rule)] = (route_limits, slots, rate_limiter)
+
+    def admit(self, method: str, rule: str, client: Callable[[], object]):
+        """ Raises TooManyRequestsError or ServiceBusyError if the request can't be run now. client is only called for routes with a rate limit.
+        Otherwise returns the semaphore to release once the request is done, or None if there is nothing to release """
+        route = self.__routes.get((method, rule))
+        if route is None:
+            return None
+        route_limits, slots, rate_limiter = route
+        if rate_limiter:
+            wait = rate_limiter.take(client())
+            if wait:
+                raise TooManyRequestsError(max(1, math.ceil(wait)))
+        if slots:
+            if not slots.acquire(blocking=False):
+                raise ServiceBusyError(route_limits.retry_after)
+        return slots
+
+def client_key(authorization: str, address: str):
+    """ Tells clients apart for rate limiting: by username for basic auth, by access token for bearer auth, and otherwise by address.
+    Tokens are only known to the client they were issued to, so unlike the user id inside them they can't be used to spend someone else's requests """
+    scheme, _, credentials = (authorization or "").partition(" ")
+    if scheme == "Bearer" and credentials:
+        return ("token", hash(credentials))
+    if scheme == "Basic" and credentials:
+        try:
+            return ("user", base64.b64decode(credentials, validate=True).partition(b":")[0])
+        except ValueError:
+            pass
+    return ("address", address)
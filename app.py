@@ -1,64 +1,164 @@
 """ This module is the main flask application """
-from logging.config import dictConfig
+import functools
+import hashlib
 import json
+import logging
+import threading
+import time
 
-from flask import Flask, request, jsonify
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify, stream_with_context
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity
+from werkzeug.local import LocalProxy
 
-from in_memory_user_store import InMemoryUserStore
-from in_memory_account_store import InMemoryAccountStore
-from user_collection import UserCollection
-from account_collection import AccountCollection
+from logging_config import logging_config
+from stores import create_stores
+from user_collection import UserCollection, UserNotFoundError
+from password_hasher import PasswordHasher, bcrypt_workers
+from account_collection import AccountCollection, TransferRequest
 from errors import APIError
+from admission import AdmissionControl, client_key
+from metrics import REGISTRY, HTTP_REQUEST_DURATION
+from idempotency import IdempotentRequests, is_final
+from jwt_cache import VerifiedTokenCache, cached_jwt_required
+from json_encoding import FastJSONProvider
+from idempotency_store import StoredResponse
 
-# Confgure our two loggers
-# Root: For general logging to the error stream
-# Audit: For logging to the audit.log file for when auditers need to audit our system
-dictConfig({
-    'version': 1,
-    'formatters': {'default': {
-        'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
-    }, 'auditFormatter': {
-        'format': '[AUDIT - %(asctime)s]: %(message)s',
-    }},
-    'handlers': {'wsgi': {
-        'class': 'logging.StreamHandler',
-        'stream': 'ext://flask.logging.wsgi_errors_stream',
-        'formatter': 'default'
-    }, 'auditHandler': {
-        'formatter': 'auditFormatter',
-        'class': 'logging.handlers.RotatingFileHandler',
-        'filename': "audit.log",
-        'maxBytes': 5000000,
-        'backupCount': 10
-    } },
-     'loggers': {
-           'audit': {
-        'level': 'INFO',
-        'handlers': ['auditHandler'],
-        "propagate": False
-,    }},
-    'root': {
-        'level': 'INFO',
-        'handlers': ['wsgi'],
-    },
-})
-
-app = Flask(__name__)
-app.config.from_file("config.json", load=json.load)
-
-jwt = JWTManager(app)
-store = UserCollection(user_store=InMemoryUserStore())
-accountCollection = AccountCollection(account_store=InMemoryAccountStore())
-
-@app.errorhandler(APIError)
+class Services():
+    """ The stores and collections behind the routes of one app.
+    They are built by the first request that needs them rather than by create_app(), so that a master process preloading the app
+    (gunicorn --preload) never opens a store or starts a bcrypt pool, and every worker it forks builds its own."""
+
+    def __init__(self, config):
+        self.__config = config
+        self.__lock = threading.Lock()
+        self.__built = False
+
+    def __build(self):
+        with self.__lock:
+            if self.__built:
+                return
+            config = self.__config
+            password_hasher = PasswordHasher(max_workers=bcrypt_workers(config),
+                                             max_pending=config.get("BCRYPT_MAX_PENDING"),
+                                             verification_cache_ttl=config.get("AUTH_CACHE_TTL_SECONDS", 0))
+            user_store, account_store, idempotency_store, transaction_store = create_stores(config)
+            self.user_collection = UserCollection(user_store=user_store, password_hasher=password_hasher)
+            self.account_collection = AccountCollection(account_store=account_store, transaction_store=transaction_store)
+            self.idempotent_requests = IdempotentRequests(idempotency_store)
+            self.__built = True
+
+    def __getattr__(self, name: str):
+        # Only called for attributes that aren't set yet, so once everything is built, lookups cost nothing extra
+        if name.startswith("_") or self.__built:
+            raise AttributeError(name)
+        self.__build()
+        return getattr(self, name)
+
+api = Blueprint("api", __name__)
+
+# The routes reach the services of whichever app is handling the request through these
+store: UserCollection = LocalProxy(lambda: current_app.extensions["services"].user_collection)
+accountCollection: AccountCollection = LocalProxy(lambda: current_app.extensions["services"].account_collection)
+idempotentRequests: IdempotentRequests = LocalProxy(lambda: current_app.extensions["services"].idempotent_requests)
+
+def token_cache() -> VerifiedTokenCache | None:
+    """ The current app's cache of verified tokens. JWT_VERIFICATION_CACHE_SIZE set to 0 turns it off """
+    return current_app.extensions["verified_token_cache"]
+
+def create_app(config: dict = None) -> Flask:
+    """ Builds the Flask app. Without config, it reads config.json and sets up logging.
+    Stores and collections are only built once a request needs them, see Services. """
+    app = Flask(__name__)
+    # Serializes accounts and users through an encoder compiled once per type, or through orjson if it is installed
+    app.json = FastJSONProvider(app)
+    if config is None:
+        from logging.config import dictConfig
+        dictConfig(logging_config("ext://flask.logging.wsgi_errors_stream"))
+        app.config.from_file("config.json", load=json.load)
+        REGISTRY.gauge("audit_queue_depth", "Audit records waiting to be written to file.", logging.getLogger("audit").handlers[0].queue_depth)
+    else:
+        app.config.update(config)
+
+    # Metrics are always collected. With METRICS_DIR set, every worker also shares its numbers through that directory, so /metrics shows totals for all workers.
+    if app.config.get("METRICS_DIR"):
+        REGISTRY.share_through(app.config["METRICS_DIR"])
+
+    JWTManager(app)
+    # Account routes look tokens up here before fully verifying them
+    token_cache_size = app.config.get("JWT_VERIFICATION_CACHE_SIZE", 10000)
+    app.extensions["verified_token_cache"] = VerifiedTokenCache(token_cache_size) if token_cache_size else None
+    app.extensions["services"] = Services(app.config)
+    # Per-route concurrency limits and per-client rate limits, e.g. to keep bcrypt on /auth from crowding out cheap reads
+    app.extensions["admission"] = AdmissionControl(app.config.get("ADMISSION_LIMITS"))
+    app.register_blueprint(api)
+    return app
+
+@api.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@api.before_app_request
+def admit_request():
+    """ Turns the request away with 429 or 503 if its route is over one of the limits in ADMISSION_LIMITS """
+    if request.url_rule is not None:
+        g.admission_slot = current_app.extensions["admission"].admit(request.method, request.url_rule.rule,
+                                                                     lambda: client_key(request.headers.get("Authorization"), request.remote_addr))
+
+@api.teardown_app_request
+def release_admission_slot(exception):
+    slot = g.pop("admission_slot", None)
+    if slot is not None:
+        slot.release()
+
+@api.after_app_request
+def observe_request_duration(response):
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    HTTP_REQUEST_DURATION.observe(time.perf_counter() - g.request_start, route, request.method, str(response.status_code))
+    return response
+
+@api.route("/metrics", methods=["GET"])
+def metrics():
+    """ Endpoint for Prometheus to scrape """
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@api.app_errorhandler(APIError)
 def api_error(e):
     """ Handles all our custom errors meant for the api level. Non-custom errors will return a status-code 500 and be logged as ERROR"""
-    app.logger.warning("An error occurred while handling a request. e='%s'", e)
-    return jsonify(e.to_dict()), e.status_code
+    current_app.logger.warning("An error occurred while handling a request. e='%s'", e)
+    return jsonify(e.to_dict()), e.status_code, e.headers
+
+def idempotent(view):
+    """ Lets clients safely retry the route by sending an Idempotency-Key header. Retries with the same key get the first response again,
+    including its errors, without the route running a second time. Errors that ask for a retry, like conflicts, aren't kept, so a retry with the key runs the route again. Must be applied below the JWT decorator, as keys are scoped by user. """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return view(*args, **kwargs)
+        fingerprint = hashlib.sha256(f"{request.method} {request.path}\n".encode("utf-8") + request.get_data()).hexdigest()
+
+        def handle() -> StoredResponse:
+            try:
+                response = view(*args, **kwargs)
+            except APIError as e:
+                if not is_final(e):
+                    raise
+                current_app.logger.warning("An error occurred while handling a request. e='%s'", e)
+                return StoredResponse(fingerprint, e.status_code, e.to_dict())
+            return StoredResponse(fingerprint, response.status_code, response.get_json())
+
+        stored_response, replayed = idempotentRequests.run(get_jwt_identity(), key, fingerprint, handle)
+        if replayed:
+            current_app.logger.info("Replayed response for idempotency key. key=%s", key)
+        response = jsonify(stored_response.body)
+        response.status_code = stored_response.status_code
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return response
+    return wrapper
 
 # USER ROUTES
-@app.route("/users", methods = ["POST"])
+@api.route("/users", methods = ["POST"])
 def create_user():
     """ Endpoint for creating a new user """
     content = request.get_json()
@@ -66,18 +166,30 @@ def create_user():
         raise APIError("username not submitted in body", 400)
     username = content['username']
     user, pwd = store.create_user(username)
-    app.logger.info("Successfully created a new user. username=%s, user_id=%s", user.username, user.id)
+    current_app.logger.info("Successfully created a new user. username=%s, user_id=%s", user.username, user.id)
     return jsonify({"user": user, "pwd": pwd})
 
 
-@app.route("/users/<username>", methods = ["GET"])
+@api.route("/users/<username>", methods = ["GET"])
 def get_user(username: str):
     """ Endpoint for getting a user by username """
     user = store.get_user(username)
-    app.logger.info("Successfully fetched user upon request. username=%s, user_id=%s", user.username, user.id)
+    current_app.logger.info("Successfully fetched user upon request. username=%s, user_id=%s", user.username, user.id)
     return jsonify({"user": user})
 
-@app.route("/auth", methods = ["GET"])
+@api.route("/users/<username>/summary", methods = ["GET"])
+@cached_jwt_required(token_cache)
+def get_user_summary(username: str):
+    """ Endpoint for getting a user's account count and total balance. Users can only see their own """
+    user = store.get_user(username)
+    if user.id != get_jwt_identity():
+        # The same answer as for a user that doesn't exist, so the route can't be used to find out which users do
+        raise UserNotFoundError(username)
+    summary = accountCollection.get_user_summary(user.id)
+    current_app.logger.info("Successfully fetched account summary for user upon request. user_id=%s", user.id)
+    return jsonify({"summary": summary})
+
+@api.route("/auth", methods = ["GET"])
 def authenticate():
     """ Endpoint for authenticating a user and getting an access token"""
     if "username" not in request.authorization:
@@ -91,12 +203,12 @@ def authenticate():
     user = store.authenticate(username, pwd)
     token = create_access_token(identity=user.id)
 
-    app.logger.info("User successfully authenticated username=%s, user_id=%s", user.username, user.id)
+    current_app.logger.info("User successfully authenticated username=%s, user_id=%s", user.username, user.id)
     return jsonify({"token": token})
 
 # ACCOUNT ROUTES
-@app.route('/accounts', methods=['POST'])
-@jwt_required()
+@api.route('/accounts', methods=['POST'])
+@cached_jwt_required(token_cache)
 def create_account():
     """ Endpoint for creating a new account for a user """
     user_id = get_jwt_identity()
@@ -108,31 +220,109 @@ def create_account():
 
     account = accountCollection.create_account(user_id, balance)
 
-    app.logger.info("Successfully created a new account. account_id=%s, user_id=%s", account.id, user_id)
+    current_app.logger.info("Successfully created a new account. account_id=%s, user_id=%s", account.id, user_id)
     return jsonify({'account':account})
 
+@api.route('/accounts/batch', methods=['POST'])
+@cached_jwt_required(token_cache)
+@idempotent
+def create_accounts():
+    """ Endpoint for creating many accounts for a user at once, e.g. when onboarding a business """
+    user_id = get_jwt_identity()
+    content = request.get_json()
+
+    if "balances" not in content:
+        raise APIError("balances not submitted in body", 400)
+
+    accounts = accountCollection.create_accounts(user_id, content['balances'])
+
+    current_app.logger.info("Successfully created accounts in bulk. user_id=%s, account_count=%s", user_id, len(accounts))
+    return jsonify({'accounts': accounts})
+
+def accounts_etag(accounts) -> str:
+    """ An ETag that changes whenever an account is added to the list or any of them is updated """
+    digest = hashlib.blake2b(digest_size=16)
+    for account in accounts:
+        digest.update(f"{account.id}.{account.version};".encode("ascii"))
+    return digest.hexdigest()
+
+def conditional_json(etag: str, build_body):
+    """ Answers with 304 Not Modified if the client already has the current version, and only builds and serializes the body if it doesn't """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build_body())
+    response.set_etag(etag)
+    return response
 
-@app.route('/accounts/<account_id>', methods=['GET'])
-@jwt_required()
+@api.route('/accounts/<account_id>', methods=['GET'])
+@cached_jwt_required(token_cache)
 def get_account(account_id: str):
     """ Endpoint for getting a particular account for a user """
     user_id = get_jwt_identity()
     account = accountCollection.get_user_account(user_id, account_id)
-    app.logger.info("Successfully fetched account for user upon request. account_id=%s, user_id=%s", account.id, user_id)
-    return jsonify({'account': account})
+    current_app.logger.info("Successfully fetched account for user upon request. account_id=%s, user_id=%s", account.id, user_id)
+    return conditional_json(f"{account.id}.{account.version}", lambda: {'account': account})
 
-@app.route('/accounts', methods=['GET'])
-@jwt_required()
+@api.route('/accounts', methods=['GET'])
+@cached_jwt_required(token_cache)
 def get_accounts():
-    """ Endpoint for getting all accounts for a user """
+    """ Endpoint for getting all accounts for a user.
+    With a limit query parameter, a single page is returned along with the cursor to pass as after to get the next page.
+    With stream=true, every account is returned, but the response is written page by page instead of being built in memory first."""
     user_id = get_jwt_identity()
+
+    if request.args.get("stream") == "true":
+        accounts = accountCollection.iter_user_accounts(user_id)
+        current_app.logger.info("Streaming accounts for user upon request.  user_id=%s", user_id)
+        return Response(stream_with_context(stream_accounts_json(accounts)), mimetype="application/json")
+
+    if "limit" in request.args:
+        try:
+            limit = int(request.args["limit"])
+        except ValueError as e:
+            raise APIError("limit must be an integer", 400, limit=request.args["limit"]) from e
+        accounts = accountCollection.get_user_accounts_page(user_id, limit, request.args.get("after"))
+        next_after = accounts[-1].id if len(accounts) == limit else None
+        current_app.logger.info("Successfully fetched a page of accounts for user upon request.  user_id=%s", user_id)
+        return conditional_json(accounts_etag(accounts), lambda: {'accounts': accounts, 'next_after': next_after})
+
     accounts = accountCollection.get_user_accounts(user_id)
-    app.logger.info("Successfully fetched accounts for user upon request.  user_id=%s", user_id)
-    return jsonify({'accounts': accounts})
+    current_app.logger.info("Successfully fetched accounts for user upon request.  user_id=%s", user_id)
+    return conditional_json(accounts_etag(accounts), lambda: {'accounts': accounts})
+
+@api.route('/accounts/<account_id>/transactions', methods=['GET'])
+@cached_jwt_required(token_cache)
+def get_account_transactions(account_id: str):
+    """ Endpoint for getting the transactions on an account, oldest first.
+    from and to limit them to a time range, and a page holds up to limit of them, along with the cursor to pass as after to get the next page."""
+    user_id = get_jwt_identity()
+    try:
+        limit = int(request.args.get("limit", 100))
+    except ValueError as e:
+        raise APIError("limit must be an integer", 400, limit=request.args["limit"]) from e
+    try:
+        after = int(request.args["after"]) if "after" in request.args else None
+    except ValueError as e:
+        raise APIError("after must be an integer", 400, after=request.args["after"]) from e
+    transactions = accountCollection.get_account_transactions(user_id, account_id, request.args.get("from"), request.args.get("to"), limit, after)
+    next_after = transactions[-1].id if len(transactions) == limit else None
+    current_app.logger.info("Successfully fetched transactions for account upon request. account_id=%s, user_id=%s", account_id, user_id)
+    return jsonify({'transactions': transactions, 'next_after': next_after})
+
+def stream_accounts_json(accounts):
+    """ Writes the same body as jsonify({'accounts': accounts}), one account at a time """
+    yield '{"accounts":['
+    separator = ""
+    for account in accounts:
+        yield separator + current_app.json.dumps(account)
+        separator = ","
+    yield ']}\n'
 
 
-@app.route('/accounts/<account_id>', methods=['PATCH'])
-@jwt_required()
+@api.route('/accounts/<account_id>', methods=['PATCH'])
+@cached_jwt_required(token_cache)
+@idempotent
 def transfer(account_id: str):
     """ Endpoint for initializing a transfer """
     user_id = get_jwt_identity()
@@ -147,5 +337,28 @@ def transfer(account_id: str):
     amount = content['amount']
     
     account = accountCollection.transfer(user_id, account_id, to_account_id, amount)
-    app.logger.info("Successfully transfered an amount between two accounts. from_account_id=%s, to_account_id=%s", account_id, to_account_id)
-    return jsonify({'account':account})
\ No newline at end of file
+    current_app.logger.info("Successfully transfered an amount between two accounts. from_account_id=%s, to_account_id=%s", account_id, to_account_id)
+    return jsonify({'account':account})
+
+
+@api.route('/transfers/batch', methods=['POST'])
+@cached_jwt_required(token_cache)
+@idempotent
+def transfer_batch():
+    """ Endpoint for applying a batch of transfers all-or-nothing """
+    user_id = get_jwt_identity()
+    content = request.get_json()
+
+    if "transfers" not in content or not isinstance(content["transfers"], list):
+        raise APIError("transfers not submitted in body", 400)
+
+    transfers = []
+    for transfer in content["transfers"]:
+        for key in ("from_account_id", "to_account_id", "amount"):
+            if not isinstance(transfer, dict) or key not in transfer:
+                raise APIError(f"{key} not submitted for every transfer in batch", 400)
+        transfers.append(TransferRequest(transfer["from_account_id"], transfer["to_account_id"], transfer["amount"]))
+
+    accounts = accountCollection.transfer_many(user_id, transfers)
+    current_app.logger.info("Successfully applied a batch of transfers. user_id=%s, transfer_count=%s", user_id, len(transfers))
+    return jsonify({'accounts': accounts})
@@ -0,0 +1,452 @@
+""" This module is the ASGI counterpart of app.py. It serves the same routes with the same errors, backed by the async collections,
+so one process can keep thousands of requests in flight while the stores and bcrypt do their work outside the event loop.
+
+    uvicorn --factory asgi_app:create_app
+"""
+from collections.abc import AsyncIterator, Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from logging.config import dictConfig
+from urllib.parse import parse_qs
+import base64
+import hashlib
+import json
+import logging
+import re
+import time
+import uuid
+
+import jwt
+
+from async_account_collection import AsyncAccountCollection
+from async_account_store import AsyncAccountStoreAdapter
+from async_idempotency import AsyncIdempotentRequests
+from idempotency import is_final
+from async_transaction_store import AsyncTransactionStoreAdapter
+from async_user_collection import AsyncUserCollection
+from async_user_store import AsyncUserStoreAdapter
+from user_collection import UserNotFoundError
+from account_collection import TransferRequest
+from admission import AdmissionControl, client_key
+from errors import APIError
+from idempotency_store import StoredResponse
+from jwt_cache import VerifiedTokenCache
+from json_encoding import dumps
+from logging_config import logging_config
+from metrics import REGISTRY, HTTP_REQUEST_DURATION
+from password_hasher import PasswordHasher, bcrypt_workers
+from stores import create_stores, stores_block_on_io
+
+logger = logging.getLogger(__name__)
+
+class AuthorizationError(Exception):
+    """ A missing or invalid access token. Answered with the same status codes and body as flask_jwt_extended uses """
+    def __init__(self, msg: str, status_code: int):
+        super().__init__(msg)
+        self.msg = msg
+        self.status_code = status_code
+
+class Request():
+    """ The parts of an HTTP request the routes use """
+    def __init__(self, scope: dict, body: bytes):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        self.args = {name: values[0] for name, values in parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True).items()}
+        self.body = body
+        self.client = (scope.get("client") or ("", 0))[0]
+        self.user_id = None
+
+    def get_json(self) -> dict:
+        """ Parses the body as a JSON object """
+        try:
+            content = json.loads(self.body)
+        except ValueError as e:
+            raise APIError("Request body must be a JSON object", 400) from e
+        if not isinstance(content, dict):
+            raise APIError("Request body must be a JSON object", 400)
+        return content
+
+@dataclass
+class Response():
+    """ A response to send. The body is either complete, or streamed chunk by chunk """
+    status_code: int
+    body: bytes | AsyncIterator[bytes] = b""
+    headers: dict[str, str] = field(default_factory=dict)
+
+def json_response(body, status_code: int = 200) -> Response:
+    return Response(status_code, dumps(body) + b"\n", {"content-type": "application/json"})
+
+@dataclass
+class Route():
+    rule: str
+    method: str
+    handler: Callable[..., Awaitable[Response]]
+    jwt_required: bool = False
+    pattern: re.Pattern = None
+
+    def __post_init__(self):
+        self.pattern = re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", self.rule) + "$")
+
+class AccountsApp():
+    """ ASGI application serving the routes of app.py """
+
+    def __init__(self, config: dict, user_collection: AsyncUserCollection, account_collection: AsyncAccountCollection,
+                 idempotent_requests: AsyncIdempotentRequests, password_hasher: PasswordHasher, executor: ThreadPoolExecutor = None):
+        self.__user_collection = user_collection
+        self.__account_collection = account_collection
+        self.__idempotent_requests = idempotent_requests
+        self.__password_hasher = password_hasher
+        self.__executor = executor
+        self.__jwt_secret = config["JWT_SECRET_KEY"]
+        self.__jwt_algorithm = config.get("JWT_ALGORITHM", "HS256")
+        expires = config.get("JWT_ACCESS_TOKEN_EXPIRES", timedelta(minutes=15))
+        self.__jwt_expires = timedelta(seconds=expires) if isinstance(expires, (int, float)) and not isinstance(expires, bool) else expires
+        token_cache_size = config.get("JWT_VERIFICATION_CACHE_SIZE", 10000)
+        self.__token_cache = VerifiedTokenCache(token_cache_size) if token_cache_size else None
+        self.__admission = AdmissionControl(config.get("ADMISSION_LIMITS"))
+        self.__routes = [
+            Route("/metrics", "GET", self.metrics),
+            Route("/users", "POST", self.create_user),
+            Route("/users/<username>", "GET", self.get_user),
+            Route("/users/<username>/summary", "GET", self.get_user_summary, jwt_required=True),
+            Route("/auth", "GET", self.authenticate),
+            Route("/accounts", "POST", self.create_account, jwt_required=True),
+            Route("/accounts/batch", "POST", self.idempotent(self.create_accounts), jwt_required=True),
+            Route("/accounts/<account_id>", "GET", self.get_account, jwt_required=True),
+            Route("/accounts", "GET", self.get_accounts, jwt_required=True),
+            Route("/accounts/<account_id>/transactions", "GET", self.get_account_transactions, jwt_required=True),
+            Route("/accounts/<account_id>", "PATCH", self.idempotent(self.transfer), jwt_required=True),
+            Route("/transfers/batch", "POST", self.idempotent(self.transfer_batch), jwt_required=True),
+        ]
+
+    async def __call__(self, scope: dict, receive, send):
+        if scope["type"] == "lifespan":
+            await self.__lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        start = time.perf_counter()
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        request = Request(scope, body)
+        rule, response = await self.__dispatch(request)
+        await send({"type": "http.response.start", "status": response.status_code,
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in response.headers.items()]})
+        if isinstance(response.body, bytes):
+            await send({"type": "http.response.body", "body": response.body})
+        else:
+            async for chunk in response.body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, rule, request.method, str(response.status_code))
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.__password_hasher.shutdown()
+                if self.__executor:
+                    self.__executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __dispatch(self, request: Request) -> tuple[str, Response]:
+        """ Runs the route matching the request, and turns errors into responses. Returns the route's rule as well, for metrics """
+        path_found = False
+        for route in self.__routes:
+            match = route.pattern.match(request.path)
+            if not match:
+                continue
+            path_found = True
+            if route.method != request.method:
+                continue
+            slot = None
+            try:
+                slot = self.__admission.admit(route.method, route.rule, lambda: client_key(request.headers.get("authorization"), request.client))
+                if route.jwt_required:
+                    request.user_id = self.__verify_access_token(request)
+                return route.rule, await route.handler(request, **match.groupdict())
+            except AuthorizationError as e:
+                return route.rule, json_response({"msg": e.msg}, e.status_code)
+            except APIError as e:
+                # Handles all our custom errors meant for the api level. Non-custom errors will return a status-code 500 and be logged as ERROR
+                logger.warning("An error occurred while handling a request. e='%s'", e)
+                response = json_response(e.to_dict(), e.status_code)
+                response.headers.update((name.lower(), value) for name, value in e.headers.items())
+                return route.rule, response
+            except Exception:
+                logger.exception("Exception on %s [%s]", request.path, request.method)
+                return route.rule, json_response({"message": "Internal Server Error"}, 500)
+            finally:
+                # A streamed body is still being sent at this point, but the route's own work is done
+                if slot is not None:
+                    slot.release()
+        if path_found:
+            return "<unmatched>", json_response({"message": "Method Not Allowed"}, 405)
+        return "<unmatched>", json_response({"message": "Not Found"}, 404)
+
+    def __create_access_token(self, identity: str) -> str:
+        # The same claims flask_jwt_extended puts in a token, so tokens from either app work with both
+        now = datetime.now(timezone.utc)
+        claims = {"fresh": False, "iat": now, "jti": str(uuid.uuid4()), "type": "access", "sub": identity, "nbf": now}
+        if self.__jwt_expires:
+            claims["exp"] = now + self.__jwt_expires
+        return jwt.encode(claims, self.__jwt_secret, algorithm=self.__jwt_algorithm)
+
+    def __verify_access_token(self, request: Request) -> str:
+        """ Checks the bearer token like jwt_required() does, and returns the user id it was issued to """
+        header = request.headers.get("authorization")
+        if header is None:
+            raise AuthorizationError("Missing Authorization Header", 401)
+        parts = header.split()
+        if len(parts) != 2 or parts[0] != "Bearer":
+            raise AuthorizationError("Bad Authorization header. Expected 'Authorization: Bearer <JWT>'", 422)
+        token = parts[1]
+
+        cached = self.__token_cache.get(token) if self.__token_cache else None
+        if cached:
+            return cached[1]["sub"]
+        try:
+            jwt_header = jwt.get_unverified_header(token)
+            jwt_data = jwt.decode(token, self.__jwt_secret, algorithms=[self.__jwt_algorithm])
+        except jwt.ExpiredSignatureError as e:
+            raise AuthorizationError("Token has expired", 401) from e
+        except jwt.InvalidTokenError as e:
+            raise AuthorizationError(str(e), 422) from e
+        if jwt_data.get("type") != "access":
+            raise AuthorizationError("Only non-refresh tokens are allowed", 422)
+        if "sub" not in jwt_data:
+            raise AuthorizationError("Missing claim: sub", 422)
+        if self.__token_cache:
+            self.__token_cache.add(token, jwt_header, jwt_data)
+        return jwt_data["sub"]
+
+    def idempotent(self, handler):
+        """ Lets clients safely retry the route by sending an Idempotency-Key header, like app.idempotent """
+        async def wrapper(request: Request, **params) -> Response:
+            key = request.headers.get("idempotency-key")
+            if key is None:
+                return await handler(request, **params)
+            fingerprint = hashlib.sha256(f"{request.method} {request.path}\n".encode("utf-8") + request.body).hexdigest()
+
+            async def handle() -> StoredResponse:
+                try:
+                    response = await handler(request, **params)
+                except APIError as e:
+                    if not is_final(e):
+                        raise
+                    logger.warning("An error occurred while handling a request. e='%s'", e)
+                    return StoredResponse(fingerprint, e.status_code, e.to_dict())
+                return StoredResponse(fingerprint, response.status_code, json.loads(response.body))
+
+            stored_response, replayed = await self.__idempotent_requests.run(request.user_id, key, fingerprint, handle)
+            response = json_response(stored_response.body, stored_response.status_code)
+            if replayed:
+                logger.info("Replayed response for idempotency key. key=%s", key)
+                response.headers["idempotent-replayed"] = "true"
+            return response
+        return wrapper
+
+    async def metrics(self, request: Request) -> Response:
+        """ Endpoint for Prometheus to scrape """
+        return Response(200, REGISTRY.render().encode("utf-8"), {"content-type": "text/plain; version=0.0.4"})
+
+    # USER ROUTES
+    async def create_user(self, request: Request) -> Response:
+        """ Endpoint for creating a new user """
+        content = request.get_json()
+        if "username" not in content:
+            raise APIError("username not submitted in body", 400)
+        user, pwd = await self.__user_collection.create_user(content["username"])
+        logger.info("Successfully created a new user. username=%s, user_id=%s", user.username, user.id)
+        return json_response({"user": user, "pwd": pwd})
+
+    async def get_user(self, request: Request, username: str) -> Response:
+        """ Endpoint for getting a user by username """
+        user = await self.__user_collection.get_user(username)
+        logger.info("Successfully fetched user upon request. username=%s, user_id=%s", user.username, user.id)
+        return json_response({"user": user})
+
+    async def get_user_summary(self, request: Request, username: str) -> Response:
+        """ Endpoint for getting a user's account count and total balance. Users can only see their own """
+        user = await self.__user_collection.get_user(username)
+        if user.id != request.user_id:
+            raise UserNotFoundError(username)
+        summary = await self.__account_collection.get_user_summary(user.id)
+        logger.info("Successfully fetched account summary for user upon request. user_id=%s", user.id)
+        return json_response({"summary": summary})
+
+    async def authenticate(self, request: Request) -> Response:
+        """ Endpoint for authenticating a user and getting an access token"""
+        scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "basic":
+            raise APIError("username not submitted with basic auth", 400)
+        try:
+            username, separator, pwd = base64.b64decode(credentials).decode("utf-8").partition(":")
+        except ValueError as e:
+            raise APIError("username not submitted with basic auth", 400) from e
+        if not separator:
+            raise APIError("password not submitted with basic auth", 400)
+
+        user = await self.__user_collection.authenticate(username, pwd)
+        token = self.__create_access_token(user.id)
+
+        logger.info("User successfully authenticated username=%s, user_id=%s", user.username, user.id)
+        return json_response({"token": token})
+
+    # ACCOUNT ROUTES
+    async def create_account(self, request: Request) -> Response:
+        """ Endpoint for creating a new account for a user """
+        content = request.get_json()
+        if "balance" not in content:
+            raise APIError("balance not submitted in body", 400)
+        account = await self.__account_collection.create_account(request.user_id, content["balance"])
+        logger.info("Successfully created a new account. account_id=%s, user_id=%s", account.id, request.user_id)
+        return json_response({"account": account})
+
+    async def create_accounts(self, request: Request) -> Response:
+        """ Endpoint for creating many accounts for a user at once """
+        content = request.get_json()
+        if "balances" not in content:
+            raise APIError("balances not submitted in body", 400)
+        accounts = await self.__account_collection.create_accounts(request.user_id, content["balances"])
+        logger.info("Successfully created accounts in bulk. user_id=%s, account_count=%s", request.user_id, len(accounts))
+        return json_response({"accounts": accounts})
+
+    def __conditional_json(self, request: Request, etag: str, build_body) -> Response:
+        """ Answers with 304 Not Modified if the client already has the current version, like app.conditional_json """
+        if_none_match = {tag.strip() for tag in request.headers.get("if-none-match", "").split(",")}
+        if "*" in if_none_match or f'"{etag}"' in if_none_match:
+            response = Response(304)
+        else:
+            response = json_response(build_body())
+        response.headers["etag"] = f'"{etag}"'
+        return response
+
+    async def get_account(self, request: Request, account_id: str) -> Response:
+        """ Endpoint for getting a particular account for a user """
+        account = await self.__account_collection.get_user_account(request.user_id, account_id)
+        logger.info("Successfully fetched account for user upon request. account_id=%s, user_id=%s", account.id, request.user_id)
+        return self.__conditional_json(request, f"{account.id}.{account.version}", lambda: {"account": account})
+
+    async def get_accounts(self, request: Request) -> Response:
+        """ Endpoint for getting all accounts for a user, a page of them with limit, or all of them streamed with stream=true """
+        user_id = request.user_id
+
+        if request.args.get("stream") == "true":
+            accounts = self.__account_collection.iter_user_accounts(user_id)
+            logger.info("Streaming accounts for user upon request.  user_id=%s", user_id)
+            return Response(200, self.__stream_accounts_json(accounts), {"content-type": "application/json"})
+
+        if "limit" in request.args:
+            try:
+                limit = int(request.args["limit"])
+            except ValueError as e:
+                raise APIError("limit must be an integer", 400, limit=request.args["limit"]) from e
+            accounts = await self.__account_collection.get_user_accounts_page(user_id, limit, request.args.get("after"))
+            next_after = accounts[-1].id if len(accounts) == limit else None
+            logger.info("Successfully fetched a page of accounts for user upon request.  user_id=%s", user_id)
+            return self.__conditional_json(request, accounts_etag(accounts), lambda: {"accounts": accounts, "next_after": next_after})
+
+        accounts = await self.__account_collection.get_user_accounts(user_id)
+        logger.info("Successfully fetched accounts for user upon request.  user_id=%s", user_id)
+        return self.__conditional_json(request, accounts_etag(accounts), lambda: {"accounts": accounts})
+
+    async def get_account_transactions(self, request: Request, account_id: str) -> Response:
+        """ Endpoint for getting the transactions on an account, oldest first, within from and to, a page of limit at a time """
+        try:
+            limit = int(request.args.get("limit", 100))
+        except ValueError as e:
+            raise APIError("limit must be an integer", 400, limit=request.args["limit"]) from e
+        try:
+            after = int(request.args["after"]) if "after" in request.args else None
+        except ValueError as e:
+            raise APIError("after must be an integer", 400, after=request.args["after"]) from e
+        transactions = await self.__account_collection.get_account_transactions(request.user_id, account_id, request.args.get("from"), request.args.get("to"), limit, after)
+        next_after = transactions[-1].id if len(transactions) == limit else None
+        logger.info("Successfully fetched transactions for account upon request. account_id=%s, user_id=%s", account_id, request.user_id)
+        return json_response({"transactions": transactions, "next_after": next_after})
+
+    async def __stream_accounts_json(self, accounts):
+        """ Writes the same body as json_response({'accounts': accounts}), one account at a time """
+        yield b'{"accounts":['
+        separator = b""
+        async for account in accounts:
+            yield separator + dumps(account)
+            separator = b","
+        yield b"]}\n"
+
+    async def transfer(self, request: Request, account_id: str) -> Response:
+        """ Endpoint for initializing a transfer """
+        content = request.get_json()
+        if "to_account_id" not in content:
+            raise APIError("to_account_id not submitted in body", 400)
+        if "amount" not in content:
+            raise APIError("amount not submitted in body")
+        to_account_id = content["to_account_id"]
+
+        account = await self.__account_collection.transfer(request.user_id, account_id, to_account_id, content["amount"])
+        logger.info("Successfully transfered an amount between two accounts. from_account_id=%s, to_account_id=%s", account_id, to_account_id)
+        return json_response({"account": account})
+
+    async def transfer_batch(self, request: Request) -> Response:
+        """ Endpoint for applying a batch of transfers all-or-nothing """
+        content = request.get_json()
+        if "transfers" not in content or not isinstance(content["transfers"], list):
+            raise APIError("transfers not submitted in body", 400)
+
+        transfers = []
+        for transfer in content["transfers"]:
+            for key in ("from_account_id", "to_account_id", "amount"):
+                if not isinstance(transfer, dict) or key not in transfer:
+                    raise APIError(f"{key} not submitted for every transfer in batch", 400)
+            transfers.append(TransferRequest(transfer["from_account_id"], transfer["to_account_id"], transfer["amount"]))
+
+        accounts = await self.__account_collection.transfer_many(request.user_id, transfers)
+        logger.info("Successfully applied a batch of transfers. user_id=%s, transfer_count=%s", request.user_id, len(transfers))
+        return json_response({"accounts": accounts})
+
+def accounts_etag(accounts) -> str:
+    """ The same ETag app.py gives a list of accounts """
+    digest = hashlib.blake2b(digest_size=16)
+    for account in accounts:
+        digest.update(f"{account.id}.{account.version};".encode("ascii"))
+    return digest.hexdigest()
+
+def create_app(config: dict = None) -> AccountsApp:
+    """ Builds the ASGI app. Without config, it reads config.json and sets up logging the same way app.py does """
+    if config is None:
+        dictConfig(logging_config("ext://sys.stderr"))
+        with open("config.json", encoding="utf-8") as config_file:
+            config = json.load(config_file)
+        REGISTRY.gauge("audit_queue_depth", "Audit records waiting to be written to file.", logging.getLogger("audit").handlers[0].queue_depth)
+    if config.get("METRICS_DIR"):
+        REGISTRY.share_through(config["METRICS_DIR"])
+
+    password_hasher = PasswordHasher(max_workers=bcrypt_workers(config),
+                                     max_pending=config.get("BCRYPT_MAX_PENDING"),
+                                     verification_cache_ttl=config.get("AUTH_CACHE_TTL_SECONDS", 0))
+    user_store, account_store, idempotency_store, transaction_store = create_stores(config)
+    # Stores that wait on the disk get a pool of ASYNC_STORE_THREADS threads. However many requests are in flight, only that many store calls run at once.
+    executor = None
+    if stores_block_on_io(config):
+        executor = ThreadPoolExecutor(max_workers=config.get("ASYNC_STORE_THREADS", 32), thread_name_prefix="store")
+    return AccountsApp(config,
+                       user_collection=AsyncUserCollection(AsyncUserStoreAdapter(user_store, executor, inline=executor is None), password_hasher),
+                       account_collection=AsyncAccountCollection(AsyncAccountStoreAdapter(account_store, executor, inline=executor is None),
+                                                                 transaction_store=AsyncTransactionStoreAdapter(transaction_store, executor, inline=executor is None)),
+                       idempotent_requests=AsyncIdempotentRequests(idempotency_store, executor),
+                       password_hasher=password_hasher,
+                       executor=executor)
@@ -0,0 +1,258 @@
+""" This module implements the AsyncAccountCollection class, the asyncio counterpart of AccountCollection """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import replace
+import logging
+import zlib
+
+from account_store import Account, UserSummary, AccountStoreCreateError, AccountStoreGetError, AccountStoreUpdateError, AccountStoreConflictError
+from async_account_store import AsyncAccountStore
+from async_transaction_store import AsyncTransactionStore, AsyncTransactionStoreAdapter
+from in_memory_transaction_store import InMemoryTransactionStore
+from transaction_store import Transaction, TransactionStoreError
+from account_collection import (AccountCollection, AccountLookupError, AccountListLookupError, AccountCreateError, InvalidInitialBalanceError, InvalidAccountBatchError, AccountNotFoundError,
+                                SelfTransferError, IllegalTransferAmountError, TransferError, TransferConflictError, BatchTransferError, EmptyBatchError, TransferBatchTooLargeError, InvalidBatchTransferError,
+                                InvalidPageLimitError, InvalidCursorError, InvalidTransactionCursorError, TransactionLookupError, TransferRequest,
+                                transaction_time_bound)
+
+class AsyncAccountCollection():
+    """
+    Collection for interacting with accounts from async code. Validates, locks and audits exactly like AccountCollection, and raises the same errors.
+    """
+    max_page_limit = AccountCollection.max_page_limit
+    max_create_batch = AccountCollection.max_create_batch
+    max_transfer_batch = AccountCollection.max_transfer_batch
+    def __init__(self, account_store: AsyncAccountStore, lock_stripes: int = 64, transaction_store: AsyncTransactionStore = None):
+        self.__account_store = account_store
+        self.__transaction_store = transaction_store or AsyncTransactionStoreAdapter(InMemoryTransactionStore(), inline=True)
+        self.root_logger = logging.getLogger("root")
+        self.audit_logger = logging.getLogger("audit")
+        # Same striping as AccountCollection. Waiting on an asyncio lock suspends the request, rather than blocking the thread serving every other request.
+        stripe_count = max(1, lock_stripes)
+        self.__lock_stripes = [asyncio.Lock() for _ in range(stripe_count)]
+        # Stores shared by several processes also lock every stripe across processes, with locks that block. They are waited on in threads of their own:
+        # a stripe's asyncio lock is taken first, so no more than one thread per stripe ever waits, and store calls never queue up behind them.
+        self.__process_locks = account_store.transfer_locks(stripe_count)
+        self.__process_lock_executor = ThreadPoolExecutor(max_workers=stripe_count, thread_name_prefix="transfer-lock") if self.__process_locks else None
+
+    @asynccontextmanager
+    async def __locked_accounts(self, *account_ids: str):
+        # Stripes are always acquired in ascending index order, so two transfers can never wait on each other in a cycle
+        # crc32 rather than hash(), which is salted differently in every process, so that all processes agree on an account's stripe.
+        # str(), as ids come straight from request bodies, and one that isn't a string is left for the lookup to not find
+        stripe_indexes = sorted({zlib.crc32(str(account_id).encode()) % len(self.__lock_stripes) for account_id in account_ids})
+        acquired = []
+        try:
+            for i in stripe_indexes:
+                await self.__lock_stripes[i].acquire()
+                acquired.append(self.__lock_stripes[i])
+                if self.__process_locks:
+                    await self.__acquire_process_lock(self.__process_locks[i])
+                    acquired.append(self.__process_locks[i])
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    async def __acquire_process_lock(self, lock):
+        acquiring = asyncio.get_running_loop().run_in_executor(self.__process_lock_executor, lock.acquire)
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The thread takes the lock all the same, so let it go as soon as it has
+            acquiring.add_done_callback(lambda future: future.cancelled() or future.exception() is not None or lock.release())
+            raise
+
+    async def __internal_get_account(self, account_id, user_id = None) -> Account | None:
+        try:
+            return await self.__account_store.get_account(account_id, user_id)
+        except AccountStoreGetError as e:
+            user_id_str = "" if not user_id else user_id
+            self.root_logger.warning("Unexpected error occurred when trying to perform an account lookup. account_id='%s', user_id='%s", account_id, user_id_str)
+            raise(AccountLookupError(account_id)) from e
+
+    async def __record_transactions(self, transactions: list[Transaction]):
+        try:
+            await self.__transaction_store.add_transactions(transactions)
+        except TransactionStoreError as e:
+            self.root_logger.error("Failed to record transactions. account_ids='%s', e='%s'", ",".join(dict.fromkeys(t.account_id for t in transactions)), e)
+
+    async def create_account(self, user_id: str, initial_balance: int) -> Account:
+        """ Creates a new account for a user """
+        if(not isinstance(initial_balance, int) or initial_balance < 0):
+            raise InvalidInitialBalanceError(initial_balance)
+        try:
+            account = await self.__account_store.create_account(user_id, initial_balance)
+            self.audit_logger.info("Account created. account_id=%s, user_id=%s", account.id, user_id)
+        except AccountStoreCreateError as e:
+            self.root_logger.warning("Unexpected error occurred when trying to create account. e='%s'", e)
+            raise AccountCreateError() from e
+        await self.__record_transactions([Transaction(account.id, None, initial_balance, initial_balance)])
+        return account
+
+    async def create_accounts(self, user_id: str, initial_balances: list[int]) -> list[Account]:
+        """ Creates several accounts for a user all-or-nothing, with a single store operation and a single audit record """
+        if(not isinstance(initial_balances, list) or not 1 <= len(initial_balances) <= self.max_create_batch):
+            raise InvalidAccountBatchError(len(initial_balances) if isinstance(initial_balances, list) else None, self.max_create_batch)
+        for initial_balance in initial_balances:
+            if(not isinstance(initial_balance, int) or initial_balance < 0):
+                raise InvalidInitialBalanceError(initial_balance)
+        try:
+            accounts = await self.__account_store.create_accounts(user_id, initial_balances)
+        except AccountStoreCreateError as e:
+            self.root_logger.warning("Unexpected error occurred when trying to create accounts in bulk. user_id='%s', account_count='%s', e='%s'", user_id, len(initial_balances), e)
+            raise AccountCreateError() from e
+        await self.__record_transactions([Transaction(account.id, None, account.balance, account.balance) for account in accounts])
+        self.audit_logger.info("Accounts created in bulk. user_id=%s, account_count=%s, accounts=%s", user_id, len(accounts),
+                               ";".join(f"{account.id}:{account.balance}" for account in accounts), extra={"account_ids": [account.id for account in accounts]})
+        return accounts
+
+    async def get_user_account(self, user_id: str, account_id: str) -> Account:
+        """Gets a user's account by id """
+        account = await self.__internal_get_account(account_id, user_id)
+        if (not account):
+            self.root_logger.info("Account not found for user. user_id='%s'", user_id)
+            raise AccountNotFoundError(account_id)
+        return account
+
+    async def get_user_accounts(self, user_id: str) -> list[Account]:
+        """Lists all of a user's accounts"""
+        try:
+            return await self.__account_store.get_accounts(user_id)
+        except AccountStoreGetError as e:
+            self.root_logger.warning("Failed to list accounts for user. user_id='%s', e='%s'", user_id, e)
+            raise AccountListLookupError(user_id) from e
+
+    async def get_user_summary(self, user_id: str) -> UserSummary:
+        """Gets a user's account count and total balance, without reading their accounts"""
+        try:
+            return await self.__account_store.get_user_summary(user_id)
+        except AccountStoreGetError as e:
+            self.root_logger.warning("Failed to look up account summary for user. user_id='%s', e='%s'", user_id, e)
+            raise AccountListLookupError(user_id) from e
+
+    async def get_user_accounts_page(self, user_id: str, limit: int, after: str = None) -> list[Account]:
+        """Lists up to limit of a user's accounts, starting after the account with id after. Pass the id of the last account in a page to get the next one"""
+        if(not isinstance(limit, int) or limit < 1 or limit > self.max_page_limit):
+            raise InvalidPageLimitError(limit, self.max_page_limit)
+        try:
+            accounts = await self.__account_store.get_accounts_page(user_id, limit, after)
+        except AccountStoreGetError as e:
+            self.root_logger.warning("Failed to list a page of accounts for user. user_id='%s', e='%s'", user_id, e)
+            raise AccountListLookupError(user_id) from e
+        if accounts is None:
+            raise InvalidCursorError(after)
+        return accounts
+
+    async def iter_user_accounts(self, user_id: str, page_size: int = 500):
+        """Yields all of a user's accounts, fetching them from the store one page at a time"""
+        after = None
+        while True:
+            accounts = await self.get_user_accounts_page(user_id, page_size, after)
+            for account in accounts:
+                yield account
+            if len(accounts) < page_size:
+                return
+            after = accounts[-1].id
+
+    async def get_account_transactions(self, user_id: str, account_id: str, start: str = None, end: str = None, limit: int = 100, after: int = None) -> list[Transaction]:
+        """Lists up to limit of the transactions on a user's account from start up to but not including end, oldest first, starting after the transaction with id after"""
+        if(not isinstance(limit, int) or limit < 1 or limit > self.max_page_limit):
+            raise InvalidPageLimitError(limit, self.max_page_limit)
+        if(after is not None and not isinstance(after, int)):
+            raise InvalidTransactionCursorError(after)
+        start, end = transaction_time_bound("from", start), transaction_time_bound("to", end)
+        await self.get_user_account(user_id, account_id)
+        try:
+            transactions = await self.__transaction_store.get_transactions(account_id, start, end, limit, after)
+        except TransactionStoreError as e:
+            self.root_logger.warning("Failed to look up transactions for account. account_id='%s', e='%s'", account_id, e)
+            raise TransactionLookupError(account_id) from e
+        if transactions is None:
+            raise InvalidTransactionCursorError(after)
+        return transactions
+
+    async def transfer(self, user_id: str, from_account_id: str, to_account_id: str, amount: int) -> Account:
+        """Transfers an amount betweeen two accounts"""
+        if(from_account_id == to_account_id):
+            raise SelfTransferError(from_account_id)
+
+        async with self.__locked_accounts(from_account_id, to_account_id):
+            from_account = await self.get_user_account(user_id, from_account_id)
+
+            if(not isinstance(amount, int) or amount <= 0 or from_account.balance < amount):
+                raise IllegalTransferAmountError(amount, from_account.balance)
+
+            to_account = await self.__internal_get_account(account_id=to_account_id)
+            if(not to_account):
+                raise AccountNotFoundError(to_account_id)
+
+            updated_from_account = replace(from_account, balance=from_account.balance - amount)
+            updated_to_account = replace(to_account, balance=to_account.balance + amount)
+
+            try:
+                await self.__account_store.update_accounts([updated_from_account, updated_to_account])
+            except AccountStoreConflictError as e:
+                self.root_logger.info("Accounts were changed concurrently during a transfer. from_account_id='%s', to_account_id='%s'", from_account_id, to_account_id)
+                raise TransferConflictError(from_account_id) from e
+            except AccountStoreUpdateError as e:
+                self.root_logger.warning("Unexpected error occurred when attempting to update the accounts during a transfer. from_account_id='%s', to_account_id='%s',  e='%s'", from_account_id, to_account_id, e)
+                raise TransferError(from_account_id, to_account_id) from e
+            updated_from_account.version += 1
+            await self.__record_transactions([Transaction(from_account_id, to_account_id, -amount, updated_from_account.balance),
+                                              Transaction(to_account_id, from_account_id, amount, updated_to_account.balance)])
+
+        self.audit_logger.info("Transfered an amount between two accounts. from_account_id=%s, to_account_id=%s, user_id=%s, amount=%s", from_account_id, to_account_id, user_id, amount)
+        return updated_from_account
+
+    async def transfer_many(self, user_id: str, transfers: list[TransferRequest]) -> list[Account]:
+        """Applies a batch of transfers all-or-nothing, in the given order"""
+        if(not transfers):
+            raise EmptyBatchError()
+        if(len(transfers) > self.max_transfer_batch):
+            raise TransferBatchTooLargeError(len(transfers), self.max_transfer_batch)
+
+        for index, transfer in enumerate(transfers):
+            if(not isinstance(transfer.from_account_id, str) or not isinstance(transfer.to_account_id, str) or not isinstance(transfer.amount, int) or transfer.amount <= 0):
+                raise InvalidBatchTransferError(index)
+            if(transfer.from_account_id == transfer.to_account_id):
+                raise SelfTransferError(transfer.from_account_id)
+
+        from_account_ids = {transfer.from_account_id for transfer in transfers}
+        involved_account_ids = from_account_ids | {transfer.to_account_id for transfer in transfers}
+
+        async with self.__locked_accounts(*involved_account_ids):
+            balances: dict[str, Account] = {}
+            for account_id in involved_account_ids:
+                account = await self.__internal_get_account(account_id, user_id if account_id in from_account_ids else None)
+                if(not account):
+                    raise AccountNotFoundError(account_id)
+                balances[account_id] = replace(account)
+
+            transactions = []
+            for transfer in transfers:
+                from_account = balances[transfer.from_account_id]
+                to_account = balances[transfer.to_account_id]
+                if(not isinstance(transfer.amount, int) or transfer.amount <= 0 or from_account.balance < transfer.amount):
+                    raise IllegalTransferAmountError(transfer.amount, from_account.balance)
+                from_account.balance -= transfer.amount
+                to_account.balance += transfer.amount
+                transactions.append(Transaction(transfer.from_account_id, transfer.to_account_id, -transfer.amount, from_account.balance))
+                transactions.append(Transaction(transfer.to_account_id, transfer.from_account_id, transfer.amount, to_account.balance))
+
+            try:
+                await self.__account_store.update_accounts(list(balances.values()))
+            except AccountStoreConflictError as e:
+                self.root_logger.info("Accounts were changed concurrently during a batch of transfers. user_id='%s', transfer_count='%s'", user_id, len(transfers))
+                raise TransferConflictError(transfers[0].from_account_id) from e
+            except AccountStoreUpdateError as e:
+                self.root_logger.warning("Unexpected error occurred when attempting to apply a batch of transfers. user_id='%s', transfer_count='%s', e='%s'", user_id, len(transfers), e)
+                raise BatchTransferError(len(transfers)) from e
+            for account in balances.values():
+                account.version += 1
+            await self.__record_transactions(transactions)
+
+        self.audit_logger.info("Transfered amounts in a batch. user_id=%s, transfer_count=%s, transfers=%s", user_id, len(transfers),
+                               ";".join(f"{t.from_account_id}>{t.to_account_id}:{t.amount}" for t in transfers), extra={"account_ids": sorted(involved_account_ids)})
+        return [balances[account_id] for account_id in dict.fromkeys(t.from_account_id for t in transfers)]
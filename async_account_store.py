@@ -0,0 +1,95 @@
+""" This module defines the abstract AsyncAccountStore class, and an adapter that runs a blocking AccountStore behind it """
+from abc import ABC, abstractmethod
+import asyncio
+from concurrent.futures import Executor
+import functools
+
+from account_store import AccountStore, Account
+
+class AsyncAccountStore(ABC):
+    """ Abstract class, which all async account stores will inherit from. Methods behave like those of AccountStore, and raise the same errors """
+
+    @abstractmethod
+    async def create_account(self, user_id: str, initial_balance: int):
+        """ Abstract method for creating account in store"""
+
+    @abstractmethod
+    async def create_accounts(self, user_id: str, initial_balances: list[int]):
+        """ Abstract method for creating several accounts for a user in store as one operation. Either all accounts are created or none are"""
+
+    @abstractmethod
+    async def update_account(self, account: Account):
+        """ Abstract method for updating an account in store, with the version check of AccountStore.update_account"""
+
+    @abstractmethod
+    async def update_accounts(self, accounts: list[Account]):
+        """ Abstract method for updating several accounts in store as one operation. Either all accounts are updated or none are"""
+
+    @abstractmethod
+    async def get_account(self, account_id: str, user_id: str = None):
+        """ Abstract method for getting account from store"""
+
+    @abstractmethod
+    async def get_accounts(self, user_id: str):
+        """ Abstract method for getting all accounts belonging to a user"""
+
+    @abstractmethod
+    async def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        """ Abstract method for getting up to limit of a user's accounts, in creation order, starting after the account with id after.
+        Returns None if after is not one of the user's accounts"""
+
+    @abstractmethod
+    async def get_user_summary(self, user_id: str):
+        """ Abstract method for getting a user's account count and total balance as a UserSummary"""
+
+    @abstractmethod
+    async def get_user_summaries(self):
+        """ Abstract method for getting the summary of every user with accounts"""
+
+    def transfer_locks(self, count: int) -> list | None:
+        """ Same as AccountStore.transfer_locks. The locks block, so they must be acquired off the event loop """
+        return None
+
+class AsyncAccountStoreAdapter(AsyncAccountStore):
+    """ Runs the calls of a blocking AccountStore in executor, so that the event loop keeps serving other requests while the store waits on the disk.
+    Stores that only touch memory never block for long, so with inline=True their calls are made directly on the event loop instead. """
+
+    def __init__(self, account_store: AccountStore, executor: Executor = None, inline: bool = False):
+        self.__account_store = account_store
+        self.__executor = executor
+        self.__inline = inline
+
+    async def __call(self, method, *args):
+        if self.__inline:
+            return method(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(method, *args))
+
+    async def create_account(self, user_id: str, initial_balance: int):
+        return await self.__call(self.__account_store.create_account, user_id, initial_balance)
+
+    async def create_accounts(self, user_id: str, initial_balances: list[int]):
+        return await self.__call(self.__account_store.create_accounts, user_id, initial_balances)
+
+    async def update_account(self, account: Account):
+        return await self.__call(self.__account_store.update_account, account)
+
+    async def update_accounts(self, accounts: list[Account]):
+        return await self.__call(self.__account_store.update_accounts, accounts)
+
+    async def get_account(self, account_id: str, user_id: str = None):
+        return await self.__call(self.__account_store.get_account, account_id, user_id)
+
+    async def get_accounts(self, user_id: str):
+        return await self.__call(self.__account_store.get_accounts, user_id)
+
+    async def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        return await self.__call(self.__account_store.get_accounts_page, user_id, limit, after)
+
+    async def get_user_summary(self, user_id: str):
+        return await self.__call(self.__account_store.get_user_summary, user_id)
+
+    async def get_user_summaries(self):
+        return await self.__call(self.__account_store.get_user_summaries)
+
+    def transfer_locks(self, count: int):
+        return self.__account_store.transfer_locks(count)
@@ -0,0 +1,60 @@
+""" This module implements the AsyncIdempotentRequests class, the asyncio counterpart of IdempotentRequests """
+import asyncio
+from collections.abc import Awaitable, Callable
+from concurrent.futures import Executor
+import logging
+import time
+from idempotency_store import IdempotencyStore, IdempotencyStoreError, PendingRequest, StoredResponse
+from idempotency import InvalidIdempotencyKeyError, IdempotencyLookupError, IdempotencyTimeoutError, MAX_POLL_INTERVAL, POLL_INTERVAL, check_claim
+
+class AsyncIdempotentRequests():
+    """ The asyncio counterpart of IdempotentRequests. Store calls run in executor, and a retry of an in-flight request
+    polls its claim on the event loop rather than holding a thread. """
+
+    def __init__(self, idempotency_store: IdempotencyStore, executor: Executor = None, wait_timeout: float = 30.0, abandoned_after: float = 5 * 60):
+        self.__idempotency_store = idempotency_store
+        self.__executor = executor
+        self.__wait_timeout = wait_timeout
+        self.__abandoned_after = abandoned_after
+        self.root_logger = logging.getLogger("root")
+
+    async def __claim(self, user_id: str, key: str, fingerprint: str) -> StoredResponse | PendingRequest | None:
+        try:
+            claim = await asyncio.get_running_loop().run_in_executor(self.__executor, self.__idempotency_store.claim, user_id, key, fingerprint)
+        except IdempotencyStoreError as e:
+            self.root_logger.warning("Claiming idempotency key failed. user_id='%s', key='%s', e='%s'", user_id, key, e)
+            raise IdempotencyLookupError(key) from e
+        if claim is not None:
+            check_claim(claim, key, fingerprint, self.__abandoned_after)
+        return claim
+
+    async def run(self, user_id: str, key: str, fingerprint: str, handle: Callable[[], Awaitable[StoredResponse]]) -> tuple[StoredResponse, bool]:
+        """ Awaits handle, unless a response is already stored for the key. Returns the response, and whether it was replayed """
+        if not key or len(key) > 255:
+            raise InvalidIdempotencyKeyError(key)
+
+        deadline = time.monotonic() + self.__wait_timeout
+        poll_interval = POLL_INTERVAL
+        while (claim := await self.__claim(user_id, key, fingerprint)) is not None:
+            if isinstance(claim, StoredResponse):
+                return claim, True
+            if time.monotonic() >= deadline:
+                raise IdempotencyTimeoutError(key)
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+
+        loop = asyncio.get_running_loop()
+        try:
+            response = await handle()
+        except BaseException:
+            try:
+                await loop.run_in_executor(self.__executor, self.__idempotency_store.release, user_id, key)
+            except IdempotencyStoreError as e:
+                self.root_logger.error("Releasing idempotency key failed. user_id='%s', key='%s', e='%s'", user_id, key, e)
+            raise
+        try:
+            await loop.run_in_executor(self.__executor, self.__idempotency_store.put_response, user_id, key, response)
+        except IdempotencyStoreError as e:
+            # The key stays claimed, so a retry won't run the request again
+            self.root_logger.error("Storing response for idempotency key failed. user_id='%s', key='%s', e='%s'", user_id, key, e)
+        return response, False
@@ -0,0 +1,38 @@
+""" This module defines the abstract AsyncTransactionStore class, and an adapter that runs a blocking TransactionStore behind it """
+from abc import ABC, abstractmethod
+import asyncio
+from concurrent.futures import Executor
+import functools
+
+from transaction_store import TransactionStore, Transaction
+
+class AsyncTransactionStore(ABC):
+    """ Abstract class, which all async transaction stores will inherit from. Methods behave like those of TransactionStore, and raise the same errors """
+
+    @abstractmethod
+    async def add_transactions(self, transactions: list[Transaction]):
+        """ Abstract method for recording transactions as one operation. Sets the id and created_at of each of them"""
+
+    @abstractmethod
+    async def get_transactions(self, account_id: str, start: str | None, end: str | None, limit: int, after: int = None):
+        """ Abstract method for getting up to limit of an account's transactions with start <= created_at < end, oldest first,
+        starting after the transaction with id after. Returns None if after is not one of the account's transactions"""
+
+class AsyncTransactionStoreAdapter(AsyncTransactionStore):
+    """ Runs the calls of a blocking TransactionStore in executor, or directly on the event loop with inline=True, like AsyncAccountStoreAdapter """
+
+    def __init__(self, transaction_store: TransactionStore, executor: Executor = None, inline: bool = False):
+        self.__transaction_store = transaction_store
+        self.__executor = executor
+        self.__inline = inline
+
+    async def __call(self, method, *args):
+        if self.__inline:
+            return method(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(method, *args))
+
+    async def add_transactions(self, transactions: list[Transaction]):
+        return await self.__call(self.__transaction_store.add_transactions, transactions)
+
+    async def get_transactions(self, account_id: str, start: str | None, end: str | None, limit: int, after: int = None):
+        return await self.__call(self.__transaction_store.get_transactions, account_id, start, end, limit, after)
@@ -0,0 +1,78 @@
+"""This module implements the AsyncUserCollection class, the asyncio counterpart of UserCollection"""
+import secrets
+import base64
+import logging
+from password_hasher import PasswordHasher
+from async_user_store import AsyncUserStore
+from user_store import UserStoreGetError, UserStoreCreateError, StoredUser
+from user_collection import User, InvalidUsernameError, UserAlreadyExistsError, UserNotFoundError, AuthenticationError, UserLookupError, UserCreateError
+
+class AsyncUserCollection():
+    """ Collection containing all the logic for working with users from async code. Behaves like UserCollection, and raises the same errors.
+    bcrypt runs outside the event loop, so a login only suspends its own request while the password is checked. """
+    def __init__(self, user_store: AsyncUserStore, password_hasher: PasswordHasher = None):
+        self.__user_store = user_store
+        self.__password_hasher = password_hasher or PasswordHasher()
+        self.root_logger = logging.getLogger("root")
+        self.audit_logger = logging.getLogger("audit")
+
+    def __obscure_user(self, stored_user: StoredUser)  -> User:
+        return User(stored_user.id, stored_user.username)
+
+    def __is_valid_username(self, username: str) -> bool:
+        return username.isalnum() and len(username) <= 20
+
+    async def __internal_get_user(self, username: str) -> StoredUser | None:
+        if(not self.__is_valid_username(username)):
+            raise InvalidUsernameError(username)
+
+        try:
+            user = await self.__user_store.get_user(username)
+        except UserStoreGetError as e:
+            self.root_logger.warning("Fetching user from store failed. username='%s' e='%s'", username, e)
+            raise UserLookupError(username) from e
+
+        return user
+
+    async def create_user(self, username: str) -> tuple[User, str]:
+        """ Create a new user with username and generate a password for them """
+        if await self.__internal_get_user(username):
+            raise UserAlreadyExistsError(username)
+
+        pwd_bytes = secrets.token_bytes(16)
+        pwd_base64 = base64.urlsafe_b64encode(pwd_bytes).decode("ascii")
+
+        hashed_pwd = await self.__password_hasher.hash_async(pwd_bytes)
+
+        try:
+            new_user = await self.__user_store.create_user_if_absent(username,  base64.urlsafe_b64encode(hashed_pwd).decode('ascii'))
+        except UserStoreCreateError as e:
+            self.root_logger.warning("Creating user in store failed. username='%s' e='%s'", username, e)
+            raise UserCreateError(username) from e
+        if not new_user:
+            raise UserAlreadyExistsError(username)
+        self.audit_logger.info("New User created. username=%s, user_id=%s", new_user.username, new_user.id)
+
+        return (self.__obscure_user(new_user), pwd_base64)
+
+    async def get_user(self, username: str) -> User:
+        """ Gets user by username """
+        user = await self.__internal_get_user(username)
+        if not user:
+            self.root_logger.info("User with given name not found. username=%s", username)
+            raise UserNotFoundError(username)
+
+        return self.__obscure_user(user)
+
+    async def authenticate(self, username: str, pwd: str) -> User:
+        """ Check if user can authenticate with password. Throws an error if user cannot be authenticated """
+        user = await self.__internal_get_user(username)
+        if not user:
+            self.root_logger.info("User with given name not found. username=%s", username)
+            raise UserNotFoundError(username)
+
+        if not await self.__password_hasher.check_async(base64.urlsafe_b64decode(pwd.encode('ascii')),  base64.urlsafe_b64decode(user.hashed_pwd)):
+            self.root_logger.info("User failed to authenticate. username=%s", username)
+            raise AuthenticationError(username)
+
+        return self.__obscure_user(user)
@@ -0,0 +1,44 @@
+""" This module defines the abstract AsyncUserStore class, and an adapter that runs a blocking UserStore behind it """
+from abc import ABC, abstractmethod
+import asyncio
+from concurrent.futures import Executor
+import functools
+
+from user_store import UserStore
+
+class AsyncUserStore(ABC):
+    """ Abstract class, which all async user stores will inherit from. Methods behave like those of UserStore, and raise the same errors """
+
+    @abstractmethod
+    async def create_user(self, username: str, hashed_pwd: bytes):
+        """ Abstract method for creating user in store"""
+
+    @abstractmethod
+    async def create_user_if_absent(self, username: str, hashed_pwd: bytes):
+        """ Abstract method for atomically creating a user in store, unless the username is already taken. Returns None if it is taken"""
+
+    @abstractmethod
+    async def get_user(self, username: str):
+        """ Abstract method for getting user from store"""
+
+class AsyncUserStoreAdapter(AsyncUserStore):
+    """ Runs the calls of a blocking UserStore in executor, or directly on the event loop with inline=True. See AsyncAccountStoreAdapter """
+
+    def __init__(self, user_store: UserStore, executor: Executor = None, inline: bool = False):
+        self.__user_store = user_store
+        self.__executor = executor
+        self.__inline = inline
+
+    async def __call(self, method, *args):
+        if self.__inline:
+            return method(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(method, *args))
+
+    async def create_user(self, username: str, hashed_pwd: bytes):
+        return await self.__call(self.__user_store.create_user, username, hashed_pwd)
+
+    async def create_user_if_absent(self, username: str, hashed_pwd: bytes):
+        return await self.__call(self.__user_store.create_user_if_absent, username, hashed_pwd)
+
+    async def get_user(self, username: str):
+        return await self.__call(self.__user_store.get_user, username)
@@ -0,0 +1,275 @@
+""" This module implements the sidecar index of the audit log, which finds the records touching an account or a user without reading the whole log.
+Every segment of the log (audit.log, audit.log.1, ...) has its own index next to it (audit.log.idx, audit.log.1.idx, ...), which travels with it on rotation """
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import zlib
+
+INDEX_SUFFIX = ".idx"
+COMPRESSED_SUFFIX = ".gz"
+# Every file that makes up a segment, and has to be moved or removed with it
+SEGMENT_SUFFIXES = ("", COMPRESSED_SUFFIX, INDEX_SUFFIX)
+# Compressed segments are made of gzip members of about this many bytes, so a search only decompresses the members holding its records
+CHUNK_BYTES = 64 * 1024
+
+_ACCOUNT_FIELDS = ("account_id", "from_account_id", "to_account_id")
+
+# Keys are stored as 64-bit hashes, which keeps the index a fraction of the size of the segment. Searches seek straight to the first record of the
+# account or user at or after a time, and read on in order of time from there
+_CREATE_RECORDS = """
+CREATE TABLE IF NOT EXISTS records (
+    key INTEGER NOT NULL,
+    time REAL NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (key, time, offset)
+) WITHOUT ROWID"""
+# Where each gzip member of a compressed segment starts, in the segment as written and in the compressed file
+_CREATE_CHUNKS = "CREATE TABLE IF NOT EXISTS chunks (offset INTEGER PRIMARY KEY, compressed_offset INTEGER NOT NULL)"
+# How much of the segment has been indexed, so that an index left behind by a crash can catch up
+_CREATE_PROGRESS = "CREATE TABLE IF NOT EXISTS progress (id INTEGER PRIMARY KEY CHECK (id = 0), indexed_bytes INTEGER NOT NULL)"
+_INSERT_RECORD = "INSERT INTO records (key, time, offset, length) VALUES (?, ?, ?, ?)"
+_UPDATE_PROGRESS = "INSERT OR REPLACE INTO progress (id, indexed_bytes) VALUES (0, ?)"
+_SELECT_PROGRESS = "SELECT indexed_bytes FROM progress WHERE id = 0"
+
+def record_keys(record: dict) -> set[str]:
+    """ The index keys of a structured audit record: account:<id> for every account it touches, and user:<id> for the user behind it """
+    keys = {f"account:{record[name]}" for name in _ACCOUNT_FIELDS if record.get(name) is not None}
+    keys.update(f"account:{account_id}" for account_id in record.get("account_ids") or ())
+    if record.get("user_id") is not None:
+        keys.add(f"user:{record['user_id']}")
+    return keys
+
+def _key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+def _index_entries(data: bytes, offset: int) -> Iterator[tuple[int, float, int, int]]:
+    """ Yields (key, time, offset, length) for the records in data, whole lines found at offset in the segment.
+    Lines that aren't structured records, e.g. those written before the log was structured, are skipped """
+    for line in data.splitlines(keepends=True):
+        try:
+            record = json.loads(line)
+            time = datetime.fromisoformat(record["time"]).timestamp()
+            keys = record_keys(record)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            keys = ()
+        for key in keys:
+            yield _key_hash(key), time, offset, len(line)
+        offset += len(line)
+
+class AuditIndex():
+    """ The index of one segment of the audit log, kept in a SQLite database next to it.
+    It only holds what can be read back from the segment, so it doesn't fsync, and can be rebuilt with audit_search.py reindex """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.__connection.execute("PRAGMA synchronous = OFF")
+        for statement in (_CREATE_RECORDS, _CREATE_CHUNKS, _CREATE_PROGRESS):
+            self.__connection.execute(statement)
+
+    def close(self):
+        self.__connection.close()
+
+    def indexed_bytes(self) -> int:
+        row = self.__connection.execute(_SELECT_PROGRESS).fetchone()
+        return row[0] if row else 0
+
+    def add(self, data: bytes, offset: int):
+        """ Indexes data, whole lines that were written at offset in the segment """
+        with self.__transaction():
+            self.__connection.executemany(_INSERT_RECORD, _index_entries(data, offset))
+            self.__connection.execute(_UPDATE_PROGRESS, (offset + len(data),))
+
+    def catch_up(self, segment_path: str):
+        """ Indexes whatever complete lines of a plain segment haven't been indexed yet """
+        indexed_bytes = self.indexed_bytes()
+        with open(segment_path, "rb") as segment:
+            segment.seek(indexed_bytes)
+            data = segment.read()
+        # A line without its newline is still being written
+        data = data[:data.rfind(b"\n") + 1]
+        if data:
+            self.add(data, indexed_bytes)
+
+    def find(self, keys: list[str], since: float = None, until: float = None) -> list[tuple[int, int]]:
+        """ Returns (offset, length) of the records with any of the keys from since up to until, in the order they were written.
+        Keys are found by their hash, so on the rare collision there are records among them that don't have any of the keys """
+        placeholders = ", ".join("?" * len(keys))
+        rows = self.__connection.execute(f"SELECT DISTINCT offset, length FROM records WHERE key IN ({placeholders}) AND time >= ? AND time < ? ORDER BY offset",
+                                         (*map(_key_hash, keys), float("-inf") if since is None else since, float("inf") if until is None else until))
+        return rows.fetchall()
+
+    def chunks(self) -> list[tuple[int, int]]:
+        """ Returns (offset, compressed_offset) of every gzip member of the compressed segment, in order """
+        return self.__connection.execute("SELECT offset, compressed_offset FROM chunks ORDER BY offset").fetchall()
+
+    def set_chunks(self, chunks: list[tuple[int, int]]):
+        with self.__transaction():
+            self.__connection.execute("DELETE FROM chunks")
+            self.__connection.executemany("INSERT INTO chunks (offset, compressed_offset) VALUES (?, ?)", chunks)
+
+    @contextmanager
+    def __transaction(self):
+        self.__connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.__connection.execute("ROLLBACK")
+            raise
+        self.__connection.execute("COMMIT")
+
+@contextmanager
+def segment_lock(filename: str):
+    """ Keeps the segments of the log at filename from being written, rotated, compressed and looked up at the same time, also across processes """
+    with open(f"{filename}.lock", "a", encoding="utf-8") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def segments(filename: str) -> list[str]:
+    """ Returns the segments of the log at filename, oldest first, each by its path without the .gz of a compressed segment """
+    directory, base = os.path.split(os.path.abspath(filename))
+    pattern = re.compile(re.escape(base) + r"\.(\d+)(?:\.gz)?")
+    numbers = {int(match.group(1)) for name in os.listdir(directory) if (match := pattern.fullmatch(name))}
+    rotated = [os.path.join(directory, f"{base}.{number}") for number in sorted(numbers, reverse=True)]
+    return rotated + [os.path.join(directory, base)] if os.path.exists(os.path.join(directory, base)) else rotated
+
+def is_compressed(segment: str) -> bool:
+    # A segment that was compressed but not yet removed is still read from the plain file
+    return not os.path.exists(segment) and os.path.exists(segment + COMPRESSED_SUFFIX)
+
+def _members(compressed_path: str) -> Iterator[tuple[int, bytes]]:
+    """ Yields (compressed_offset, data) for every gzip member of a compressed segment """
+    with open(compressed_path, "rb") as compressed:
+        raw = compressed.read()
+    position = 0
+    while position < len(raw):
+        decompressor = zlib.decompressobj(wbits=31)
+        data = decompressor.decompress(raw[position:])
+        yield position, data
+        position = len(raw) - len(decompressor.unused_data)
+
+def _read_member(compressed, compressed_offset: int) -> bytes:
+    compressed.seek(compressed_offset)
+    decompressor = zlib.decompressobj(wbits=31)
+    data = b""
+    while not decompressor.eof:
+        block = compressed.read(CHUNK_BYTES)
+        if not block:
+            raise ValueError(f"Truncated gzip member at {compressed_offset} in {compressed.name}")
+        data += decompressor.decompress(block)
+    return data
+
+def read_records(segment_file, chunks: list[tuple[int, int]] | None, locations: list[tuple[int, int]]) -> Iterator[bytes]:
+    """ Yields the records at locations, (offset, length) in the order they were written, seeking straight to each of them in segment_file, an open segment.
+    A compressed segment comes with the chunks of its index, and only the gzip members holding the records are decompressed """
+    if chunks is None:
+        for offset, length in locations:
+            segment_file.seek(offset)
+            yield segment_file.read(length)
+        return
+    current = -1
+    for offset, length in locations:
+        if current + 1 < len(chunks) and chunks[current + 1][0] <= offset:
+            # Locations are in order, so the member holding this one is at or after the current one
+            while current + 1 < len(chunks) and chunks[current + 1][0] <= offset:
+                current += 1
+            data = _read_member(segment_file, chunks[current][1])
+        elif current < 0:
+            # The first member always starts at 0, so the index doesn't know the members of this segment at all
+            raise ValueError(f"The index doesn't know where the gzip members of {segment_file.name} start. Rebuild it with audit_search.py reindex --all")
+        start = offset - chunks[current][0]
+        yield data[start:start + length]
+
+def _resolve(segment: str, keys: list[str], since: float | None, until: float | None) -> tuple[object, list[tuple[int, int]] | None, list[tuple[int, int]]]:
+    """ Opens a segment and finds the locations of its records with any of the keys, returning (segment file, chunks if compressed, locations) """
+    index = AuditIndex(segment + INDEX_SUFFIX)
+    try:
+        locations = index.find(keys, since, until)
+        if is_compressed(segment):
+            return open(segment + COMPRESSED_SUFFIX, "rb"), index.chunks(), locations
+        return open(segment, "rb"), None, locations
+    finally:
+        index.close()
+
+def compress_segment(segment: str, chunk_bytes: int = CHUNK_BYTES):
+    """ Compresses a rotated segment into segment.gz, made of gzip members of whole records that can each be decompressed on their own.
+    The result is still an ordinary gzip file to zcat and friends. The plain segment is only removed once the index knows where every member starts """
+    index = AuditIndex(segment + INDEX_SUFFIX)
+    try:
+        # Anything the index is missing can't be read back from the compressed segment without decompressing all of it
+        index.catch_up(segment)
+        chunks = []
+        temporary_path = segment + COMPRESSED_SUFFIX + ".tmp"
+        with open(segment, "rb") as plain, open(temporary_path, "wb") as compressed:
+            offset = 0
+            while data := plain.read(chunk_bytes):
+                # Read on to the end of the line, so that no record is split across members
+                if not data.endswith(b"\n"):
+                    data += plain.readline()
+                chunks.append((offset, compressed.tell()))
+                compressed.write(gzip.compress(data, mtime=0))
+                offset += len(data)
+            compressed.flush()
+            os.fsync(compressed.fileno())
+        index.set_chunks(chunks)
+        os.replace(temporary_path, segment + COMPRESSED_SUFFIX)
+        os.remove(segment)
+    finally:
+        index.close()
+
+def reindex_segment(segment: str):
+    """ Builds the index of a segment from scratch, including where the members of a compressed segment start """
+    index_path = segment + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    index = AuditIndex(index_path)
+    try:
+        if is_compressed(segment):
+            chunks = []
+            offset = 0
+            for compressed_offset, data in _members(segment + COMPRESSED_SUFFIX):
+                chunks.append((offset, compressed_offset))
+                index.add(data, offset)
+                offset += len(data)
+            index.set_chunks(chunks)
+        else:
+            index.catch_up(segment)
+    finally:
+        index.close()
+
+def search(filename: str, account_ids: list[str] = (), user_ids: list[str] = (), since: float = None, until: float = None) -> Iterator[dict]:
+    """ Yields the records of the log at filename that touch any of the accounts or users, from since up to until (as POSIX timestamps), oldest segment first.
+    Segments without an index are skipped, see unindexed_segments().
+    Every segment is opened and looked up in its index under the segment lock, so that rotation and compression can't move one from under another.
+    The records are read after the lock is let go, from the files as they were opened """
+    keys = [f"account:{account_id}" for account_id in account_ids] + [f"user:{user_id}" for user_id in user_ids]
+    if not keys:
+        return
+    resolved = []
+    try:
+        with segment_lock(filename):
+            for segment in segments(filename):
+                if os.path.exists(segment + INDEX_SUFFIX):
+                    resolved.append(_resolve(segment, keys, since, until))
+        for segment_file, chunks, locations in resolved:
+            for line in read_records(segment_file, chunks, locations):
+                record = json.loads(line)
+                if record_keys(record).intersection(keys):
+                    yield record
+    finally:
+        for segment_file, _, _ in resolved:
+            segment_file.close()
+
+def unindexed_segments(filename: str) -> list[str]:
+    return [segment for segment in segments(filename) if not os.path.exists(segment + INDEX_SUFFIX)]
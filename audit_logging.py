@@ -0,0 +1,205 @@
+""" This module implements a logging handler that writes audit records to file from a background thread, and the formatter that structures them """
+from datetime import datetime, timezone
+import functools
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import weakref
+
+class BatchingAuditHandler(logging.Handler):
+    """ Handler that only puts formatted records on a queue, leaving all disk I/O to a background writer thread.
+    The writer writes records in batches of up to `batchSize`, or whatever has arrived after `flushInterval` seconds, and rotates the file like RotatingFileHandler.
+    With `fsync` set, every batch is fsynced before the writer moves on. Records still queued are written when the handler is closed, which logging does at interpreter exit.
+    A process forked from one with a handler (e.g. a gunicorn worker of a preloading master) starts a writer of its own, as threads don't survive a fork.
+    With `index` set, the writer also adds every batch to the sidecar index of the file (see audit_index.py), and rotation moves the index along with the file.
+    Several processes may write the same file, e.g. the workers of one gunicorn: every batch is written, indexed and rotated under the segment lock,
+    at the end of the file as it is at that moment, and a writer whose file was rotated by another process moves on to the new one."""
+
+    def __init__(self, filename: str, maxBytes: int = 0, backupCount: int = 0, batchSize: int = 512, flushInterval: float = 0.05, fsync: bool = False,
+                 index: bool = False):
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = maxBytes
+        self.backup_count = backupCount
+        self.batch_size = batchSize
+        self.flush_interval = flushInterval
+        self.fsync = fsync
+        self.index = index
+        # Binary, so that the offsets the index records are byte offsets
+        self.__stream = open(self.filename, "ab")
+        self.__start_writer()
+        handler = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: handler() and handler().__start_writer_after_fork())
+
+    def __start_writer(self):
+        # The index connection belongs to the writer thread that opened it, so a new writer opens its own
+        self.__index = None
+        self.__queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.__writer = threading.Thread(target=self.__write_loop, name="audit-writer", daemon=True)
+        self.__writer.start()
+
+    def __start_writer_after_fork(self):
+        # Records queued before the fork are the parent's to write
+        if not self.__stream.closed:
+            self.__start_writer()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.__queue.put(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+    def queue_depth(self) -> int:
+        """ The number of records waiting to be written """
+        return self.__queue.qsize()
+
+    def flush(self):
+        """ Blocks until every record emitted before the call has been written """
+        if not self.__writer.is_alive():
+            return
+        written = threading.Event()
+        self.__queue.put(written)
+        written.wait()
+
+    def close(self):
+        if self.__writer.is_alive():
+            self.__queue.put(None)
+            self.__writer.join()
+        self.__stream.close()
+        super().close()
+
+    def __write_loop(self):
+        while True:
+            item = self.__queue.get()
+            batch: list[str] = []
+            events: list[threading.Event] = []
+            stop = False
+            # Keep collecting until the batch is full, or the flush interval has passed since its first record
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                if isinstance(item, threading.Event):
+                    # Someone is waiting in flush(), so write what we have right away
+                    events.append(item)
+                    break
+                else:
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                try:
+                    item = self.__queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self.__write_batch("".join(batch).encode("utf-8"))
+            for event in events:
+                event.set()
+            if stop:
+                self.__close_index()
+                return
+
+    def __write_batch(self, data: bytes):
+        # Imported here, on the writer thread, to keep sqlite3 out of the service's startup
+        from audit_index import segment_lock
+        try:
+            with segment_lock(self.filename):
+                self.__write_locked(data)
+        except Exception:
+            # The records are gone at this point, but a broken audit file must not take the writer thread down with it
+            logging.getLogger("root").exception("Writing audit records failed. filename='%s'", self.filename)
+
+    def __write_locked(self, data: bytes):
+        if self.__rotated_elsewhere():
+            self.__stream.close()
+            self.__close_index()
+            self.__stream = open(self.filename, "ab")
+        # Where this process last wrote is no longer the end of the file once another one has written to it
+        offset = self.__stream.seek(0, os.SEEK_END)
+        if self.max_bytes > 0 and offset + len(data) > self.max_bytes and offset > 0:
+            self.__rollover()
+            offset = 0
+        self.__open_index()
+        self.__stream.write(data)
+        self.__stream.flush()
+        if self.fsync:
+            os.fsync(self.__stream.fileno())
+        if self.__index is not None:
+            try:
+                self.__index.add(data, offset)
+            except Exception:
+                # The records are safe in the file, and the index catches up with it the next time it is opened
+                logging.getLogger("root").exception("Indexing audit records failed. filename='%s'", self.filename)
+                self.__close_index()
+
+    def __rotated_elsewhere(self) -> bool:
+        try:
+            return os.stat(self.filename).st_ino != os.fstat(self.__stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def __open_index(self):
+        if not self.index or self.__index is not None:
+            return
+        from audit_index import AuditIndex, INDEX_SUFFIX
+        try:
+            index = AuditIndex(self.filename + INDEX_SUFFIX)
+            index.catch_up(self.filename)
+        except Exception:
+            logging.getLogger("root").exception("Opening the audit index failed. filename='%s'", self.filename)
+            return
+        self.__index = index
+
+    def __close_index(self):
+        if self.__index is not None:
+            self.__index.close()
+            self.__index = None
+
+    def __rollover(self):
+        """ Called with the segment lock held """
+        from audit_index import SEGMENT_SUFFIXES
+        self.__stream.close()
+        self.__close_index()
+        # Every file of a segment, i.e. its compressed form and its index, moves along with it
+        if self.backup_count > 0:
+            for suffix in SEGMENT_SUFFIXES:
+                if os.path.exists(f"{self.filename}.{self.backup_count}{suffix}"):
+                    os.remove(f"{self.filename}.{self.backup_count}{suffix}")
+        for i in range(self.backup_count - 1, 0, -1):
+            for suffix in SEGMENT_SUFFIXES:
+                source = f"{self.filename}.{i}{suffix}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.filename}.{i + 1}{suffix}")
+        for suffix in SEGMENT_SUFFIXES:
+            if os.path.exists(self.filename + suffix):
+                if self.backup_count > 0:
+                    os.replace(self.filename + suffix, f"{self.filename}.1{suffix}")
+                else:
+                    os.remove(self.filename + suffix)
+        self.__stream = open(self.filename, "ab")
+
+# A %s of the message, with the name in front of it if there is one, e.g. account_id=%s
+_PLACEHOLDER = re.compile(r"(?:(\w+)=)?%[sdr]")
+
+@functools.lru_cache(maxsize=256)
+def _field_names(msg: str) -> tuple[str | None, ...]:
+    return tuple(match.group(1) for match in _PLACEHOLDER.finditer(msg))
+
+class AuditFormatter(logging.Formatter):
+    """ Formats audit records as JSON lines, which the audit index and audit_search.py can read.
+    Besides the time and the message, a record holds every name=%s of its message as a field of its own, plus the account_ids passed as extra, if any """
+
+    def format(self, record: logging.LogRecord) -> str:
+        # In UTC, which reads the same on every machine and across changes to daylight saving time
+        structured = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"), "message": record.getMessage()}
+        if isinstance(record.args, tuple):
+            structured.update((name, value) for name, value in zip(_field_names(str(record.msg)), record.args) if name)
+        account_ids = getattr(record, "account_ids", None)
+        if account_ids is not None:
+            structured["account_ids"] = list(account_ids)
+        return json.dumps(structured, default=str)
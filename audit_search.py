@@ -0,0 +1,66 @@
+""" Searches the audit log through its index, and compresses its rotated segments.
+
+    python audit_search.py search [--log audit.log] [--account ID ...] [--user ID ...] [--since 2026-01-01] [--until 2026-02-01T12:00]
+    python audit_search.py compress [--log audit.log]
+    python audit_search.py reindex [--log audit.log]
+
+search prints every record touching any of the accounts or users from --since up to --until, one JSON line each and oldest first.
+Times without a UTC offset are in UTC, like the times in the records. Only the index of each segment and the records it points to are read,
+also in compressed segments. compress gzips the rotated segments, which stay searchable. reindex builds the index of segments that have none,
+e.g. those written before the log was indexed, and --all rebuilds every rotated segment's index.
+Safe to run next to a running service, even one with several worker processes: every command works under the lock the service rotates the log under.
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import sys
+from audit_index import INDEX_SUFFIX, compress_segment, is_compressed, reindex_segment, search, segment_lock, segments, unindexed_segments
+
+def timestamp(value: str) -> float:
+    time = datetime.fromisoformat(value)
+    return (time if time.tzinfo else time.replace(tzinfo=timezone.utc)).timestamp()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    search_parser = commands.add_parser("search")
+    search_parser.add_argument("--account", action="append", default=[], help="an account id, can be given more than once")
+    search_parser.add_argument("--user", action="append", default=[], help="a user id, can be given more than once")
+    search_parser.add_argument("--since", type=timestamp, help="an ISO 8601 date or time")
+    search_parser.add_argument("--until", type=timestamp, help="an ISO 8601 date or time, exclusive")
+    compress_parser = commands.add_parser("compress")
+    reindex_parser = commands.add_parser("reindex")
+    reindex_parser.add_argument("--all", action="store_true", help="also rebuild the indexes of rotated segments that have one")
+    for command_parser in (search_parser, compress_parser, reindex_parser):
+        command_parser.add_argument("--log", default="audit.log", help="the audit log file the service writes to")
+    args = parser.parse_args()
+
+    # The segment being written to is indexed by the service itself
+    rotated = segments(args.log)[:-1] if os.path.exists(args.log) else segments(args.log)
+    if args.command == "search":
+        if not (args.account or args.user):
+            parser.error("search needs at least one --account or --user")
+        for segment in unindexed_segments(args.log):
+            print(f"Not searched, as it has no index. Run reindex first. segment='{segment}'", file=sys.stderr)
+        count = 0
+        for count, record in enumerate(search(args.log, args.account, args.user, args.since, args.until), 1):
+            print(json.dumps(record))
+        print(f"{count} records", file=sys.stderr)
+    elif args.command == "compress":
+        for segment in rotated:
+            # Rotation renames segments, so it has to wait until this one is done
+            with segment_lock(args.log):
+                if os.path.exists(segment):
+                    compress_segment(segment)
+                    print(f"Compressed. segment='{segment}'", file=sys.stderr)
+    else:
+        for segment in rotated:
+            with segment_lock(args.log):
+                if (args.all or not os.path.exists(segment + INDEX_SUFFIX)) and (os.path.exists(segment) or is_compressed(segment)):
+                    reindex_segment(segment)
+                    print(f"Indexed. segment='{segment}'", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+""" Benchmarks for the account service. Run them from the repository root with `python -m benchmarks.<name>` """
@@ -0,0 +1,60 @@
+""" Measures GET /accounts for a user with 10k accounts, serialized by Flask's own JSON provider and by FastJSONProvider.
+
+    python -m benchmarks.json_encoding [--accounts 10000] [--requests 20]
+
+FastJSONProvider is measured twice, once with the json module and the compiled encoders, and once with orjson if it is installed.
+The app runs on the in-memory stores, so it doesn't need a config.json.
+"""
+import argparse
+import logging
+import statistics
+import time
+import uuid
+from flask.json.provider import DefaultJSONProvider
+from flask_jwt_extended import create_access_token
+import json_encoding
+from app import create_app
+
+def time_requests(client, headers: dict, count: int) -> float:
+    """ Returns the median time per request in milliseconds """
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = client.get("/accounts", headers=headers)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+
+    # Every request logs at INFO
+    logging.disable(logging.INFO)
+    app = create_app({"JWT_SECRET_KEY": uuid.uuid4().hex * 2, "JWT_TOKEN_LOCATION": ["headers"]})
+    user_id = str(uuid.uuid4())
+    app.extensions["services"].account_collection.create_accounts(user_id, list(range(args.accounts)))
+    with app.app_context():
+        headers = {"Authorization": f"Bearer {create_access_token(identity=user_id)}"}
+    client = app.test_client()
+
+    fast_provider = app.json
+    orjson = json_encoding.orjson
+    results = {}
+    app.json = DefaultJSONProvider(app)
+    results["Flask's DefaultJSONProvider"] = time_requests(client, headers, args.requests)
+    app.json = fast_provider
+    json_encoding.orjson = None
+    results["FastJSONProvider, json"] = time_requests(client, headers, args.requests)
+    json_encoding.orjson = orjson
+    if orjson is not None:
+        results["FastJSONProvider, orjson"] = time_requests(client, headers, args.requests)
+
+    baseline = results["Flask's DefaultJSONProvider"]
+    for name, median in results.items():
+        print(f"{name + ':':30} {median:7.1f} ms per request ({baseline / median:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+""" Measures what the verified-token cache saves per request on GET /accounts/<account_id>.
+
+    python -m benchmarks.jwt_cache [--requests 5000]
+
+Builds a small app with the same route twice, once behind jwt_required() and once behind cached_jwt_required(),
+so it doesn't need a config.json.
+"""
+import argparse
+import time
+import uuid
+from flask import Flask, jsonify
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, jwt_required
+from account_collection import AccountCollection
+from in_memory_account_store import InMemoryAccountStore
+from jwt_cache import VerifiedTokenCache, cached_jwt_required
+
+def build_app():
+    app = Flask(__name__)
+    app.config["JWT_SECRET_KEY"] = uuid.uuid4().hex * 2
+    app.config["JWT_TOKEN_LOCATION"] = ["headers"]
+    JWTManager(app)
+    collection = AccountCollection(InMemoryAccountStore())
+
+    def get_account(account_id: str):
+        return jsonify({"account": collection.get_user_account(get_jwt_identity(), account_id)})
+    app.add_url_rule("/uncached/accounts/<account_id>", "uncached", jwt_required()(get_account))
+    app.add_url_rule("/cached/accounts/<account_id>", "cached", cached_jwt_required(VerifiedTokenCache())(get_account))
+    return app, collection
+
+def time_requests(client, url: str, headers: dict, count: int) -> float:
+    """ Returns the mean time per request in microseconds """
+    start = time.perf_counter()
+    for _ in range(count):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    return (time.perf_counter() - start) / count * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    app, collection = build_app()
+    user_id = str(uuid.uuid4())
+    account = collection.create_account(user_id, 100)
+    with app.app_context():
+        headers = {"Authorization": f"Bearer {create_access_token(identity=user_id)}"}
+    client = app.test_client()
+
+    # Warm up both routes, which also puts the token in the cache
+    time_requests(client, f"/uncached/accounts/{account.id}", headers, 100)
+    time_requests(client, f"/cached/accounts/{account.id}", headers, 100)
+    uncached = time_requests(client, f"/uncached/accounts/{account.id}", headers, args.requests)
+    cached = time_requests(client, f"/cached/accounts/{account.id}", headers, args.requests)
+    print(f"jwt_required():        {uncached:.1f} us per request")
+    print(f"cached_jwt_required(): {cached:.1f} us per request")
+    print(f"saved:                 {uncached - cached:.1f} us per request ({(uncached - cached) / uncached:.0%})")
+
+if __name__ == "__main__":
+    main()
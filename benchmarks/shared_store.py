@@ -0,0 +1,54 @@
+""" Measures how transfer throughput on SharedMemoryAccountStore grows with the number of worker processes sharing it.
+
+    python -m benchmarks.shared_store [--processes 1 2 4 8] [--accounts 100000] [--seconds 3]
+
+Every process runs transfers between random accounts of the same store file for the given time, like gunicorn workers behind one port would.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+import uuid
+from account_collection import AccountCollection
+from shared_memory_account_store import SharedMemoryAccountStore
+
+def run_transfers(path: str, accounts: list[tuple[str, str]], seconds: float, seed: int, transfers):
+    collection = AccountCollection(SharedMemoryAccountStore(path))
+    rng = random.Random(seed)
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        (user_id, from_account_id), (_, to_account_id) = rng.choice(accounts), rng.choice(accounts)
+        if from_account_id != to_account_id:
+            collection.transfer(user_id, from_account_id, to_account_id, 1)
+            count += 1
+    with transfers.get_lock():
+        transfers.value += count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, nargs="+", default=sorted({1, 2, 4, os.cpu_count()}))
+    parser.add_argument("--accounts", type=int, default=100000)
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "accounts.shm")
+        collection = AccountCollection(SharedMemoryAccountStore(path, capacity=args.accounts))
+        user_ids = [str(uuid.uuid4()) for _ in range(max(1, args.accounts // 10))]
+        accounts = [(user_id, account.id) for user_id in user_ids for account in collection.create_accounts(user_id, [1000000] * 10)]
+
+        for process_count in args.processes:
+            transfers = context.Value("q", 0)
+            workers = [context.Process(target=run_transfers, args=(path, accounts, args.seconds, seed, transfers)) for seed in range(process_count)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            print(f"{process_count} processes: {transfers.value / args.seconds:,.0f} transfers per second")
+
+if __name__ == "__main__":
+    main()
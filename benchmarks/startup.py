@@ -0,0 +1,83 @@
+""" Measures how long a fresh worker process takes to start serving app.py.
+
+    python -m benchmarks.startup [--runs 20] [--config config.json] [--preload]
+
+Every run starts a new interpreter, like a gunicorn worker or an autoscaled instance would, and times importing app.py, create_app(),
+and the first request, which is the one that builds the stores. Without --config, the app runs on the in-memory stores.
+With --preload, create_app() runs once in this process and every run forks from it instead, the way `gunicorn --preload` starts its workers.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Runs in the new interpreter, and prints its timings as JSON
+_WORKER = """
+import json, logging, sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+logging.disable(logging.WARNING)
+app.test_client().get("/users/nobody")
+served = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "create_app_ms": (created - imported) * 1000, "first_request_ms": (served - created) * 1000}))
+"""
+
+def run_fresh(config: dict) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", _WORKER, json.dumps(config)], check=True, capture_output=True, text=True).stdout
+    timings = json.loads(output)
+    timings["process_ms"] = (time.perf_counter() - started) * 1000
+    return timings
+
+def run_forked(app) -> dict:
+    """ Forks from a process that already built the app, and times the worker's first request """
+    read_end, write_end = os.pipe()
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        forked = time.perf_counter()
+        app.test_client().get("/users/nobody")
+        served = time.perf_counter()
+        os.write(write_end, json.dumps({"fork_ms": (forked - started) * 1000, "first_request_ms": (served - forked) * 1000}).encode())
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        timings = json.loads(pipe.read())
+    os.waitpid(pid, 0)
+    timings["process_ms"] = (time.perf_counter() - started) * 1000
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--config", help="a config.json to start the app with")
+    parser.add_argument("--preload", action="store_true", help="fork every worker from a process that already ran create_app()")
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config, encoding="utf-8") as config_file:
+            config = json.load(config_file)
+    else:
+        config = {"JWT_SECRET_KEY": "startup-benchmark-secret-key-0123456789", "JWT_TOKEN_LOCATION": ["headers"]}
+
+    if args.preload:
+        from app import create_app
+        # The first request is answered with a 404, which would otherwise be logged by every run
+        logging.disable(logging.WARNING)
+        app = create_app(config)
+        runs = [run_forked(app) for _ in range(args.runs)]
+    else:
+        runs = [run_fresh(config) for _ in range(args.runs)]
+    # Medians, as the odd run that gets descheduled would skew a mean
+    print(json.dumps({name: round(statistics.median(run[name] for run in runs), 2) for name in runs[0]}, indent=2))
+
+if __name__ == "__main__":
+    main()
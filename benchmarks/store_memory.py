@@ -0,0 +1,42 @@
+""" Measures how many bytes each account costs in the in-memory account stores.
+
+    python -m benchmarks.store_memory [--accounts 250000] [--accounts-per-user 10]
+"""
+import argparse
+import gc
+import tracemalloc
+import uuid
+from in_memory_account_store import InMemoryAccountStore
+from compact_account_store import CompactAccountStore
+
+STORES = {
+    "InMemoryAccountStore": InMemoryAccountStore,
+    "CompactAccountStore": CompactAccountStore,
+}
+
+def measure(store_class, account_count: int, accounts_per_user: int) -> float:
+    """ Returns the number of bytes allocated per account while filling a new store """
+    user_ids = [str(uuid.uuid4()) for _ in range(max(1, account_count // accounts_per_user))]
+    gc.collect()
+    tracemalloc.start()
+    store = store_class()
+    for i in range(account_count):
+        store.create_account(user_ids[i % len(user_ids)], i)
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    return allocated / account_count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, default=250000)
+    parser.add_argument("--accounts-per-user", type=int, default=10)
+    args = parser.parse_args()
+
+    for name, store_class in STORES.items():
+        bytes_per_account = measure(store_class, args.accounts, args.accounts_per_user)
+        print(f"{name}: {bytes_per_account:.0f} bytes per account ({args.accounts} accounts, {args.accounts_per_user} per user)")
+
+if __name__ == "__main__":
+    main()
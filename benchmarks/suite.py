@@ -0,0 +1,217 @@
+""" Times the hot paths of the collections and the HTTP routes, and compares the results with a stored baseline.
+
+    python -m benchmarks.suite [--sizes 1000 100000 1000000] [--stores in_memory compact sqlite ledger shared]
+                               [--output results.json] [--baseline baseline.json] [--save-baseline] [--tolerance 0.25]
+
+Every collection benchmark fills a fresh store with `size` accounts (or users) first, and then times repeated calls against it.
+The HTTP benchmarks use Flask's test client against app.py and add `size` accounts to its store, so they need a config.json, just like `flask run` does.
+With --baseline, every result is compared with the baseline result of the same name, store and size, and the run
+exits with status 1 if any of them got slower by more than the tolerance.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from account_collection import AccountCollection
+from user_collection import UserCollection
+from in_memory_account_store import InMemoryAccountStore
+from in_memory_user_store import InMemoryUserStore
+from compact_account_store import CompactAccountStore
+from sqlite_account_store import SqliteAccountStore
+from sqlite_user_store import SqliteUserStore
+from ledger_account_store import LedgerAccountStore
+from shared_memory_account_store import SharedMemoryAccountStore
+from password_hasher import PasswordHasher
+
+ACCOUNT_STORES = {
+    "in_memory": lambda directory: InMemoryAccountStore(),
+    "compact": lambda directory: CompactAccountStore(),
+    "sqlite": lambda directory: SqliteAccountStore(os.path.join(directory, "accounts.db")),
+    "ledger": lambda directory: LedgerAccountStore(os.path.join(directory, "accounts.ledger"), fsync=False),
+    # Room for the largest size, plus the accounts created by AccountCollection.create_accounts[100]
+    "shared": lambda directory: SharedMemoryAccountStore(os.path.join(directory, "accounts.shm"), capacity=2000000),
+}
+USER_STORES = {
+    "in_memory": lambda directory: InMemoryUserStore(),
+    "sqlite": lambda directory: SqliteUserStore(os.path.join(directory, "users.db")),
+}
+
+def time_calls(function, iterations: int) -> dict:
+    """ Calls function iterations times, and summarizes how long the calls took """
+    durations = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {
+        "iterations": iterations,
+        "mean_us": statistics.fmean(durations) * 1e6,
+        "p50_us": durations[len(durations) // 2] * 1e6,
+        "p99_us": durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1e6,
+        "ops_per_second": iterations / sum(durations),
+    }
+
+def fill_accounts(collection: AccountCollection, size: int, accounts_per_user: int = 10) -> list[tuple[str, str]]:
+    """ Creates size accounts, and returns their (user_id, account_id) pairs """
+    user_ids = [str(uuid.uuid4()) for _ in range(max(1, size // accounts_per_user))]
+    return [(user_ids[i % len(user_ids)], collection.create_account(user_ids[i % len(user_ids)], 1000000).id) for i in range(size)]
+
+def account_benchmarks(store_name: str, size: int, iterations: int) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        collection = AccountCollection(ACCOUNT_STORES[store_name](directory))
+        accounts = fill_accounts(collection, size)
+        rng = random.Random(size)
+        samples = [rng.choice(accounts) for _ in range(iterations)]
+        targets = [rng.choice(accounts) for _ in range(iterations)]
+
+        def transfer(i):
+            (user_id, from_account_id), (_, to_account_id) = samples[i], targets[i]
+            if from_account_id != to_account_id:
+                collection.transfer(user_id, from_account_id, to_account_id, 1)
+
+        benchmarks = {
+            "AccountCollection.transfer": transfer,
+            "AccountCollection.get_user_account": lambda i: collection.get_user_account(*samples[i]),
+            "AccountCollection.get_user_accounts": lambda i: collection.get_user_accounts(samples[i][0]),
+            "AccountCollection.get_account_transactions": lambda i: collection.get_account_transactions(*samples[i], limit=100),
+            "AccountCollection.get_user_summary": lambda i: collection.get_user_summary(samples[i][0]),
+            # Runs last, as it grows the store. Times a batch of 100, against 100 times AccountCollection.create_account.
+            "AccountCollection.create_accounts[100]": lambda i: collection.create_accounts(samples[i][0], [1000] * 100),
+        }
+        for name, function in benchmarks.items():
+            results.append({"name": name, "store": store_name, "size": size, **time_calls(function, iterations)})
+    return results
+
+def user_benchmarks(store_name: str, size: int, iterations: int) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        user_store = USER_STORES[store_name](directory)
+        collection = UserCollection(user_store, PasswordHasher())
+        # Filling the store through the collection would run bcrypt size times, so every pre-filled user shares one hash instead
+        username = "benchmarkuser"
+        _, pwd = collection.create_user(username)
+        hashed_pwd = user_store.get_user(username).hashed_pwd
+        for i in range(size - 1):
+            user_store.create_user(f"user{i}", hashed_pwd)
+
+        # Both calls are dominated by bcrypt, so they get fewer iterations
+        bcrypt_iterations = max(1, iterations // 100)
+        benchmarks = {
+            "UserCollection.authenticate": lambda i: collection.authenticate(username, pwd),
+            "UserCollection.create_user": lambda i: collection.create_user(f"new{size}x{i}"),
+        }
+        for name, function in benchmarks.items():
+            results.append({"name": name, "store": store_name, "size": size, **time_calls(function, bcrypt_iterations)})
+    return results
+
+def http_benchmarks(size: int, iterations: int) -> list[dict]:
+    """ Times every route in app.py through Flask's test client, using the stores configured in config.json """
+    from app import create_app
+    app = create_app()
+    client = app.test_client()
+
+    username = f"bench{uuid.uuid4().hex[:12]}"
+    pwd = client.post("/users", json={"username": username}).get_json()["pwd"]
+    basic_auth = {"Authorization": "Basic " + base64.b64encode(f"{username}:{pwd}".encode("ascii")).decode("ascii")}
+    token = client.get("/auth", headers=basic_auth).get_json()["token"]
+    bearer = {"Authorization": f"Bearer {token}"}
+    account_ids = [client.post("/accounts", json={"balance": 1000000}, headers=bearer).get_json()["account"]["id"] for _ in range(10)]
+    fill_accounts(app.extensions["services"].account_collection, size)
+
+    bcrypt_iterations = max(1, iterations // 100)
+    benchmarks = {
+        "POST /users": (lambda i: client.post("/users", json={"username": f"{username[:8]}{size}x{i}"}), bcrypt_iterations),
+        "GET /users/<username>": (lambda i: client.get(f"/users/{username}"), iterations),
+        "GET /users/<username>/summary": (lambda i: client.get(f"/users/{username}/summary", headers=bearer), iterations),
+        "GET /auth": (lambda i: client.get("/auth", headers=basic_auth), bcrypt_iterations),
+        "POST /accounts": (lambda i: client.post("/accounts", json={"balance": 10}, headers=bearer), iterations),
+        "POST /accounts/batch[100]": (lambda i: client.post("/accounts/batch", json={"balances": [10] * 100}, headers=bearer), max(1, iterations // 10)),
+        "GET /accounts/<account_id>": (lambda i: client.get(f"/accounts/{account_ids[i % 10]}", headers=bearer), iterations),
+        "GET /accounts": (lambda i: client.get("/accounts", headers=bearer), iterations),
+        "GET /accounts/<account_id>/transactions": (lambda i: client.get(f"/accounts/{account_ids[i % 10]}/transactions", headers=bearer), iterations),
+        "PATCH /accounts/<account_id>": (lambda i: client.patch(f"/accounts/{account_ids[i % 10]}", json={"to_account_id": account_ids[(i + 1) % 10], "amount": 1}, headers=bearer), iterations),
+        "POST /transfers/batch": (lambda i: client.post("/transfers/batch", json={"transfers": [{"from_account_id": account_ids[j], "to_account_id": account_ids[(j + 1) % 10], "amount": 1} for j in range(10)]}, headers=bearer), iterations),
+        # Last, so that every route above has histograms for it to render
+        "GET /metrics": (lambda i: client.get("/metrics"), iterations),
+    }
+    results = []
+    for name, (function, route_iterations) in benchmarks.items():
+        def checked(i, function=function, name=name):
+            response = function(i)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name} failed with status {response.status_code}: {response.get_data(as_text=True)}")
+        results.append({"name": name, "store": "app", "size": size, **time_calls(checked, route_iterations)})
+    return results
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[dict]:
+    """ Adds the change against the baseline to every result, and returns the results that regressed """
+    baseline_results = {(r["name"], r["store"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get((result["name"], result["store"], result["size"]))
+        if not baseline_result:
+            continue
+        result["baseline_mean_us"] = baseline_result["mean_us"]
+        result["change"] = result["mean_us"] / baseline_result["mean_us"] - 1
+        if result["change"] > tolerance:
+            regressions.append(result)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--stores", nargs="+", default=["in_memory", "compact"], choices=sorted(ACCOUNT_STORES))
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--skip-users", action="store_true", help="skip the UserCollection benchmarks")
+    parser.add_argument("--skip-http", action="store_true", help="skip the HTTP benchmarks")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="compare the results with this earlier output")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the --baseline file instead of comparing with it")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower than the baseline a result may be, as a fraction")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        for store_name in args.stores:
+            results += account_benchmarks(store_name, size, args.iterations)
+            if not args.skip_users and store_name in USER_STORES:
+                results += user_benchmarks(store_name, size, args.iterations)
+        if not args.skip_http:
+            results += http_benchmarks(size, args.iterations)
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    regressions = []
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+    elif args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        report["regressions"] = [f'{r["name"]} [{r["store"]}, {r["size"]}]: {r["change"]:+.0%}' for r in regressions]
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    for regression in report.get("regressions", []):
+        print(f"Regression: {regression}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
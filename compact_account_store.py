@@ -0,0 +1,191 @@
+""" This module implements AccountStore with typed arrays, for books with millions of accounts """
+from array import array
+import threading
+import uuid
+from account_store import AccountStore, Account, UserSummary, new_account_ids, AccountStoreGetError, AccountStoreCreateError, AccountStoreUpdateError, AccountStoreConflictError
+
+_MIN_BALANCE = -2**63
+_MAX_BALANCE = 2**63 - 1
+
+class CompactAccountStore(AccountStore):
+    """ An in memory store that keeps accounts as columns instead of objects.
+    Every account gets an integer slot. The slot's account id, owner, balance and version live in typed arrays, and Account objects are only built when an account is read.
+    Accounts cost roughly 175 bytes each, against roughly 295 bytes in InMemoryAccountStore, with ten accounts per user (see benchmarks/store_memory.py).
+    Columns are updated in place, so readers check a write sequence instead of taking a lock. It is odd while a write is being applied,
+    and a read that overlapped a write is done again, so readers never see half of a transfer."""
+
+    read_attempts = 3
+
+    def __init__(self):
+        super().__init__()
+        self.__slots: dict[bytes, int] = {}           # 16 byte account id -> slot
+        self.__account_ids = bytearray()              # 16 bytes per slot
+        self.__balances = array("q")
+        self.__versions = array("Q")
+        self.__owners = array("I")                    # slot -> user number
+        self.__positions = array("I")                 # slot -> position in the owner's list of slots
+        self.__user_numbers: dict[str, int] = {}
+        self.__user_ids: list[str] = []
+        self.__user_slots: list[array] = []           # user number -> the user's slots, in creation order
+        self.__user_totals: list[int] = []            # user number -> total balance, which can outgrow a typed array
+        self.__write_lock = threading.Lock()
+        self.__write_sequence = 0
+
+    def __slot(self, account_id: str) -> int | None:
+        try:
+            parsed_id = uuid.UUID(account_id)
+        except (ValueError, TypeError, AttributeError):
+            # Anything that isn't a UUID can't be an id handed out by this store
+            return None
+        # Nor can other spellings of one, like upper case or braces, which the other stores don't find either
+        return self.__slots.get(parsed_id.bytes) if str(parsed_id) == account_id else None
+
+    def __view(self, slot: int) -> Account:
+        return Account(id=str(uuid.UUID(bytes=bytes(self.__account_ids[slot * 16:slot * 16 + 16]))),
+                       user_id=self.__user_ids[self.__owners[slot]],
+                       balance=self.__balances[slot],
+                       version=self.__versions[slot])
+
+    def create_account(self, user_id: str, initial_balance: int):
+        account_id = uuid.uuid4()
+        try:
+            # The columns must all grow together, so creation is serialized
+            with self.__write_lock:
+                user_number = self.__user_numbers.get(user_id)
+                if user_number is None:
+                    user_number = len(self.__user_ids)
+                    self.__user_ids.append(user_id)
+                    self.__user_slots.append(array("I"))
+                    self.__user_totals.append(0)
+                    # Registered last, so a reader that finds the number finds everything it indexes
+                    self.__user_numbers[user_id] = user_number
+                slot = len(self.__balances)
+                # Appending the balance is the only step that can fail (on overflow), so it goes first to keep the columns aligned
+                self.__balances.append(initial_balance)
+                self.__account_ids += account_id.bytes
+                self.__versions.append(0)
+                self.__owners.append(user_number)
+                self.__positions.append(len(self.__user_slots[user_number]))
+                self.__write_sequence += 1
+                self.__user_slots[user_number].append(slot)
+                self.__user_totals[user_number] += initial_balance
+                self.__write_sequence += 1
+                self.__slots[account_id.bytes] = slot
+        except Exception as e:
+            raise AccountStoreCreateError(e) from e
+        return Account(id=str(account_id), user_id=user_id, balance=initial_balance, version=0)
+
+    def create_accounts(self, user_id: str, initial_balances: list[int]):
+        account_ids = new_account_ids(len(initial_balances))
+        try:
+            # Typed arrays check every value while converting the whole list, before any column is touched
+            balances = array("q", initial_balances)
+            with self.__write_lock:
+                user_number = self.__user_numbers.get(user_id)
+                if user_number is None:
+                    user_number = len(self.__user_ids)
+                    self.__user_ids.append(user_id)
+                    self.__user_slots.append(array("I"))
+                    self.__user_totals.append(0)
+                    # Registered last, so a reader that finds the number finds everything it indexes
+                    self.__user_numbers[user_id] = user_number
+                user_slots = self.__user_slots[user_number]
+                first_slot = len(self.__balances)
+                first_position = len(user_slots)
+                self.__balances.extend(balances)
+                self.__account_ids += b"".join(account_id.bytes for account_id in account_ids)
+                self.__versions.extend(array("Q", bytes(8 * len(balances))))
+                self.__owners.extend(array("I", [user_number]) * len(balances))
+                self.__positions.extend(range(first_position, first_position + len(balances)))
+                self.__write_sequence += 1
+                user_slots.extend(range(first_slot, first_slot + len(balances)))
+                self.__user_totals[user_number] += sum(initial_balances)
+                self.__write_sequence += 1
+                self.__slots.update((account_id.bytes, first_slot + i) for i, account_id in enumerate(account_ids))
+        except Exception as e:
+            raise AccountStoreCreateError(e) from e
+        return [Account(id=str(account_id), user_id=user_id, balance=balance, version=0) for account_id, balance in zip(account_ids, initial_balances)]
+
+    def update_account(self, account: Account):
+        self.update_accounts([account])
+
+    def update_accounts(self, accounts: list[Account]):
+        slots = [self.__slot(account.id) for account in accounts]
+        if None in slots:
+            raise AccountStoreUpdateError(KeyError(accounts[slots.index(None)].id))
+        for account in accounts:
+            if not _MIN_BALANCE <= account.balance <= _MAX_BALANCE:
+                raise AccountStoreUpdateError(OverflowError(account.balance))
+        with self.__write_lock:
+            for slot, account in zip(slots, accounts):
+                if self.__versions[slot] != account.version:
+                    raise AccountStoreConflictError(None)
+            self.__write_sequence += 1
+            for slot, account in zip(slots, accounts):
+                self.__user_totals[self.__owners[slot]] += account.balance - self.__balances[slot]
+                self.__balances[slot] = account.balance
+                self.__versions[slot] += 1
+            self.__write_sequence += 1
+
+    def __read(self, read):
+        """ Calls read until it runs without overlapping a write. After a few attempts it reads under the write lock instead """
+        for _ in range(self.read_attempts):
+            sequence = self.__write_sequence
+            if sequence % 2 == 0:
+                result = read()
+                if self.__write_sequence == sequence:
+                    return result
+        with self.__write_lock:
+            return read()
+
+    def get_account(self, account_id: str, user_id: str = None):
+        try:
+            slot = self.__slot(account_id)
+            if slot is None or (user_id and self.__user_ids[self.__owners[slot]] != user_id):
+                return None
+            return self.__read(lambda: self.__view(slot))
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_accounts(self, user_id: str):
+        try:
+            user_number = self.__user_numbers.get(user_id)
+            if user_number is None:
+                return []
+            slots = self.__user_slots[user_number][:]
+            return self.__read(lambda: [self.__view(slot) for slot in slots])
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        try:
+            user_number = self.__user_numbers.get(user_id)
+            start = 0
+            if after is not None:
+                slot = self.__slot(after)
+                if slot is None or user_number is None or self.__owners[slot] != user_number:
+                    return None
+                start = self.__positions[slot] + 1
+            if user_number is None:
+                return []
+            slots = self.__user_slots[user_number][start:start + limit]
+            return self.__read(lambda: [self.__view(slot) for slot in slots])
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summary(self, user_id: str):
+        try:
+            user_number = self.__user_numbers.get(user_id)
+            if user_number is None:
+                return UserSummary(user_id)
+            return self.__read(lambda: UserSummary(user_id, len(self.__user_slots[user_number]), self.__user_totals[user_number]))
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summaries(self):
+        try:
+            with self.__write_lock:
+                return [UserSummary(user_id, len(self.__user_slots[user_number]), self.__user_totals[user_number])
+                        for user_number, user_id in enumerate(self.__user_ids)]
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
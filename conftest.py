@@ -0,0 +1,19 @@
+""" Fixtures shared by the tests of the Flask and ASGI apps"""
+import base64
+import pytest
+
+@pytest.fixture
+def config() -> dict:
+    """ A config for create_app() with the in-memory stores. A new dict for every test, so tests can change it """
+    return {"JWT_SECRET_KEY": "testsecrettestsecrettestsecret123", "JWT_TOKEN_LOCATION": ["headers"], "JWT_ACCESS_TOKEN_EXPIRES": 3600}
+
+def _signed_in(client, username: str) -> dict:
+    pwd = client.post("/users", json={"username": username}).get_json()["pwd"]
+    basic = base64.b64encode(f"{username}:{pwd}".encode("ascii")).decode("ascii")
+    token = client.get("/auth", headers={"Authorization": f"Basic {basic}"}).get_json()["token"]
+    return {"Authorization": f"Bearer {token}"}
+
+@pytest.fixture
+def signed_in():
+    """ signed_in(client, username) signs a new user up through a Flask test client, and returns the headers of a request signed in as them """
+    return _signed_in
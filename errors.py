@@ -10,6 +10,8 @@ class APIError(Exception):
         if status_code is not None:
             self.status_code = status_code
         self.payload = kwargs
+        # Extra headers for the response, e.g. Retry-After
+        self.headers: dict[str, str] = {}
 
     def to_dict(self):
         dictionary = dict(self.payload or ())
@@ -0,0 +1,104 @@
+""" This module implements the IdempotentRequests class, which replays responses for requests retried with the same Idempotency-Key """
+from collections.abc import Callable
+import logging
+import time
+from idempotency_store import IdempotencyStore, IdempotencyStoreError, PendingRequest, StoredResponse
+from errors import APIError
+
+class InvalidIdempotencyKeyError(APIError):
+    def __init__(self, key: str):
+        super().__init__("Idempotency-Key must be between 1 and 255 characters.", 400, key=key)
+
+class IdempotencyKeyReusedError(APIError):
+    def __init__(self, key: str):
+        super().__init__("Idempotency-Key was already used for a different request.", 422, key=key)
+
+class IdempotencyLookupError(APIError):
+    def __init__(self, key: str):
+        super().__init__("Unexpected error. Unable to look up idempotency key.", 500, key=key)
+
+class IdempotencyTimeoutError(APIError):
+    def __init__(self, key: str):
+        super().__init__("A request with the same Idempotency-Key is still being handled. Retry later.", 409, key=key)
+
+class IdempotencyOutcomeUnknownError(APIError):
+    def __init__(self, key: str):
+        super().__init__("The first request with this Idempotency-Key never finished, so whether it went through is unknown. "
+                         "Check the account's transactions before retrying with a new key.", 409, key=key)
+
+# Waiting on a claim starts with short polls, as most requests finish within milliseconds
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.25
+
+# Answers that say the request may well succeed if it is simply sent again: a conflict with another request, or being turned away by admission control
+RETRYABLE_STATUS_CODES = frozenset({409, 429})
+
+def is_final(error: APIError) -> bool:
+    """ Whether an error is the request's answer for good, and is stored for its Idempotency-Key. Unexpected and retryable errors aren't,
+    so that a retry with the same key runs the request again """
+    return error.status_code < 500 and error.status_code not in RETRYABLE_STATUS_CODES
+
+def check_claim(claim: StoredResponse | PendingRequest, key: str, fingerprint: str, abandoned_after: float):
+    """ Raises if a claim someone else holds can't be waited on or replayed """
+    if claim.fingerprint != fingerprint:
+        raise IdempotencyKeyReusedError(key)
+    if isinstance(claim, PendingRequest) and time.time() - claim.claimed_at > abandoned_after:
+        raise IdempotencyOutcomeUnknownError(key)
+
+class IdempotentRequests():
+    """ Runs each (user, Idempotency-Key) pair at most once, and answers retries with the stored first response.
+    The key is claimed in the store before the request runs, so a retry that arrives on any worker while the first request is still running
+    waits for its response, instead of running alongside it. Requests that fail with an unexpected error release their claim, so they can be retried for real.
+    A claim that is never completed, e.g. because the worker died after moving the money but before storing the response, is never run again.
+    Once it is older than abandoned_after seconds, retries are told that the outcome is unknown."""
+
+    def __init__(self, idempotency_store: IdempotencyStore, wait_timeout: float = 30.0, abandoned_after: float = 5 * 60):
+        self.__idempotency_store = idempotency_store
+        self.__wait_timeout = wait_timeout
+        self.__abandoned_after = abandoned_after
+        self.root_logger = logging.getLogger("root")
+
+    def __claim(self, user_id: str, key: str, fingerprint: str) -> StoredResponse | PendingRequest | None:
+        try:
+            claim = self.__idempotency_store.claim(user_id, key, fingerprint)
+        except IdempotencyStoreError as e:
+            self.root_logger.warning("Claiming idempotency key failed. user_id='%s', key='%s', e='%s'", user_id, key, e)
+            raise IdempotencyLookupError(key) from e
+        if claim is not None:
+            check_claim(claim, key, fingerprint, self.__abandoned_after)
+        return claim
+
+    def run(self, user_id: str, key: str, fingerprint: str, handle: Callable[[], StoredResponse]) -> tuple[StoredResponse, bool]:
+        """ Calls handle, unless a response is already stored for the key. Returns the response, and whether it was replayed.
+        fingerprint identifies the request itself, so that a key can't be reused for a different request."""
+        if not key or len(key) > 255:
+            raise InvalidIdempotencyKeyError(key)
+
+        deadline = time.monotonic() + self.__wait_timeout
+        poll_interval = POLL_INTERVAL
+        while (claim := self.__claim(user_id, key, fingerprint)) is not None:
+            if isinstance(claim, StoredResponse):
+                return claim, True
+            # Someone else, possibly another worker, is running the request
+            if time.monotonic() >= deadline:
+                raise IdempotencyTimeoutError(key)
+            time.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+
+        try:
+            response = handle()
+        except BaseException:
+            self.__release(user_id, key)
+            raise
+        try:
+            self.__idempotency_store.put_response(user_id, key, response)
+        except IdempotencyStoreError as e:
+            # The request itself went through, so its response is still returned. The key stays claimed, so a retry won't run it again.
+            self.root_logger.error("Storing response for idempotency key failed. user_id='%s', key='%s', e='%s'", user_id, key, e)
+        return response, False
+
+    def __release(self, user_id: str, key: str):
+        try:
+            self.__idempotency_store.release(user_id, key)
+        except IdempotencyStoreError as e:
+            self.root_logger.error("Releasing idempotency key failed. user_id='%s', key='%s', e='%s'", user_id, key, e)
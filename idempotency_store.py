@@ -0,0 +1,41 @@
+"""This module defines the abstract IdempotencyStore class"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+@dataclass
+class StoredResponse:
+    """ The first response given to a request with an Idempotency-Key, as stored """
+    fingerprint: str
+    status_code: int
+    body: dict
+
+@dataclass
+class PendingRequest:
+    """ A claim on a key by a request that hasn't stored its response yet """
+    fingerprint: str
+    claimed_at: float    # time.time() of the claim
+
+class IdempotencyStoreError(Exception):
+    """ Base exception for idempotency stores """
+    def __init__(self, original_exception: Exception, message: str = "Operation failed unexpectedly, when attempting to look up or store an idempotency key."):
+        self.message = message
+        self.original_exception = original_exception
+        super().__init__(message)
+    def __str__(self):
+        return f"{self.message} (originalException: {self.original_exception})"
+
+class IdempotencyStore(ABC):
+    """ Abstract class, which all idempotency stores will inherit from. Keys are scoped by user, so users can't see each other's responses """
+
+    @abstractmethod
+    def claim(self, user_id: str, key: str, fingerprint: str) -> StoredResponse | PendingRequest | None:
+        """ Abstract method for claiming a key for a request about to run. Must be atomic across every process sharing the store.
+        Returns None if the caller now holds the claim, and otherwise the stored response or the pending claim of whoever got there first """
+
+    @abstractmethod
+    def put_response(self, user_id: str, key: str, response: StoredResponse):
+        """ Abstract method for storing the response for a key, which completes its claim"""
+
+    @abstractmethod
+    def release(self, user_id: str, key: str):
+        """ Abstract method for dropping a pending claim on a key, so that a retry can run the request again"""
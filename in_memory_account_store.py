@@ -1,45 +1,75 @@
-""" This module implements AccountStore with a simple list """
+""" This module implements AccountStore with a couple of dictionaries """
 import uuid
-from account_store import AccountStore, Account, AccountStoreGetError, AccountStoreCreateError, AccountStoreUpdateError
+from account_store import AccountStore, Account, UserSummary, new_account_ids, AccountStoreGetError, AccountStoreCreateError, AccountStoreUpdateError, AccountStoreConflictError
+from versioned_accounts import VersionedAccounts
 
 class InMemoryAccountStore(AccountStore):
-    """ An in memory store used during debugging and testing. It's just based around a list really, don't get too excited."""
-    __accounts: list[Account]
+    """ An in memory store used during debugging and testing.
+    Accounts are kept in a VersionedAccounts table keyed by account id, with a secondary index from user id to the ids of the user's accounts, in creation order.
+    Reads never wait on transfers, and always see every account as of the same point in time."""
+    __accounts: VersionedAccounts
 
     def __init__(self):
         super().__init__()
-        self.__accounts: list[Account] = []
+        self.__accounts = VersionedAccounts()
 
     def create_account(self, user_id: str, initial_balance: int):
         account_id = str(uuid.uuid4())
         account = Account(user_id = user_id, id=account_id, balance=initial_balance)
 
         try:
-            self.__accounts.append(account)
+            self.__accounts.add([account])
         except Exception as e:
             raise AccountStoreCreateError(e) from e
         return account
 
+    def create_accounts(self, user_id: str, initial_balances: list[int]):
+        accounts = [Account(user_id=user_id, id=str(account_id), balance=balance) for account_id, balance in zip(new_account_ids(len(initial_balances)), initial_balances)]
+
+        try:
+            self.__accounts.add(accounts)
+        except Exception as e:
+            raise AccountStoreCreateError(e) from e
+        return accounts
+
 
     def update_account(self, account: Account):
+        self.update_accounts([account])
+
+    def update_accounts(self, accounts: list[Account]):
         try:
-            index = next(i for i, x in enumerate(self.__accounts) if x.id == account.id)
-            self.__accounts[index] = account
+            committed = self.__accounts.commit(accounts)
         except Exception as e:
             raise AccountStoreUpdateError(e) from e
+        if not committed:
+            raise AccountStoreConflictError(None)
 
     def get_account(self, account_id: str, user_id: str = None):
-        user_check = lambda id: id == user_id if user_id else lambda _: True
-        account_check = lambda id: id == account_id if account_id else lambda _: True    
         try:
-            return next(x for x in self.__accounts if user_check(x.user_id) and account_check(x.id))
-        except StopIteration:
-            return None
+            return self.__accounts.get(account_id, user_id)
         except Exception as e:
             raise AccountStoreGetError(e) from e
-        
+
     def get_accounts(self, user_id: str):
         try:
-            return [x for x in self.__accounts if x.user_id == user_id]
+            return self.__accounts.get_all(user_id)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        try:
+            return self.__accounts.get_page(user_id, limit, after)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summary(self, user_id: str):
+        try:
+            return UserSummary(user_id, *self.__accounts.summary(user_id))
         except Exception as e:
-            raise AccountStoreGetError(e) from e
\ No newline at end of file
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summaries(self):
+        try:
+            return [UserSummary(user_id, *summary) for user_id, summary in self.__accounts.summaries().items()]
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
@@ -0,0 +1,50 @@
+""" This module implements IdempotencyStore with a bounded LRU dictionary """
+from collections import OrderedDict
+import threading
+import time
+from idempotency_store import IdempotencyStore, PendingRequest, StoredResponse
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    """ Keeps the responses for at most max_entries keys, for ttl_seconds each. The least recently used keys are dropped first.
+    Claims are only seen by the process holding the store."""
+
+    def __init__(self, max_entries: int = 100000, ttl_seconds: float = 24 * 60 * 60):
+        super().__init__()
+        self.__max_entries = max_entries
+        self.__ttl_seconds = ttl_seconds
+        self.__responses: OrderedDict[tuple[str, str], tuple[float, StoredResponse | PendingRequest]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __get(self, user_id: str, key: str) -> StoredResponse | PendingRequest | None:
+        entry = self.__responses.get((user_id, key))
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del self.__responses[(user_id, key)]
+            return None
+        self.__responses.move_to_end((user_id, key))
+        return response
+
+    def __put(self, user_id: str, key: str, response: StoredResponse | PendingRequest):
+        self.__responses[(user_id, key)] = (time.monotonic() + self.__ttl_seconds, response)
+        self.__responses.move_to_end((user_id, key))
+        while len(self.__responses) > self.__max_entries:
+            self.__responses.popitem(last=False)
+
+    def claim(self, user_id: str, key: str, fingerprint: str):
+        with self.__lock:
+            response = self.__get(user_id, key)
+            if response is None:
+                self.__put(user_id, key, PendingRequest(fingerprint, time.time()))
+            return response
+
+    def put_response(self, user_id: str, key: str, response: StoredResponse):
+        with self.__lock:
+            self.__put(user_id, key, response)
+
+    def release(self, user_id: str, key: str):
+        with self.__lock:
+            entry = self.__responses.get((user_id, key))
+            if entry is not None and isinstance(entry[1], PendingRequest):
+                del self.__responses[(user_id, key)]
@@ -0,0 +1,60 @@
+""" This module implements TransactionStore with a dictionary of lists """
+from bisect import bisect_left
+from collections import Counter, deque
+from datetime import datetime, timezone
+import threading
+from transaction_store import TransactionStore, Transaction, format_timestamp
+
+class InMemoryTransactionStore(TransactionStore):
+    """ Keeps every account's transactions in a list in the order they were added, which is also their order by id and by created_at.
+    Range queries and cursors are binary searches into that list, so a page costs O(log n) plus its own size.
+    At most max_transactions are kept. Past that, the oldest tenth is dropped in one go, so that dropping costs O(1) per transaction on average."""
+
+    def __init__(self, max_transactions: int = 1000000):
+        super().__init__()
+        self.__max_transactions = max_transactions
+        self.__transactions: dict[str, list[Transaction]] = {}
+        # The account of every transaction kept, oldest first
+        self.__order: deque[str] = deque()
+        self.__last_id = 0
+        self.__last_created_at = ""
+        self.__lock = threading.Lock()
+
+    def add_transactions(self, transactions: list[Transaction]):
+        with self.__lock:
+            # The clock may step back, but created_at never does
+            created_at = max(format_timestamp(datetime.now(timezone.utc)), self.__last_created_at)
+            for transaction in transactions:
+                self.__last_id += 1
+                transaction.id = self.__last_id
+                transaction.created_at = created_at
+                self.__transactions.setdefault(transaction.account_id, []).append(transaction)
+                self.__order.append(transaction.account_id)
+            self.__last_created_at = created_at
+            if len(self.__order) > self.__max_transactions:
+                self.__drop_oldest(len(self.__order) - self.__max_transactions + self.__max_transactions // 10)
+
+    def __drop_oldest(self, count: int):
+        dropped = Counter(self.__order.popleft() for _ in range(count))
+        for account_id, account_count in dropped.items():
+            # A new list rather than deleting from the old one, which reads may still be looking at
+            remaining = self.__transactions[account_id][account_count:]
+            if remaining:
+                self.__transactions[account_id] = remaining
+            else:
+                del self.__transactions[account_id]
+
+    def get_transactions(self, account_id: str, start: str | None, end: str | None, limit: int, after: int = None):
+        transactions = self.__transactions.get(account_id, [])
+        # Only look at what was there when the read started, as transactions added meanwhile go on the end
+        count = len(transactions)
+        first = 0
+        if after is not None:
+            first = bisect_left(transactions, after, hi=count, key=lambda transaction: transaction.id)
+            if first == count or transactions[first].id != after:
+                return None
+            first += 1
+        if start is not None:
+            first = max(first, bisect_left(transactions, start, hi=count, key=lambda transaction: transaction.created_at))
+        last = count if end is None else bisect_left(transactions, end, lo=first, hi=count, key=lambda transaction: transaction.created_at)
+        return transactions[first:min(last, first + limit)]
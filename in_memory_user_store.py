@@ -1,29 +1,42 @@
-""" This module implements UserStore with a simple list """
+""" This module implements UserStore with a couple of dictionaries """
+import threading
 import uuid
 from user_store import UserStore, StoredUser, UserStoreGetError, UserStoreCreateError
 
 class InMemoryUserStore(UserStore):
-    """ An in memory store used during debugging and testing. It's just based around a list really, don't get too excited."""
-    __users: list[StoredUser]
+    """ An in memory store used during debugging and testing.
+    Users are indexed by username. Creation is guarded by a lock, so that checking for an existing username and inserting the new user happen as one step."""
+    __users: dict[str, StoredUser]
 
     def __init__(self):
         super().__init__()
-        self.__users = []
-    
+        self.__users = {}
+        self.__lock = threading.Lock()
+
+    def __insert(self, username: str, hashed_pwd: bytes) -> StoredUser:
+        user_id = str(uuid.uuid4())
+        user = StoredUser(user_id, username, hashed_pwd)
+        self.__users[username] = user
+        return user
+
     def create_user(self, username: str, hashed_pwd: bytes):
         try:
-            user_id = str(uuid.uuid4())
-            user = StoredUser(user_id, username, hashed_pwd)
-            self.__users.append(user)
-            return user
+            with self.__lock:
+                return self.__insert(username, hashed_pwd)
+        except Exception as e:
+            raise UserStoreCreateError(e) from e
+
+    def create_user_if_absent(self, username: str, hashed_pwd: bytes):
+        try:
+            with self.__lock:
+                if username in self.__users:
+                    return None
+                return self.__insert(username, hashed_pwd)
         except Exception as e:
             raise UserStoreCreateError(e) from e
 
     def get_user(self, username: str):
         try:
-            return next(x for x in self.__users if x.username == username)
-        except StopIteration:
-            return None
+            return self.__users.get(username)
         except Exception as e:
             raise UserStoreGetError(e) from e
-            
\ No newline at end of file
@@ -0,0 +1,58 @@
+""" This module serializes response bodies, with orjson when it is installed, and otherwise with the json module and an encoder compiled once per dataclass,
+instead of dataclasses.asdict() per object, which deep-copies every field of every account in a list """
+from collections.abc import Callable
+from dataclasses import fields, is_dataclass
+import json
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    # Optional, see the README
+    orjson = None
+
+# Compact, and like Flask's jsonify() leaves dates, decimals, UUIDs and the like to default()
+_ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+_ENCODERS: dict[type, Callable[[object], dict]] = {}
+
+def compile_encoder(cls: type) -> Callable[[object], dict]:
+    """ Builds a function that turns an instance of the dataclass cls into a dict of its fields, e.g. lambda value: {"balance": value.balance, "id": value.id, ...}.
+    Fields holding dataclasses of their own are left to the encoder of their type """
+    # Field names are identifiers, so they can be put into the source as they are
+    source = "lambda value: {" + ", ".join(f"{field.name!r}: value.{field.name}" for field in fields(cls)) + "}"
+    return eval(source, {})
+
+def default(value):
+    """ Serializes what the JSON encoder can't: dataclasses through their compiled encoder, and everything else like Flask does """
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        if not is_dataclass(value) or isinstance(value, type):
+            return DefaultJSONProvider.default(value)
+        encoder = _ENCODERS[type(value)] = compile_encoder(type(value))
+    return encoder(value)
+
+def dumps(value) -> bytes:
+    """ Serializes value like Flask's jsonify(): compact, and with dataclasses as objects """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=default, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # e.g. an integer beyond 64 bits, which the json module does handle
+            pass
+    return json.dumps(value, default=default, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+class FastJSONProvider(DefaultJSONProvider):
+    """ Flask's JSON provider, serializing through dumps() above. Pretty-printed responses in debug mode, and dumps() with arguments of its own,
+    still go through the json module, with the compiled encoders. Parsing request bodies is left to the json module as well """
+    default = staticmethod(default)
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode("utf-8")
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(dumps(self._prepare_response_obj(args, kwargs)) + b"\n", mimetype=self.mimetype)
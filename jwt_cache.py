@@ -0,0 +1,84 @@
+""" This module implements a cache of verified access tokens, which lets routes skip decoding and checking the signature of a token they have seen before """
+from collections import OrderedDict
+from collections.abc import Callable
+from functools import wraps
+import hashlib
+import threading
+import time
+from flask import current_app, g, request
+from flask_jwt_extended import jwt_required, verify_jwt_in_request, get_jwt, get_jwt_header
+
+class VerifiedTokenCache():
+    """ Remembers the decoded contents of tokens that passed full verification, keyed by a SHA-256 digest of the token.
+    An entry is never used after the token's own exp, and at most max_entries tokens are kept, least recently used first out.
+    Tokens without an exp are kept for at most max_ttl_seconds.
+    This skips everything verify_jwt_in_request() does after decoding, so it must not be used together with a token blocklist."""
+
+    def __init__(self, max_entries: int = 10000, max_ttl_seconds: float = 15 * 60):
+        self.__max_entries = max_entries
+        self.__max_ttl_seconds = max_ttl_seconds
+        self.__entries: OrderedDict[bytes, tuple[float, dict, dict]] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, token: str) -> tuple[dict, dict] | None:
+        """ Returns the header and claims of the token, if it was verified before and hasn't expired since """
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        with self.__lock:
+            entry = self.__entries.get(digest)
+            if entry is None:
+                return None
+            expires_at, jwt_header, jwt_data = entry
+            if expires_at <= time.time():
+                del self.__entries[digest]
+                return None
+            self.__entries.move_to_end(digest)
+            return jwt_header, jwt_data
+
+    def add(self, token: str, jwt_header: dict, jwt_data: dict):
+        """ Remembers a token that has just passed full verification """
+        expires_at = min(jwt_data.get("exp", float("inf")), time.time() + self.__max_ttl_seconds)
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        with self.__lock:
+            self.__entries[digest] = (expires_at, jwt_header, jwt_data)
+            self.__entries.move_to_end(digest)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+def _bearer_token() -> str | None:
+    parts = request.headers.get("Authorization", "").split()
+    if len(parts) != 2 or parts[0] != "Bearer":
+        return None
+    return parts[1]
+
+def cached_jwt_required(cache: VerifiedTokenCache | Callable[[], VerifiedTokenCache | None] | None):
+    """ Works like flask_jwt_extended's jwt_required(), but looks bearer tokens up in cache first. Without a cache it is plain jwt_required().
+    cache can also be a function that returns the cache for the current request, for routes that are defined before the app is built.
+    In an app with a user lookup loader every request is fully verified, so that the loader still runs for every request """
+    if cache is None:
+        return jwt_required()
+    get_cache = cache if callable(cache) else lambda: cache
+
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            token_cache = get_cache()
+            if token_cache is None:
+                verify_jwt_in_request()
+                return current_app.ensure_sync(fn)(*args, **kwargs)
+            token = _bearer_token()
+            cached = token_cache.get(token) if token else None
+            if cached:
+                # The same request state verify_jwt_in_request() leaves behind, so get_jwt_identity() and friends keep working.
+                # Only tokens verified without a user lookup loader are cached, so there is no user to load.
+                jwt_header, jwt_data = cached
+                g._jwt_extended_jwt_user = None
+                g._jwt_extended_jwt_header = jwt_header
+                g._jwt_extended_jwt = jwt_data
+                g._jwt_extended_jwt_location = "headers"
+            else:
+                verify_jwt_in_request()
+                if token and g._jwt_extended_jwt_location == "headers" and g._jwt_extended_jwt_user is None:
+                    token_cache.add(token, get_jwt_header(), get_jwt())
+            return current_app.ensure_sync(fn)(*args, **kwargs)
+        return decorator
+    return wrapper
@@ -0,0 +1,349 @@
+""" This module implements AccountStore as an append-only binary ledger with periodic snapshots """
+import fcntl
+import logging
+import os
+import shutil
+import struct
+import threading
+import uuid
+import zlib
+from dataclasses import replace
+from account_store import AccountStore, Account, UserSummary, new_account_ids, AccountStoreGetError, AccountStoreCreateError, AccountStoreUpdateError, AccountStoreConflictError
+from versioned_accounts import VersionedAccounts
+
+# Every ledger record is framed as <payload length, crc32 of payload, record type> followed by the payload.
+# A record whose frame or checksum doesn't add up can only be a write torn by a crash, and is cut off on startup.
+_FRAME = struct.Struct("<IIB")
+_CREATE = 1
+_SET_BALANCES = 2
+_CREATE_MANY = 3
+
+# A create record is <account id, balance, user id length> followed by the user id. A create-many record is a count followed by that many create records.
+# A set-balances record is a count followed by that many <account id, balance> pairs, so a transfer is one record.
+_CREATE_HEADER = struct.Struct("<16sqH")
+_COUNT = struct.Struct("<I")
+_BALANCE = struct.Struct("<16sq")
+
+# A ledger starts with <magic, base>, where base is the offset its first record had before the records in front of it were compacted away.
+# Offsets in snapshots and errors count every byte of records ever written, so they stay valid across compactions. Ledgers from before compaction have no header, and a base of 0.
+_LEDGER_MAGIC = b"LLDG0001"
+_LEDGER_HEADER = struct.Struct("<8sQ")
+
+# A snapshot is <magic, ledger offset, account count>, the accounts as create records each followed by its version, and a crc32 of everything before it.
+# Versions aren't in the ledger, as every set-balances record bumps the version of the accounts in it by one.
+_SNAPSHOT_MAGIC = b"LSNP0002"
+_SNAPSHOT_HEADER = struct.Struct("<8sQI")
+_VERSION = struct.Struct("<Q")
+_CRC = struct.Struct("<I")
+
+class LedgerInUseError(Exception):
+    """ Raised when another LedgerAccountStore, in this process or another one, already has the ledger open """
+    def __init__(self, path: str):
+        super().__init__(f"The ledger at {path} is already in use. Only one process at a time can run on a ledger, e.g. a single gunicorn worker.")
+
+class LedgerAccountStore(AccountStore):
+    """ Account store that appends every create and balance change to a ledger file and keeps the current balances in memory.
+    Every `snapshot_interval` records the balances are written to a snapshot, so a restart only has to replay the ledger written since.
+    Snapshots are encoded and written by a background thread, and then the ledger is compacted to the records after the snapshot, so it doesn't grow forever.
+    The balances in memory are a VersionedAccounts table, so reads never wait on the ledger being written.
+    Balances in memory can't be shared, so the store holds an exclusive lock on the ledger for as long as it is open, and a second one raises LedgerInUseError."""
+
+    def __init__(self, path: str, snapshot_interval: int = 10000, fsync: bool = True):
+        super().__init__()
+        self.__path = path
+        self.__snapshot_path = path + ".snapshot"
+        self.__snapshot_interval = snapshot_interval
+        self.__fsync = fsync
+        self.__accounts = VersionedAccounts()
+        self.__records_since_snapshot = 0
+        self.__lock = threading.Lock()
+        # Held while a snapshot is written and the ledger compacted behind it, so that snapshots are written one at a time and in order
+        self.__snapshot_lock = threading.Lock()
+        self.__snapshotter: threading.Thread | None = None
+
+        # On a file of its own, so that replacing the ledger or its snapshot never drops the lock
+        self.__lock_file = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self.__lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self.__lock_file)
+            raise LedgerInUseError(path) from None
+        try:
+            self.__snapshot_offset = self.__load_snapshot()
+            position = self.__replay(self.__snapshot_offset)
+            self.__ledger = open(self.__path, "ab")
+            self.__ledger.truncate(position)
+            self.__ledger.seek(position)
+        except BaseException:
+            os.close(self.__lock_file)
+            raise
+
+    def __load_snapshot(self) -> int:
+        try:
+            with open(self.__snapshot_path, "rb") as snapshot_file:
+                data = snapshot_file.read()
+        except FileNotFoundError:
+            return 0
+        if len(data) < _SNAPSHOT_HEADER.size + _CRC.size:
+            return 0
+        body, (crc,) = data[:-_CRC.size], _CRC.unpack_from(data, len(data) - _CRC.size)
+        if zlib.crc32(body) != crc:
+            # A broken snapshot is never fatal, as the full ledger can always be replayed instead
+            return 0
+        magic, offset, count = _SNAPSHOT_HEADER.unpack_from(body)
+        if magic != _SNAPSHOT_MAGIC:
+            return 0
+        position = _SNAPSHOT_HEADER.size
+        accounts = []
+        for _ in range(count):
+            account, position = self.__decode_create(body, position)
+            (account.version,) = _VERSION.unpack_from(body, position)
+            position += _VERSION.size
+            accounts.append(account)
+        self.__accounts.add(accounts)
+        return offset
+
+    def __replay(self, offset: int) -> int:
+        """ Applies every complete record after offset, and returns the position in the file just past the last of them """
+        if not os.path.exists(self.__path):
+            # Only the snapshot is left, if anything. The new ledger goes on from its offset.
+            self.__replace_ledger(offset, None)
+            return self.__header_size
+        with open(self.__path, "rb") as ledger_file:
+            header = ledger_file.read(_LEDGER_HEADER.size)
+            if len(header) == _LEDGER_HEADER.size and header.startswith(_LEDGER_MAGIC):
+                (_, self.__base), self.__header_size = _LEDGER_HEADER.unpack(header), _LEDGER_HEADER.size
+            else:
+                self.__base, self.__header_size = 0, 0
+            if offset < self.__base:
+                raise ValueError(f"The snapshot of {self.__path} ends at offset {offset}, but the ledger was compacted up to {self.__base}, so the records in between are gone")
+            start = self.__header_size + offset - self.__base
+            ledger_file.seek(start)
+            data = ledger_file.read()
+        position = 0
+        while position + _FRAME.size <= len(data):
+            length, crc, record_type = _FRAME.unpack_from(data, position)
+            payload = data[position + _FRAME.size:position + _FRAME.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            if record_type == _CREATE:
+                self.__accounts.add([self.__decode_create(payload, 0)[0]])
+            elif record_type == _SET_BALANCES:
+                self.__apply_set_balances(payload, offset + position)
+            elif record_type == _CREATE_MANY:
+                (count,) = _COUNT.unpack_from(payload)
+                accounts = []
+                create_position = _COUNT.size
+                for _ in range(count):
+                    account, create_position = self.__decode_create(payload, create_position)
+                    accounts.append(account)
+                self.__accounts.add(accounts)
+            position += _FRAME.size + length
+            self.__records_since_snapshot += 1
+        return start + position
+
+    def __replace_ledger(self, base: int, tail):
+        """ Swaps in a new ledger that starts at offset base, holding the records of the file tail from its current position on, if there is one """
+        temporary_path = self.__path + ".tmp"
+        with open(temporary_path, "wb") as ledger_file:
+            ledger_file.write(_LEDGER_HEADER.pack(_LEDGER_MAGIC, base))
+            if tail is not None:
+                shutil.copyfileobj(tail, ledger_file)
+            ledger_file.flush()
+            if self.__fsync:
+                os.fsync(ledger_file.fileno())
+        os.replace(temporary_path, self.__path)
+        if self.__fsync:
+            # New records go to the new ledger, so the rename has to be on disk before any of them is reported as written
+            directory = os.open(os.path.dirname(os.path.abspath(self.__path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        self.__base, self.__header_size = base, _LEDGER_HEADER.size
+
+    @staticmethod
+    def __decode_create(data: bytes, position: int) -> tuple[Account, int]:
+        raw_id, balance, user_id_length = _CREATE_HEADER.unpack_from(data, position)
+        position += _CREATE_HEADER.size
+        user_id = data[position:position + user_id_length].decode("utf-8")
+        return Account(id=str(uuid.UUID(bytes=raw_id)), user_id=user_id, balance=balance), position + user_id_length
+
+    def __apply_set_balances(self, payload: bytes, offset: int):
+        (count,) = _COUNT.unpack_from(payload)
+        accounts = []
+        for raw_id, balance in _BALANCE.iter_unpack(payload[_COUNT.size:_COUNT.size + count * _BALANCE.size]):
+            account = self.__accounts.get(str(uuid.UUID(bytes=raw_id)))
+            if account is None:
+                # Its checksum is fine, so the record is as it was written, and the ledger or snapshot it follows on from is not
+                raise ValueError(f"Ledger record at offset {offset} in {self.__path} sets the balance of unknown account {uuid.UUID(bytes=raw_id)}")
+            accounts.append(replace(account, balance=balance))
+        self.__accounts.commit(accounts)
+
+    @staticmethod
+    def __encode_create(account: Account) -> bytes:
+        user_id = account.user_id.encode("utf-8")
+        return _CREATE_HEADER.pack(uuid.UUID(account.id).bytes, account.balance, len(user_id)) + user_id
+
+    def __append(self, record_type: int, payload: bytes):
+        offset = self.__ledger.tell()
+        try:
+            self.__ledger.write(_FRAME.pack(len(payload), zlib.crc32(payload), record_type) + payload)
+            self.__ledger.flush()
+            if self.__fsync:
+                os.fsync(self.__ledger.fileno())
+        except Exception:
+            self.__cut_off(offset)
+            raise
+        self.__records_since_snapshot += 1
+
+    def __cut_off(self, offset: int):
+        """ Drops whatever part of a failed record made it into the ledger, so that a restart doesn't replay a change that was reported as failed """
+        try:
+            self.__ledger.close()
+        except OSError:
+            # Closing the file object still drops the bytes it couldn't write
+            pass
+        os.truncate(self.__path, offset)
+        self.__ledger = open(self.__path, "ab")
+        if self.__fsync:
+            os.fsync(self.__ledger.fileno())
+
+    def __capture(self) -> tuple[int, list[Account]]:
+        """ The offset of the end of the ledger and every account as of that offset. Called with the lock held, which only costs a copy of the list of accounts """
+        self.__records_since_snapshot = 0
+        return self.__base + self.__ledger.tell() - self.__header_size, self.__accounts.accounts()
+
+    def __snapshot_if_due(self):
+        if self.__records_since_snapshot < self.__snapshot_interval or (self.__snapshotter is not None and self.__snapshotter.is_alive()):
+            return
+        offset, accounts = self.__capture()
+        self.__snapshotter = threading.Thread(target=self.__snapshot_in_background, args=(offset, accounts), name="ledger-snapshot", daemon=True)
+        self.__snapshotter.start()
+
+    def __snapshot_in_background(self, offset: int, accounts: list[Account]):
+        try:
+            self.__snapshot_and_compact(offset, accounts)
+        except Exception as e:
+            # The changes themselves are already safe in the ledger, so a failed snapshot only means a longer replay. Try again on the next write.
+            logging.getLogger("root").warning("Writing ledger snapshot failed. path='%s' e='%s'", self.__snapshot_path, e)
+            with self.__lock:
+                self.__records_since_snapshot = max(self.__records_since_snapshot, self.__snapshot_interval)
+
+    def __snapshot_and_compact(self, offset: int, accounts: list[Account]):
+        with self.__snapshot_lock:
+            if offset <= self.__snapshot_offset:
+                # A newer snapshot was written meanwhile
+                return
+            self.__write_snapshot(offset, accounts)
+            self.__snapshot_offset = offset
+            with self.__lock:
+                self.__compact(offset)
+
+    def __compact(self, offset: int):
+        """ Drops the records the snapshot at offset covers from the ledger. Called with the lock held, so it only copies the records written while the snapshot was """
+        if self.__ledger.closed or offset <= self.__base:
+            return
+        with open(self.__path, "rb") as ledger_file:
+            ledger_file.seek(self.__header_size + offset - self.__base)
+            self.__replace_ledger(offset, ledger_file)
+        self.__ledger.close()
+        self.__ledger = open(self.__path, "ab")
+
+    def __write_snapshot(self, offset: int, accounts: list[Account]):
+        body = bytearray(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, offset, len(accounts)))
+        for account in accounts:
+            body += self.__encode_create(account) + _VERSION.pack(account.version)
+        body += _CRC.pack(zlib.crc32(body))
+        # Written next to the old snapshot and then swapped in, so a crash never leaves a half-written snapshot behind
+        temporary_path = self.__snapshot_path + ".tmp"
+        with open(temporary_path, "wb") as snapshot_file:
+            snapshot_file.write(body)
+            snapshot_file.flush()
+            if self.__fsync:
+                os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.__snapshot_path)
+
+    def create_account(self, user_id: str, initial_balance: int):
+        account = Account(id=str(uuid.uuid4()), user_id=user_id, balance=initial_balance)
+        try:
+            with self.__lock:
+                self.__append(_CREATE, self.__encode_create(account))
+                self.__accounts.add([account])
+                self.__snapshot_if_due()
+        except Exception as e:
+            raise AccountStoreCreateError(e) from e
+        return account
+
+    def create_accounts(self, user_id: str, initial_balances: list[int]):
+        accounts = [Account(id=str(account_id), user_id=user_id, balance=balance) for account_id, balance in zip(new_account_ids(len(initial_balances)), initial_balances)]
+        try:
+            payload = _COUNT.pack(len(accounts)) + b"".join(self.__encode_create(account) for account in accounts)
+            with self.__lock:
+                # A single record, so the batch is written and synced once, and is either replayed whole or not at all
+                self.__append(_CREATE_MANY, payload)
+                self.__accounts.add(accounts)
+                self.__snapshot_if_due()
+        except Exception as e:
+            raise AccountStoreCreateError(e) from e
+        return accounts
+
+    def update_account(self, account: Account):
+        self.update_accounts([account])
+
+    def update_accounts(self, accounts: list[Account]):
+        try:
+            payload = _COUNT.pack(len(accounts)) + b"".join(_BALANCE.pack(uuid.UUID(account.id).bytes, account.balance) for account in accounts)
+            with self.__lock:
+                # The ledger is written first, so memory never holds a balance that a restart would lose
+                if not self.__accounts.commit(accounts, write_ahead=lambda: self.__append(_SET_BALANCES, payload)):
+                    raise AccountStoreConflictError(None)
+                self.__snapshot_if_due()
+        except AccountStoreConflictError:
+            raise
+        except Exception as e:
+            raise AccountStoreUpdateError(e) from e
+
+    def get_account(self, account_id: str, user_id: str = None):
+        try:
+            return self.__accounts.get(account_id, user_id)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_accounts(self, user_id: str):
+        try:
+            return self.__accounts.get_all(user_id)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        try:
+            return self.__accounts.get_page(user_id, limit, after)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summary(self, user_id: str):
+        try:
+            return UserSummary(user_id, *self.__accounts.summary(user_id))
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summaries(self):
+        try:
+            return [UserSummary(user_id, *summary) for user_id, summary in self.__accounts.summaries().items()]
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def snapshot(self):
+        """ Writes a snapshot right away and compacts the ledger, e.g. before a planned shutdown """
+        with self.__lock:
+            offset, accounts = self.__capture()
+        self.__snapshot_and_compact(offset, accounts)
+
+    def close(self):
+        """ Waits for a snapshot being written, closes the ledger file, and lets another store open it """
+        if self.__snapshotter is not None:
+            self.__snapshotter.join()
+        with self.__lock:
+            self.__ledger.close()
+            os.close(self.__lock_file)
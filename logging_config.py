@@ -0,0 +1,42 @@
+""" This module holds the logging configuration shared by the WSGI and ASGI apps """
+
+def logging_config(error_stream: str) -> dict:
+    """ Returns the dictConfig() configuration for our two loggers, with regular logs going to error_stream """
+    # Confgure our two loggers
+    # Root: For general logging to the error stream
+    # Audit: For logging to the audit.log file for when auditers need to audit our system
+    return {
+        'version': 1,
+        'formatters': {'default': {
+            'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s',
+        }, 'auditFormatter': {
+            # JSON lines, so that audit_search.py can find the records touching an account or a user through the index
+            '()': 'audit_logging.AuditFormatter',
+        }},
+        'handlers': {'wsgi': {
+            'class': 'logging.StreamHandler',
+            'stream': error_stream,
+            'formatter': 'default'
+        }, 'auditHandler': {
+            # Requests only queue audit records. A background thread writes them to file in batches, so transfers never wait on the disk.
+            'formatter': 'auditFormatter',
+            'class': 'audit_logging.BatchingAuditHandler',
+            'filename': "audit.log",
+            'maxBytes': 5000000,
+            'backupCount': 10,
+            'batchSize': 512,
+            'flushInterval': 0.05,
+            'fsync': True,
+            'index': True
+        } },
+        'loggers': {
+            'audit': {
+                'level': 'INFO',
+                'handlers': ['auditHandler'],
+                "propagate": False
+            }},
+        'root': {
+            'level': 'INFO',
+            'handlers': ['wsgi'],
+        },
+    }
@@ -0,0 +1,287 @@
+""" This module implements the latency histograms and gauges behind the /metrics endpoint """
+from bisect import bisect_left
+from collections.abc import Callable
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+
+# The counts of workers that have exited, added up, so their files can be removed
+_RETIRED_FILE = "metrics-retired.json"
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram():
+    """ Histogram with fixed buckets, labelled by a tuple of label values.
+    Every thread counts into its own shard, so observing never takes a lock. Shards are only added up when the histogram is read.
+    The shards of threads that have finished are folded into a single total, so that a thread per request doesn't leave a shard per request behind."""
+
+    def __init__(self, name: str, documentation: str, label_names: list[str], buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.__local = threading.local()
+        self.__shards: list[tuple[threading.Thread, dict[tuple, list[float]]]] = []
+        # The counts of threads that have finished
+        self.__retired: dict[tuple, list[float]] = {}
+        self.__shards_lock = threading.Lock()
+
+    def __shard(self) -> dict[tuple, list[float]]:
+        shard = getattr(self.__local, "shard", None)
+        if shard is None:
+            shard = {}
+            self.__local.shard = shard
+            with self.__shards_lock:
+                self.__retire_finished_threads()
+                self.__shards.append((threading.current_thread(), shard))
+        return shard
+
+    def __retire_finished_threads(self):
+        """ Folds the shards of finished threads into the retired counts. A finished thread can't observe anymore, so its shard is final """
+        live_shards = []
+        for thread, shard in self.__shards:
+            if thread.is_alive():
+                live_shards.append((thread, shard))
+            else:
+                _add_counts(self.__retired, shard)
+        self.__shards = live_shards
+
+    def observe(self, value: float, *labels: str):
+        """ Records a value, e.g. a duration in seconds """
+        shard = self.__shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # One count per bucket, one for +Inf, then the sum of all values
+            counts = [0] * (len(self.buckets) + 2)
+            shard[labels] = counts
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self) -> dict[tuple, list[float]]:
+        """ Adds up the shards of every thread """
+        totals: dict[tuple, list[float]] = {}
+        with self.__shards_lock:
+            self.__retire_finished_threads()
+            shards = [shard for _, shard in self.__shards]
+            _add_counts(totals, self.__retired)
+        for shard in shards:
+            _add_counts(totals, shard)
+        return totals
+
+    def time(self, *labels: str):
+        """ Context manager that observes how long its body took """
+        return _Timer(self, labels)
+
+def _add_counts(totals: dict[tuple, list[float]], shard: dict[tuple, list[float]]):
+    for labels, counts in list(shard.items()):
+        total = totals.setdefault(labels, [0] * len(counts))
+        for i, count in enumerate(counts):
+            total[i] += count
+
+class _Timer():
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class MetricsRegistry():
+    """ Holds all metrics, and renders them in the Prometheus text format.
+    Every worker process has its own registry. Once share_through() is called, the registry regularly writes its numbers to a file in a directory
+    shared by all workers, and render() adds up every worker's file, so a scrape shows the same totals whichever worker answers it."""
+
+    def __init__(self):
+        self.__histograms: dict[str, Histogram] = {}
+        self.__gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+        self.__directory = None
+
+    def histogram(self, name: str, documentation: str, label_names: list[str], buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """ Creates and registers a histogram """
+        histogram = Histogram(name, documentation, label_names, buckets)
+        self.__histograms[name] = histogram
+        return histogram
+
+    def gauge(self, name: str, documentation: str, read_value: Callable[[], float]):
+        """ Registers a gauge, whose value is read by calling read_value when metrics are rendered """
+        self.__gauges[name] = (documentation, read_value)
+
+    def share_through(self, directory: str, interval: float = 5.0):
+        """ Starts writing this process' metrics to directory every interval seconds """
+        if self.__directory == directory:
+            # Already sharing there, e.g. when several apps are created in one process
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__start_sharing(interval)
+        # Threads don't survive a fork, so a worker forked from a preloading master starts sharing its own numbers
+        os.register_at_fork(after_in_child=lambda: self.__start_sharing(interval))
+
+    def __start_sharing(self, interval: float):
+        thread = threading.Thread(target=self.__share_loop, args=(interval,), name="metrics-writer", daemon=True)
+        thread.start()
+
+    def __share_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            self.write_snapshot()
+
+    def __snapshot(self) -> dict:
+        gauges = {}
+        for name, (_, read_value) in self.__gauges.items():
+            try:
+                gauges[name] = read_value()
+            except Exception:
+                gauges[name] = math.nan
+        return {
+            "histograms": {name: {json.dumps(labels): counts for labels, counts in histogram.snapshot().items()} for name, histogram in self.__histograms.items()},
+            "gauges": gauges,
+        }
+
+    def write_snapshot(self):
+        """ Writes this process' metrics to the shared directory right away """
+        if not self.__directory:
+            return
+        path = os.path.join(self.__directory, f"metrics-{os.getpid()}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as snapshot_file:
+            json.dump(self.__snapshot(), snapshot_file)
+        os.replace(path + ".tmp", path)
+
+    def __read(self, file_name: str) -> dict | None:
+        try:
+            with open(os.path.join(self.__directory, file_name), encoding="utf-8") as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None
+
+    def __retire(self, file_names: list[str]) -> dict | None:
+        """ Folds the counts in the files of exited workers into the retired file, and removes their files. Returns the retired counts """
+        if not file_names:
+            return self.__read(_RETIRED_FILE)
+        # Taken by every worker that folds, so no file is counted twice
+        with open(os.path.join(self.__directory, "metrics.lock"), "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            retired = self.__read(_RETIRED_FILE) or {"histograms": {}, "gauges": {}}
+            for file_name in file_names:
+                # Gone if another worker folded it first, and left out if it is unreadable
+                snapshot = self.__read(file_name)
+                if snapshot is not None:
+                    _add_histograms(retired["histograms"], snapshot["histograms"])
+            path = os.path.join(self.__directory, _RETIRED_FILE)
+            with open(path + ".tmp", "w", encoding="utf-8") as retired_file:
+                json.dump(retired, retired_file)
+            os.replace(path + ".tmp", path)
+            for file_name in file_names:
+                try:
+                    os.remove(os.path.join(self.__directory, file_name))
+                except FileNotFoundError:
+                    pass
+        return retired
+
+    def __collect(self) -> list[dict]:
+        snapshots = [self.__snapshot()]
+        if not self.__directory:
+            return snapshots
+        own_file = f"metrics-{os.getpid()}.json"
+        exited = []
+        for file_name in os.listdir(self.__directory):
+            pid = file_name[len("metrics-"):-len(".json")]
+            if not file_name.startswith("metrics-") or not file_name.endswith(".json") or not pid.isdigit() or file_name == own_file:
+                continue
+            # Counts from workers that have exited still count, but their gauges are stale
+            if not _is_running(int(pid)):
+                exited.append(file_name)
+                continue
+            snapshot = self.__read(file_name)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        retired = self.__retire(exited)
+        if retired is not None:
+            snapshots.append(retired)
+        return snapshots
+
+    def render(self) -> str:
+        """ Renders every metric, added up over all workers, in the Prometheus text exposition format """
+        snapshots = self.__collect()
+        lines = []
+        for name, histogram in self.__histograms.items():
+            lines.append(f"# HELP {name} {histogram.documentation}")
+            lines.append(f"# TYPE {name} histogram")
+            totals: dict[str, list[float]] = {}
+            for snapshot in snapshots:
+                for labels, counts in snapshot["histograms"].get(name, {}).items():
+                    total = totals.setdefault(labels, [0] * len(counts))
+                    for i, count in enumerate(counts):
+                        total[i] += count
+            for labels, counts in sorted(totals.items()):
+                label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in zip(histogram.label_names, json.loads(labels)))
+                prefix = label_text + "," if label_text else ""
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                cumulative += counts[len(histogram.buckets)]
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+                lines.append(f"{name}_sum{{{label_text}}} {counts[-1]}")
+                lines.append(f"{name}_count{{{label_text}}} {cumulative}")
+        for name, (documentation, _) in self.__gauges.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {sum(snapshot['gauges'].get(name, 0) for snapshot in snapshots)}")
+        return "\n".join(lines) + "\n"
+
+def _add_histograms(totals: dict, histograms: dict):
+    """ Adds the counts of the histograms in one snapshot to those in another """
+    for name, series in histograms.items():
+        for labels, counts in series.items():
+            total = totals.setdefault(name, {}).setdefault(labels, [0] * len(counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class InstrumentedStore():
+    """ Wraps a store, and times every call to its public methods in STORE_CALL_DURATION """
+
+    def __init__(self, store):
+        self.__store = store
+        self.__store_name = type(store).__name__
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.__store, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                STORE_CALL_DURATION.observe(time.perf_counter() - start, self.__store_name, name)
+        # Cache the wrapper, so that later calls skip __getattr__ altogether
+        setattr(self, name, timed)
+        return timed
+
+REGISTRY = MetricsRegistry()
+HTTP_REQUEST_DURATION = REGISTRY.histogram("http_request_duration_seconds", "Time spent handling requests, by route, method and status code.", ["route", "method", "status"])
+STORE_CALL_DURATION = REGISTRY.histogram("store_call_duration_seconds", "Time spent in store methods, by store class and method.", ["store", "method"])
+BCRYPT_DURATION = REGISTRY.histogram("bcrypt_duration_seconds", "Time spent hashing and checking passwords with bcrypt, including time queued for a worker.", ["operation"],
+                                     buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
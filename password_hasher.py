@@ -0,0 +1,131 @@
+""" This module implements the PasswordHasher class, which does the bcrypt work for the UserCollection """
+from collections import OrderedDict
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from metrics import BCRYPT_DURATION
+
+# bcrypt, asyncio and the process pool are only imported once they are first needed, so that importing the app stays cheap
+
+def _hash_password(pwd: bytes) -> bytes:
+    import bcrypt
+    return bcrypt.hashpw(pwd, bcrypt.gensalt())
+
+def _check_password(pwd: bytes, hashed_pwd: bytes) -> bool:
+    import bcrypt
+    return bcrypt.checkpw(pwd, hashed_pwd)
+
+def bcrypt_workers(config: dict) -> int:
+    """ The number of bcrypt processes from BCRYPT_WORKERS, by default one per CPU. 0 hashes on the request's own thread """
+    return config.get("BCRYPT_WORKERS", os.cpu_count() or 1)
+
+class VerificationCache():
+    """ Remembers recently verified passwords for a short while, so that repeated logins can skip bcrypt.
+    Entries are keyed by an HMAC of the stored hash and the password under a per-process random key, so neither the password nor a plain digest of it is kept in memory."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 10000):
+        self.__ttl_seconds = ttl_seconds
+        self.__max_entries = max_entries
+        self.__key = secrets.token_bytes(32)
+        self.__entries: OrderedDict[bytes, float] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __digest(self, pwd: bytes, hashed_pwd: bytes) -> bytes:
+        # The stored hash contains the user's salt, so it both identifies the user and invalidates the entry if the password is changed
+        return hmac.new(self.__key, hashed_pwd + b"\0" + pwd, hashlib.sha256).digest()
+
+    def contains(self, pwd: bytes, hashed_pwd: bytes) -> bool:
+        """ Checks whether the password was verified against the hash within the TTL """
+        digest = self.__digest(pwd, hashed_pwd)
+        with self.__lock:
+            expires_at = self.__entries.get(digest)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self.__entries[digest]
+                return False
+            return True
+
+    def add(self, pwd: bytes, hashed_pwd: bytes):
+        """ Remembers that the password matched the hash """
+        digest = self.__digest(pwd, hashed_pwd)
+        with self.__lock:
+            self.__entries[digest] = time.monotonic() + self.__ttl_seconds
+            self.__entries.move_to_end(digest)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+class PasswordHasher():
+    """ Hashes and checks passwords with bcrypt.
+    With max_workers set, the work runs in a dedicated process pool, and at most max_pending calls wait for it at a time, so bcrypt can't take the CPU from the request workers.
+    With verification_cache_ttl set, successful checks are remembered for that many seconds.
+    The worker processes are started by the first call, so a process that is forked after creating the hasher still gets a pool of its own."""
+
+    def __init__(self, max_workers: int = 0, max_pending: int = None, verification_cache_ttl: float = 0, verification_cache_size: int = 10000):
+        self.__max_workers = max_workers
+        self.__executor = None
+        self.__executor_lock = threading.Lock()
+        self.__max_pending = max_pending or max(1, max_workers) * 4
+        self.__pending = threading.BoundedSemaphore(self.__max_pending)
+        self.__async_pending = None
+        self.__cache = VerificationCache(verification_cache_ttl, verification_cache_size) if verification_cache_ttl > 0 else None
+
+    def __pool(self):
+        if self.__executor is None:
+            with self.__executor_lock:
+                if self.__executor is None:
+                    from concurrent.futures import ProcessPoolExecutor
+                    self.__executor = ProcessPoolExecutor(max_workers=self.__max_workers)
+        return self.__executor
+
+    def __run(self, operation: str, function, *args):
+        with BCRYPT_DURATION.time(operation):
+            if self.__max_workers <= 0:
+                return function(*args)
+            with self.__pending:
+                return self.__pool().submit(function, *args).result()
+
+    async def __run_async(self, operation: str, function, *args):
+        import asyncio
+        with BCRYPT_DURATION.time(operation):
+            if self.__max_workers <= 0:
+                # bcrypt releases the GIL, so the event loop's default threads can hash side by side
+                return await asyncio.to_thread(function, *args)
+            if self.__async_pending is None:
+                self.__async_pending = asyncio.Semaphore(self.__max_pending)
+            async with self.__async_pending:
+                return await asyncio.wrap_future(self.__pool().submit(function, *args))
+
+    def hash(self, pwd: bytes) -> bytes:
+        """ Generates a salted hash of the password """
+        return self.__run("hash", _hash_password, pwd)
+
+    def check(self, pwd: bytes, hashed_pwd: bytes) -> bool:
+        """ Checks the password against a hash made by hash() """
+        if self.__cache and self.__cache.contains(pwd, hashed_pwd):
+            return True
+        matches = self.__run("check", _check_password, pwd, hashed_pwd)
+        if matches and self.__cache:
+            self.__cache.add(pwd, hashed_pwd)
+        return matches
+
+    async def hash_async(self, pwd: bytes) -> bytes:
+        """ Like hash(), but suspends the calling coroutine rather than blocking the event loop """
+        return await self.__run_async("hash", _hash_password, pwd)
+
+    async def check_async(self, pwd: bytes, hashed_pwd: bytes) -> bool:
+        """ Like check(), but suspends the calling coroutine rather than blocking the event loop """
+        if self.__cache and self.__cache.contains(pwd, hashed_pwd):
+            return True
+        matches = await self.__run_async("check", _check_password, pwd, hashed_pwd)
+        if matches and self.__cache:
+            self.__cache.add(pwd, hashed_pwd)
+        return matches
+
+    def shutdown(self):
+        """ Stops the worker processes, if any """
+        if self.__executor:
+            self.__executor.shutdown()
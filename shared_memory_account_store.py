@@ -0,0 +1,405 @@
+""" This module implements AccountStore in a memory-mapped file, shared by every worker process on the machine """
+from contextlib import contextmanager
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from account_store import AccountStore, Account, UserSummary, new_account_ids, AccountStoreGetError, AccountStoreCreateError, AccountStoreUpdateError, AccountStoreConflictError
+
+# The file starts with a header page of <magic, account capacity, account count, user count, committed journal length>, followed by
+# the journal, the accounts, the account index, the users and the user index. The capacity is fixed when the file is created.
+_MAGIC = b"ACCTSHM2"
+_HEADER = struct.Struct("<8sQQQQ")
+_COUNTS_OFFSET = 16
+_COUNTS = struct.Struct("<QQ")
+_JOURNAL_LENGTH_OFFSET = 32
+_JOURNAL_LENGTH = struct.Struct("<Q")
+_JOURNAL_OFFSET = 4096
+_JOURNAL_SIZE = 4 * 1024 * 1024
+
+# A journal entry is <file offset, length> followed by the bytes to write there
+_PATCH = struct.Struct("<QI")
+
+# An account is <id, balance, version, owner's user number, next slot of the same owner or -1>. The owner's slots form a list in creation order.
+_ACCOUNT = struct.Struct("<16sqQIi")
+_BALANCE_VERSION = struct.Struct("<qQ")
+_BALANCE_OFFSET = 16
+_NEXT_OFFSET = 36
+
+# A user is <user id length, user id, first slot, last slot, account count, total balance>
+_USER = struct.Struct("<H64sxxiiQq")
+_USER_TAIL_OFFSET = 72
+_USER_SUMMARY_OFFSET = 76
+_USER_SUMMARY = struct.Struct("<Qq")
+_USER_TOTAL_OFFSET = 84
+_USER_TOTAL = struct.Struct("<q")
+_MAX_USER_ID_BYTES = 64
+
+# Both indexes are open-addressing hash tables of slot (or user number) + 1, with 0 marking an empty bucket
+_BUCKET = struct.Struct("<I")
+_INT = struct.Struct("<i")
+
+_MIN_BALANCE = -2**63
+_MAX_BALANCE = 2**63 - 1
+
+def _id_bytes(account_id: str) -> bytes | None:
+    """ The 16 bytes of an account id in canonical UUID form, or None for anything else, which can't be an id handed out by this store """
+    if not isinstance(account_id, str) or len(account_id) != 36 or account_id != account_id.lower() or account_id[8] != "-" or account_id[13] != "-" or account_id[18] != "-" or account_id[23] != "-":
+        return None
+    try:
+        account_id_bytes = bytes.fromhex(account_id.replace("-", ""))
+    except ValueError:
+        return None
+    # fromhex skips whitespace, which would make for fewer bytes
+    return account_id_bytes if len(account_id_bytes) == 16 else None
+
+def _id_str(account_id: bytes) -> str:
+    # The same as str(uuid.UUID(bytes=account_id)), at a fraction of the cost
+    digits = account_id.hex()
+    return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+
+class _StripeLock():
+    """ A lock held by at most one thread of all processes. A thread lock holds off the other threads of this process,
+    and a lock on one byte of the lock file holds off other processes, as fcntl record locks belong to a whole process. """
+
+    def __init__(self, lock_file: int, index: int):
+        self.__lock_file = lock_file
+        self.__index = index
+        self.__thread_lock = threading.Lock()
+
+    def acquire(self):
+        self.__thread_lock.acquire()
+        try:
+            while True:
+                try:
+                    fcntl.lockf(self.__lock_file, fcntl.LOCK_EX, 1, self.__index)
+                    return
+                except OSError as e:
+                    # The kernel sees two threads of one process waiting on locks held by another process as that process waiting on itself, and reports a deadlock.
+                    # Stripes are always taken in ascending order, so it never is one. Try again once the other process has moved on.
+                    if e.errno != errno.EDEADLK:
+                        raise
+                    time.sleep(0.001)
+        except BaseException:
+            self.__thread_lock.release()
+            raise
+
+    def release(self):
+        fcntl.lockf(self.__lock_file, fcntl.LOCK_UN, 1, self.__index)
+        self.__thread_lock.release()
+
+class SharedMemoryAccountStore(AccountStore):
+    """ Account store kept in a memory-mapped file, so that every worker process on a machine sees the same accounts.
+    Put the file on a tmpfs such as /dev/shm to keep it in memory. It survives worker and service restarts, but it isn't flushed to disk,
+    so it doesn't survive the machine going down. Use the ledger or SQLite stores when accounts must be durable.
+
+    Writers hold an exclusive flock on the file and readers a shared one. Each thread locks through its own file descriptor, as flock only
+    excludes other open files. Every write is first copied to a journal and then applied, so if a worker dies halfway through a write,
+    whoever takes the lock next applies the rest of it.
+    Transfers are locked across processes too, through transfer_locks, so concurrent transfers on one account wait for each other instead of conflicting."""
+
+    def __init__(self, path: str, capacity: int = 1000000):
+        super().__init__()
+        self.__path = path
+        self.__local = threading.local()
+        self.__lock_files: list[int] = []
+        self.__lock_files_lock = threading.Lock()
+        self.__transfer_lock_file: int | None = None
+
+        file = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            header = os.pread(file, _HEADER.size, 0)
+            if len(header) == _HEADER.size and header[:len(_MAGIC)] == _MAGIC:
+                capacity = _HEADER.unpack(header)[1]
+            else:
+                os.ftruncate(file, 0)
+                os.ftruncate(file, self.__layout(capacity))
+                os.pwrite(file, _HEADER.pack(_MAGIC, capacity, 0, 0, 0), 0)
+            size = self.__layout(capacity)
+            self.__map = mmap.mmap(file, size)
+        finally:
+            # mmap keeps a duplicate of the file descriptor, which would otherwise go on holding the lock
+            fcntl.flock(file, fcntl.LOCK_UN)
+            os.close(file)
+        self.__capacity = capacity
+
+    def __layout(self, capacity: int) -> int:
+        """ Works out where each region of a file for capacity accounts starts, and returns the size of the file """
+        self.__index_size = 1 << (2 * capacity - 1).bit_length()
+        self.__accounts_offset = _JOURNAL_OFFSET + _JOURNAL_SIZE
+        self.__account_index_offset = self.__accounts_offset + capacity * _ACCOUNT.size
+        self.__users_offset = self.__account_index_offset + self.__index_size * _BUCKET.size
+        self.__user_index_offset = self.__users_offset + capacity * _USER.size
+        return self.__user_index_offset + self.__index_size * _BUCKET.size
+
+    def close(self):
+        """ Unmaps the file and closes every lock file descriptor. The accounts stay in the file """
+        with self.__lock_files_lock:
+            for lock_file in self.__lock_files:
+                os.close(lock_file)
+            self.__lock_files.clear()
+        if self.__transfer_lock_file is not None:
+            os.close(self.__transfer_lock_file)
+        self.__map.close()
+
+    def transfer_locks(self, count: int):
+        # Record locks are dropped when the process closes any descriptor of the file, so they live in a file of their own that is only opened once.
+        # Forked workers inherit the descriptor, but not the locks, which stay with the process that took them.
+        if self.__transfer_lock_file is None:
+            self.__transfer_lock_file = os.open(self.__path + ".locks", os.O_RDWR | os.O_CREAT, 0o600)
+        return [_StripeLock(self.__transfer_lock_file, index) for index in range(count)]
+
+    def __lock_file(self) -> int:
+        lock_file = getattr(self.__local, "lock_file", None)
+        # A worker forked from a process that already used the store must not share its open files, or their locks wouldn't exclude each other
+        if lock_file is None or self.__local.pid != os.getpid():
+            lock_file = os.open(self.__path, os.O_RDWR)
+            self.__local.lock_file = lock_file
+            self.__local.pid = os.getpid()
+            with self.__lock_files_lock:
+                self.__lock_files.append(lock_file)
+        return lock_file
+
+    @contextmanager
+    def __locked(self, exclusive: bool):
+        lock_file = self.__lock_file()
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            if _JOURNAL_LENGTH.unpack_from(self.__map, _JOURNAL_LENGTH_OFFSET)[0]:
+                # A writer died halfway through applying its journal. Nobody else can be writing, so finish the write for it.
+                if not exclusive:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.__recover()
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __recover(self):
+        mapped = self.__map
+        end = _JOURNAL_OFFSET + _JOURNAL_LENGTH.unpack_from(mapped, _JOURNAL_LENGTH_OFFSET)[0]
+        position = _JOURNAL_OFFSET
+        while position < end:
+            offset, length = _PATCH.unpack_from(mapped, position)
+            position += _PATCH.size
+            mapped[offset:offset + length] = mapped[position:position + length]
+            position += length
+        _JOURNAL_LENGTH.pack_into(mapped, _JOURNAL_LENGTH_OFFSET, 0)
+
+    def __write(self, patches: list[tuple[int, bytes]]):
+        """ Writes every patch or, if the process dies on the way, none of them until the next lock holder recovers the journal. Needs the exclusive lock """
+        mapped = self.__map
+        length = sum(_PATCH.size + len(data) for _, data in patches)
+        if length > _JOURNAL_SIZE:
+            raise ValueError(f"write of {length} bytes doesn't fit in the journal")
+        position = _JOURNAL_OFFSET
+        for offset, data in patches:
+            _PATCH.pack_into(mapped, position, offset, len(data))
+            position += _PATCH.size
+            mapped[position:position + len(data)] = data
+            position += len(data)
+        # Setting the length commits the journal
+        _JOURNAL_LENGTH.pack_into(mapped, _JOURNAL_LENGTH_OFFSET, length)
+        for offset, data in patches:
+            mapped[offset:offset + len(data)] = data
+        _JOURNAL_LENGTH.pack_into(mapped, _JOURNAL_LENGTH_OFFSET, 0)
+
+    def __find_slot(self, account_id: bytes) -> int | None:
+        mapped = self.__map
+        mask = self.__index_size - 1
+        bucket = int.from_bytes(account_id[:8], "little") & mask
+        while True:
+            entry = _BUCKET.unpack_from(mapped, self.__account_index_offset + bucket * _BUCKET.size)[0]
+            if entry == 0:
+                return None
+            account_offset = self.__accounts_offset + (entry - 1) * _ACCOUNT.size
+            if mapped[account_offset:account_offset + 16] == account_id:
+                return entry - 1
+            bucket = (bucket + 1) & mask
+
+    def __slot(self, account_id: str) -> int | None:
+        account_id_bytes = _id_bytes(account_id)
+        return None if account_id_bytes is None else self.__find_slot(account_id_bytes)
+
+    def __find_user(self, user_id: bytes) -> tuple[int | None, int]:
+        """ Returns the user's number, or None and the empty bucket the user would go in """
+        mapped = self.__map
+        mask = self.__index_size - 1
+        bucket = zlib.crc32(user_id) & mask
+        while True:
+            entry = _BUCKET.unpack_from(mapped, self.__user_index_offset + bucket * _BUCKET.size)[0]
+            if entry == 0:
+                return None, bucket
+            length, stored_user_id, *_ = _USER.unpack_from(mapped, self.__users_offset + (entry - 1) * _USER.size)
+            if stored_user_id[:length] == user_id:
+                return entry - 1, bucket
+            bucket = (bucket + 1) & mask
+
+    def __user_id(self, user_number: int) -> str:
+        length, user_id, *_ = _USER.unpack_from(self.__map, self.__users_offset + user_number * _USER.size)
+        return user_id[:length].decode()
+
+    def __view(self, slot: int, user_id: str = None) -> Account:
+        account_id, balance, version, owner, _ = _ACCOUNT.unpack_from(self.__map, self.__accounts_offset + slot * _ACCOUNT.size)
+        return Account(id=_id_str(account_id), user_id=user_id or self.__user_id(owner), balance=balance, version=version)
+
+    def __user_accounts(self, user_id: str, first_slot: int, limit: int | None) -> list[Account]:
+        accounts = []
+        slot = first_slot
+        while slot != -1 and (limit is None or len(accounts) < limit):
+            account_id, balance, version, _, slot_after = _ACCOUNT.unpack_from(self.__map, self.__accounts_offset + slot * _ACCOUNT.size)
+            accounts.append(Account(id=_id_str(account_id), user_id=user_id, balance=balance, version=version))
+            slot = slot_after
+        return accounts
+
+    def create_account(self, user_id: str, initial_balance: int):
+        return self.create_accounts(user_id, [initial_balance])[0]
+
+    def create_accounts(self, user_id: str, initial_balances: list[int]):
+        account_ids = new_account_ids(len(initial_balances))
+        try:
+            user_id_bytes = user_id.encode()
+            if len(user_id_bytes) > _MAX_USER_ID_BYTES:
+                raise ValueError(f"user id is longer than {_MAX_USER_ID_BYTES} bytes")
+            with self.__locked(exclusive=True):
+                account_count, user_count = _COUNTS.unpack_from(self.__map, _COUNTS_OFFSET)
+                if account_count + len(initial_balances) > self.__capacity:
+                    raise MemoryError(f"the store is full at {self.__capacity} accounts")
+                first_slot = account_count
+                last_slot = first_slot + len(initial_balances) - 1
+                patches = []
+
+                user_number, user_bucket = self.__find_user(user_id_bytes)
+                if user_number is None:
+                    user_number = user_count
+                    user_count += 1
+                    patches.append((self.__users_offset + user_number * _USER.size,
+                                    _USER.pack(len(user_id_bytes), user_id_bytes, first_slot, last_slot, len(initial_balances), sum(initial_balances))))
+                    patches.append((self.__user_index_offset + user_bucket * _BUCKET.size, _BUCKET.pack(user_number + 1)))
+                else:
+                    user_offset = self.__users_offset + user_number * _USER.size
+                    previous_last_slot = _INT.unpack_from(self.__map, user_offset + _USER_TAIL_OFFSET)[0]
+                    patches.append((self.__accounts_offset + previous_last_slot * _ACCOUNT.size + _NEXT_OFFSET, _INT.pack(first_slot)))
+                    patches.append((user_offset + _USER_TAIL_OFFSET, _INT.pack(last_slot)))
+                    account_count_of_user, total_balance = _USER_SUMMARY.unpack_from(self.__map, user_offset + _USER_SUMMARY_OFFSET)
+                    patches.append((user_offset + _USER_SUMMARY_OFFSET, _USER_SUMMARY.pack(account_count_of_user + len(initial_balances), total_balance + sum(initial_balances))))
+
+                # The new accounts are contiguous, so they are written in one go. Packing checks every balance before anything is written.
+                patches.append((self.__accounts_offset + first_slot * _ACCOUNT.size,
+                                b"".join(_ACCOUNT.pack(account_id.bytes, balance, 0, user_number, slot + 1 if slot < last_slot else -1)
+                                         for slot, (account_id, balance) in enumerate(zip(account_ids, initial_balances), first_slot))))
+                mask = self.__index_size - 1
+                claimed = set()
+                for slot, account_id in enumerate(account_ids, first_slot):
+                    bucket = int.from_bytes(account_id.bytes[:8], "little") & mask
+                    while bucket in claimed or _BUCKET.unpack_from(self.__map, self.__account_index_offset + bucket * _BUCKET.size)[0]:
+                        bucket = (bucket + 1) & mask
+                    claimed.add(bucket)
+                    patches.append((self.__account_index_offset + bucket * _BUCKET.size, _BUCKET.pack(slot + 1)))
+                patches.append((_COUNTS_OFFSET, _COUNTS.pack(account_count + len(initial_balances), user_count)))
+                self.__write(patches)
+        except Exception as e:
+            raise AccountStoreCreateError(e) from e
+        return [Account(id=str(account_id), user_id=user_id, balance=balance, version=0) for account_id, balance in zip(account_ids, initial_balances)]
+
+    def update_account(self, account: Account):
+        self.update_accounts([account])
+
+    def update_accounts(self, accounts: list[Account]):
+        for account in accounts:
+            if not _MIN_BALANCE <= account.balance <= _MAX_BALANCE:
+                raise AccountStoreUpdateError(OverflowError(account.balance))
+        try:
+            with self.__locked(exclusive=True):
+                slots = [self.__slot(account.id) for account in accounts]
+                if None in slots:
+                    raise AccountStoreUpdateError(KeyError(accounts[slots.index(None)].id))
+                patches = []
+                balance_changes: dict[int, int] = {}
+                for slot, account in zip(slots, accounts):
+                    offset = self.__accounts_offset + slot * _ACCOUNT.size
+                    _, balance, version, owner, _ = _ACCOUNT.unpack_from(self.__map, offset)
+                    if version != account.version:
+                        raise AccountStoreConflictError(None)
+                    patches.append((offset + _BALANCE_OFFSET, _BALANCE_VERSION.pack(account.balance, account.version + 1)))
+                    balance_changes[owner] = balance_changes.get(owner, 0) + account.balance - balance
+                # The owners' totals go through the same journal entry as the balances, so they never disagree
+                for owner, balance_change in balance_changes.items():
+                    if balance_change:
+                        offset = self.__users_offset + owner * _USER.size + _USER_TOTAL_OFFSET
+                        patches.append((offset, _USER_TOTAL.pack(_USER_TOTAL.unpack_from(self.__map, offset)[0] + balance_change)))
+                self.__write(patches)
+        except AccountStoreUpdateError:
+            raise
+        except Exception as e:
+            raise AccountStoreUpdateError(e) from e
+
+    def get_account(self, account_id: str, user_id: str = None):
+        try:
+            with self.__locked(exclusive=False):
+                slot = self.__slot(account_id)
+                if slot is None:
+                    return None
+                account = self.__view(slot)
+            if user_id and account.user_id != user_id:
+                return None
+            return account
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_accounts(self, user_id: str):
+        try:
+            with self.__locked(exclusive=False):
+                user_number, _ = self.__find_user(user_id.encode())
+                if user_number is None:
+                    return []
+                first_slot = _USER.unpack_from(self.__map, self.__users_offset + user_number * _USER.size)[2]
+                return self.__user_accounts(user_id, first_slot, None)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        try:
+            with self.__locked(exclusive=False):
+                user_number, _ = self.__find_user(user_id.encode())
+                if after is not None:
+                    slot = self.__slot(after)
+                    if slot is None or user_number is None:
+                        return None
+                    _, _, _, owner, first_slot = _ACCOUNT.unpack_from(self.__map, self.__accounts_offset + slot * _ACCOUNT.size)
+                    if owner != user_number:
+                        return None
+                elif user_number is None:
+                    return []
+                else:
+                    first_slot = _USER.unpack_from(self.__map, self.__users_offset + user_number * _USER.size)[2]
+                return self.__user_accounts(user_id, first_slot, limit)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summary(self, user_id: str):
+        try:
+            with self.__locked(exclusive=False):
+                user_number, _ = self.__find_user(user_id.encode())
+                if user_number is None:
+                    return UserSummary(user_id)
+                account_count, total_balance = _USER_SUMMARY.unpack_from(self.__map, self.__users_offset + user_number * _USER.size + _USER_SUMMARY_OFFSET)
+            return UserSummary(user_id, account_count, total_balance)
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
+
+    def get_user_summaries(self):
+        try:
+            with self.__locked(exclusive=False):
+                user_count = _COUNTS.unpack_from(self.__map, _COUNTS_OFFSET)[1]
+                summaries = []
+                for user_number in range(user_count):
+                    length, user_id, _, _, account_count, total_balance = _USER.unpack_from(self.__map, self.__users_offset + user_number * _USER.size)
+                    summaries.append(UserSummary(user_id[:length].decode(), account_count, total_balance))
+            return summaries
+        except Exception as e:
+            raise AccountStoreGetError(e) from e
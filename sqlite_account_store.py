@@ -0,0 +1,170 @@
+""" This module implements AccountStore on top of a SQLite database """
+import sqlite3
+import uuid
+from account_store import AccountStore, Account, UserSummary, new_account_ids, AccountStoreGetError, AccountStoreCreateError, AccountStoreUpdateError, AccountStoreConflictError
+from sqlite_connection_pool import SqliteConnectionPool
+
+# Statements are kept as constants, so that the sqlite3 module's statement cache can reuse the prepared statements
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS accounts (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    balance INTEGER NOT NULL CHECK (balance >= 0),
+    version INTEGER NOT NULL DEFAULT 0
+)"""
+_ADD_VERSION_COLUMN = "ALTER TABLE accounts ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+_CREATE_USER_INDEX = "CREATE INDEX IF NOT EXISTS accounts_user_id ON accounts (user_id, seq)"
+# Per-user aggregates, kept up to date by triggers in the same transaction as the accounts they sum up
+_HAS_SUMMARY_TABLE = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_summaries'"
+_CREATE_SUMMARY_TABLE = """
+CREATE TABLE user_summaries (
+    user_id TEXT PRIMARY KEY,
+    account_count INTEGER NOT NULL,
+    total_balance INTEGER NOT NULL
+)"""
+_FILL_SUMMARY_TABLE = "INSERT INTO user_summaries SELECT user_id, count(*), sum(balance) FROM accounts GROUP BY user_id"
+_CREATE_INSERT_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS accounts_summary_insert AFTER INSERT ON accounts BEGIN
+    INSERT INTO user_summaries (user_id, account_count, total_balance) VALUES (NEW.user_id, 1, NEW.balance)
+    ON CONFLICT (user_id) DO UPDATE SET account_count = account_count + 1, total_balance = total_balance + NEW.balance;
+END"""
+_CREATE_UPDATE_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS accounts_summary_update AFTER UPDATE OF balance ON accounts BEGIN
+    UPDATE user_summaries SET total_balance = total_balance + NEW.balance - OLD.balance WHERE user_id = NEW.user_id;
+END"""
+_SELECT_SUMMARY = "SELECT user_id, account_count, total_balance FROM user_summaries WHERE user_id = ?"
+_SELECT_SUMMARIES = "SELECT user_id, account_count, total_balance FROM user_summaries"
+_INSERT = "INSERT INTO accounts (id, user_id, balance) VALUES (?, ?, ?)"
+# Only updates the row if nobody has changed it since it was read, which is what keeps separate worker processes from overwriting each other's transfers
+_UPDATE = "UPDATE accounts SET balance = ?, version = version + 1 WHERE id = ? AND version = ?"
+_EXISTS = "SELECT 1 FROM accounts WHERE id = ?"
+_SELECT = "SELECT id, user_id, balance, version FROM accounts WHERE id = ?"
+_SELECT_FOR_USER = "SELECT id, user_id, balance, version FROM accounts WHERE id = ? AND user_id = ?"
+_SELECT_ALL_FOR_USER = "SELECT id, user_id, balance, version FROM accounts WHERE user_id = ? ORDER BY seq"
+_SELECT_SEQ_FOR_USER = "SELECT seq FROM accounts WHERE id = ? AND user_id = ?"
+_SELECT_PAGE_FOR_USER = "SELECT id, user_id, balance, version FROM accounts WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?"
+
+def _to_account(row: sqlite3.Row) -> Account:
+    return Account(id=row["id"], user_id=row["user_id"], balance=row["balance"], version=row["version"])
+
+def _to_summary(row: sqlite3.Row) -> UserSummary:
+    return UserSummary(user_id=row["user_id"], account_count=row["account_count"], total_balance=row["total_balance"])
+
+class SqliteAccountStore(AccountStore):
+    """ Account store that keeps accounts in a SQLite database. Several processes can share the same database file."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.__pool = SqliteConnectionPool(path)
+        connection = self.__pool.connection()
+        connection.execute(_CREATE_TABLE)
+        if "version" not in [column["name"] for column in connection.execute("PRAGMA table_info(accounts)")]:
+            connection.execute(_ADD_VERSION_COLUMN)
+        connection.execute(_CREATE_USER_INDEX)
+        # Databases from before the summaries existed get them filled in once, in the same transaction that starts maintaining them
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if not connection.execute(_HAS_SUMMARY_TABLE).fetchone():
+                connection.execute(_CREATE_SUMMARY_TABLE)
+                connection.execute(_FILL_SUMMARY_TABLE)
+            connection.execute(_CREATE_INSERT_TRIGGER)
+            connection.execute(_CREATE_UPDATE_TRIGGER)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def create_account(self, user_id: str, initial_balance: int):
+        account = Account(id=str(uuid.uuid4()), user_id=user_id, balance=initial_balance)
+        try:
+            self.__pool.connection().execute(_INSERT, (account.id, account.user_id, account.balance))
+        except sqlite3.Error as e:
+            raise AccountStoreCreateError(e) from e
+        return account
+
+    def create_accounts(self, user_id: str, initial_balances: list[int]):
+        accounts = [Account(id=str(account_id), user_id=user_id, balance=balance) for account_id, balance in zip(new_account_ids(len(initial_balances)), initial_balances)]
+        connection = self.__pool.connection()
+        try:
+            # One transaction for the whole batch, so it costs a single commit, and a failure leaves none of the accounts behind
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany(_INSERT, ((account.id, account.user_id, account.balance) for account in accounts))
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            raise AccountStoreCreateError(e) from e
+        return accounts
+
+    def update_account(self, account: Account):
+        self.update_accounts([account])
+
+    def update_accounts(self, accounts: list[Account]):
+        connection = self.__pool.connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for account in accounts:
+                    if connection.execute(_UPDATE, (account.balance, account.id, account.version)).rowcount != 1:
+                        if connection.execute(_EXISTS, (account.id,)).fetchone():
+                            raise AccountStoreConflictError(None)
+                        raise KeyError(account.id)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        except (sqlite3.Error, KeyError) as e:
+            raise AccountStoreUpdateError(e) from e
+
+    def get_account(self, account_id: str, user_id: str = None):
+        try:
+            if user_id:
+                row = self.__pool.connection().execute(_SELECT_FOR_USER, (account_id, user_id)).fetchone()
+            else:
+                row = self.__pool.connection().execute(_SELECT, (account_id,)).fetchone()
+        except sqlite3.Error as e:
+            raise AccountStoreGetError(e) from e
+        return _to_account(row) if row else None
+
+    def get_accounts(self, user_id: str):
+        try:
+            rows = self.__pool.connection().execute(_SELECT_ALL_FOR_USER, (user_id,)).fetchall()
+        except sqlite3.Error as e:
+            raise AccountStoreGetError(e) from e
+        return [_to_account(row) for row in rows]
+
+    def get_accounts_page(self, user_id: str, limit: int, after: str = None):
+        connection = self.__pool.connection()
+        try:
+            after_seq = 0
+            if after is not None:
+                row = connection.execute(_SELECT_SEQ_FOR_USER, (after, user_id)).fetchone()
+                if not row:
+                    return None
+                after_seq = row["seq"]
+            # Served straight from the (user_id, seq) index, so a page costs the same wherever it starts
+            rows = connection.execute(_SELECT_PAGE_FOR_USER, (user_id, after_seq, limit)).fetchall()
+        except sqlite3.Error as e:
+            raise AccountStoreGetError(e) from e
+        return [_to_account(row) for row in rows]
+
+    def get_user_summary(self, user_id: str):
+        try:
+            row = self.__pool.connection().execute(_SELECT_SUMMARY, (user_id,)).fetchone()
+        except sqlite3.Error as e:
+            raise AccountStoreGetError(e) from e
+        return _to_summary(row) if row else UserSummary(user_id)
+
+    def get_user_summaries(self):
+        try:
+            rows = self.__pool.connection().execute(_SELECT_SUMMARIES).fetchall()
+        except sqlite3.Error as e:
+            raise AccountStoreGetError(e) from e
+        return [_to_summary(row) for row in rows]
+
+    def close(self):
+        """ Closes all connections to the database """
+        self.__pool.close()
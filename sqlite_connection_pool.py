@@ -0,0 +1,42 @@
+""" This module implements a small per-thread pool of SQLite connections, shared by the SQLite stores """
+import sqlite3
+import threading
+
+class SqliteConnectionPool():
+    """ Hands out one connection per thread, all opened against the same database file in WAL mode.
+    WAL lets readers in other threads and processes keep going while a writer holds the write lock."""
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        self.__local = threading.local()
+        self.__connections: list[sqlite3.Connection] = []
+        self.__lock = threading.Lock()
+        with self.__lock:
+            # WAL is a property of the database file, so setting it once is enough
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.close()
+
+    def connection(self) -> sqlite3.Connection:
+        """ Returns the connection belonging to the calling thread, opening it on first use """
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            # isolation_level=None leaves transactions to us, so that they can be started with BEGIN IMMEDIATE.
+            # Each connection is only used by its own thread, but close() may be called from any thread.
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, cached_statements=256, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self.__local.connection = connection
+            with self.__lock:
+                self.__connections.append(connection)
+        return connection
+
+    def close(self):
+        """ Closes every connection handed out by the pool """
+        with self.__lock:
+            for connection in self.__connections:
+                connection.close()
+            self.__connections.clear()
+        self.__local = threading.local()
@@ -0,0 +1,88 @@
+""" This module implements IdempotencyStore on top of a SQLite database """
+import json
+import sqlite3
+import time
+from idempotency_store import IdempotencyStore, IdempotencyStoreError, PendingRequest, StoredResponse
+from sqlite_connection_pool import SqliteConnectionPool
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    user_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    status_code INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    claimed_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, key)
+)"""
+# Databases created before keys were claimed lack the column
+_ADD_CLAIMED_AT = "ALTER TABLE idempotency_keys ADD COLUMN claimed_at REAL NOT NULL DEFAULT 0"
+_CREATE_EXPIRY_INDEX = "CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at ON idempotency_keys (expires_at)"
+# No response has status code 0, so it marks a claim whose response isn't stored yet
+_PENDING = 0
+_SELECT = "SELECT fingerprint, status_code, body, claimed_at FROM idempotency_keys WHERE user_id = ? AND key = ? AND expires_at > ?"
+_INSERT = "INSERT OR REPLACE INTO idempotency_keys (user_id, key, fingerprint, status_code, body, expires_at, claimed_at) VALUES (?, ?, ?, ?, ?, ?, ?)"
+_DELETE_PENDING = f"DELETE FROM idempotency_keys WHERE user_id = ? AND key = ? AND status_code = {_PENDING}"
+_DELETE_EXPIRED = "DELETE FROM idempotency_keys WHERE expires_at <= ?"
+
+def _to_response(row: sqlite3.Row) -> StoredResponse | PendingRequest:
+    if row["status_code"] == _PENDING:
+        return PendingRequest(row["fingerprint"], row["claimed_at"])
+    return StoredResponse(row["fingerprint"], row["status_code"], json.loads(row["body"]))
+
+class SqliteIdempotencyStore(IdempotencyStore):
+    """ Keeps responses in the same SQLite database as the accounts, so that keys survive restarts and are shared by all workers.
+    A key is claimed with a pending row before its request runs, under the database's write lock, so only one worker ever runs it.
+    Expired keys are deleted every purge_interval writes."""
+
+    def __init__(self, path: str, ttl_seconds: float = 24 * 60 * 60, purge_interval: int = 1000):
+        super().__init__()
+        self.__ttl_seconds = ttl_seconds
+        self.__purge_interval = purge_interval
+        self.__writes = 0
+        self.__pool = SqliteConnectionPool(path)
+        connection = self.__pool.connection()
+        connection.execute(_CREATE_TABLE)
+        if "claimed_at" not in {column["name"] for column in connection.execute("PRAGMA table_info(idempotency_keys)")}:
+            connection.execute(_ADD_CLAIMED_AT)
+        connection.execute(_CREATE_EXPIRY_INDEX)
+
+    def claim(self, user_id: str, key: str, fingerprint: str):
+        now = time.time()
+        connection = self.__pool.connection()
+        try:
+            # The write lock is taken up front, so that no other worker can claim the key between the lookup and the insert
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(_SELECT, (user_id, key, now)).fetchone()
+                if row is None:
+                    connection.execute(_INSERT, (user_id, key, fingerprint, _PENDING, "", now + self.__ttl_seconds, now))
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            raise IdempotencyStoreError(e) from e
+        return _to_response(row) if row else None
+
+    def put_response(self, user_id: str, key: str, response: StoredResponse):
+        now = time.time()
+        connection = self.__pool.connection()
+        try:
+            connection.execute(_INSERT, (user_id, key, response.fingerprint, response.status_code, json.dumps(response.body), now + self.__ttl_seconds, now))
+            self.__writes += 1
+            if self.__writes % self.__purge_interval == 0:
+                connection.execute(_DELETE_EXPIRED, (now,))
+        except sqlite3.Error as e:
+            raise IdempotencyStoreError(e) from e
+
+    def release(self, user_id: str, key: str):
+        try:
+            self.__pool.connection().execute(_DELETE_PENDING, (user_id, key))
+        except sqlite3.Error as e:
+            raise IdempotencyStoreError(e) from e
+
+    def close(self):
+        """ Closes all connections to the database """
+        self.__pool.close()
@@ -0,0 +1,77 @@
+""" This module implements TransactionStore on top of a SQLite database """
+from datetime import datetime, timezone
+import sqlite3
+from transaction_store import TransactionStore, TransactionStoreError, Transaction, format_timestamp
+from sqlite_connection_pool import SqliteConnectionPool
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    account_id TEXT NOT NULL,
+    counterparty_account_id TEXT,
+    amount INTEGER NOT NULL,
+    balance INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+)"""
+# Range queries seek straight to the first transaction of the account at or after a time, and read the page from there in order
+_CREATE_ACCOUNT_INDEX = "CREATE INDEX IF NOT EXISTS transactions_account_id_created_at ON transactions (account_id, created_at, id)"
+_SELECT_LAST = "SELECT id, created_at FROM transactions ORDER BY id DESC LIMIT 1"
+_INSERT = "INSERT INTO transactions (id, account_id, counterparty_account_id, amount, balance, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+_SELECT_CURSOR = "SELECT created_at FROM transactions WHERE id = ? AND account_id = ?"
+_SELECT_PAGE = """
+SELECT id, account_id, counterparty_account_id, amount, balance, created_at FROM transactions
+WHERE account_id = ? AND created_at >= ? AND created_at < ? AND id > ? ORDER BY created_at, id LIMIT ?"""
+# Sorts after every timestamp, for queries without an end
+_END_OF_TIME = "~"
+
+def _to_transaction(row: sqlite3.Row) -> Transaction:
+    return Transaction(account_id=row["account_id"], counterparty_account_id=row["counterparty_account_id"], amount=row["amount"],
+                       balance=row["balance"], created_at=row["created_at"], id=row["id"])
+
+class SqliteTransactionStore(TransactionStore):
+    """ Keeps transactions in the same SQLite database as the accounts, so that history survives restarts and is shared by all workers """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.__pool = SqliteConnectionPool(path)
+        connection = self.__pool.connection()
+        connection.execute(_CREATE_TABLE)
+        connection.execute(_CREATE_ACCOUNT_INDEX)
+
+    def add_transactions(self, transactions: list[Transaction]):
+        connection = self.__pool.connection()
+        try:
+            # The write lock is taken up front, so that ids and times are handed out in the same order across all workers
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                last = connection.execute(_SELECT_LAST).fetchone()
+                last_id, last_created_at = (last["id"], last["created_at"]) if last else (0, "")
+                created_at = max(format_timestamp(datetime.now(timezone.utc)), last_created_at)
+                for transaction_id, transaction in enumerate(transactions, last_id + 1):
+                    transaction.id = transaction_id
+                    transaction.created_at = created_at
+                connection.executemany(_INSERT, ((t.id, t.account_id, t.counterparty_account_id, t.amount, t.balance, t.created_at) for t in transactions))
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            raise TransactionStoreError(e) from e
+
+    def get_transactions(self, account_id: str, start: str | None, end: str | None, limit: int, after: int = None):
+        connection = self.__pool.connection()
+        try:
+            start = start or ""
+            if after is not None:
+                row = connection.execute(_SELECT_CURSOR, (after, account_id)).fetchone()
+                if row is None:
+                    return None
+                start = max(start, row["created_at"])
+            rows = connection.execute(_SELECT_PAGE, (account_id, start, end or _END_OF_TIME, after or 0, limit)).fetchall()
+        except sqlite3.Error as e:
+            raise TransactionStoreError(e) from e
+        return [_to_transaction(row) for row in rows]
+
+    def close(self):
+        """ Closes all connections to the database """
+        self.__pool.close()
@@ -0,0 +1,57 @@
+""" This module implements UserStore on top of a SQLite database """
+import sqlite3
+import uuid
+from user_store import UserStore, StoredUser, UserStoreGetError, UserStoreCreateError
+from sqlite_connection_pool import SqliteConnectionPool
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    hashed_pwd TEXT NOT NULL
+)"""
+_CREATE_USERNAME_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username)"
+_INSERT = "INSERT INTO users (id, username, hashed_pwd) VALUES (?, ?, ?)"
+_INSERT_IF_ABSENT = "INSERT INTO users (id, username, hashed_pwd) VALUES (?, ?, ?) ON CONFLICT (username) DO NOTHING"
+_SELECT_BY_USERNAME = "SELECT id, username, hashed_pwd FROM users WHERE username = ?"
+
+def _to_user(row: sqlite3.Row) -> StoredUser:
+    return StoredUser(row["id"], row["username"], row["hashed_pwd"])
+
+class SqliteUserStore(UserStore):
+    """ User store that keeps users in a SQLite database. Several processes can share the same database file."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.__pool = SqliteConnectionPool(path)
+        connection = self.__pool.connection()
+        connection.execute(_CREATE_TABLE)
+        connection.execute(_CREATE_USERNAME_INDEX)
+
+    def create_user(self, username: str, hashed_pwd: bytes):
+        user = StoredUser(str(uuid.uuid4()), username, hashed_pwd)
+        try:
+            self.__pool.connection().execute(_INSERT, (user.id, user.username, user.hashed_pwd))
+        except sqlite3.Error as e:
+            raise UserStoreCreateError(e) from e
+        return user
+
+    def create_user_if_absent(self, username: str, hashed_pwd: bytes):
+        user = StoredUser(str(uuid.uuid4()), username, hashed_pwd)
+        try:
+            # The unique index on username makes the existence check and the insert a single atomic statement
+            inserted = self.__pool.connection().execute(_INSERT_IF_ABSENT, (user.id, user.username, user.hashed_pwd)).rowcount
+        except sqlite3.Error as e:
+            raise UserStoreCreateError(e) from e
+        return user if inserted == 1 else None
+
+    def get_user(self, username: str):
+        try:
+            row = self.__pool.connection().execute(_SELECT_BY_USERNAME, (username,)).fetchone()
+        except sqlite3.Error as e:
+            raise UserStoreGetError(e) from e
+        return _to_user(row) if row else None
+
+    def close(self):
+        """ Closes all connections to the database """
+        self.__pool.close()
@@ -0,0 +1,76 @@
+""" This module picks the stores the service runs on, based on its configuration.
+Store modules are imported by create_stores(), so a worker only loads the stores it is configured with """
+from user_store import UserStore
+from account_store import AccountStore
+from idempotency_store import IdempotencyStore
+from transaction_store import TransactionStore
+from metrics import InstrumentedStore
+
+def create_stores(config) -> tuple[UserStore, AccountStore, IdempotencyStore, TransactionStore]:
+    """ Creates the user, account, idempotency and transaction stores for config, each wrapped in an InstrumentedStore """
+    # Setting SQLITE_DATABASE_PATH makes every worker share one durable database. Otherwise each process keeps its own data in memory.
+    # Setting SHARED_ACCOUNTS_PATH makes every worker on the machine share the accounts in one memory-mapped file, and everything else in SQLite, see shared_database_path()
+    database_path = shared_database_path(config)
+    if database_path:
+        from sqlite_user_store import SqliteUserStore
+        user_store = SqliteUserStore(database_path)
+    else:
+        from in_memory_user_store import InMemoryUserStore
+        user_store = InMemoryUserStore()
+    if config.get("SHARED_ACCOUNTS_PATH"):
+        from shared_memory_account_store import SharedMemoryAccountStore
+        account_store = SharedMemoryAccountStore(config["SHARED_ACCOUNTS_PATH"], capacity=config.get("SHARED_ACCOUNTS_CAPACITY", 1000000))
+    elif config.get("SQLITE_DATABASE_PATH"):
+        from sqlite_account_store import SqliteAccountStore
+        account_store = SqliteAccountStore(config["SQLITE_DATABASE_PATH"])
+    elif config.get("LEDGER_PATH"):
+        from ledger_account_store import LedgerAccountStore
+        account_store = LedgerAccountStore(config["LEDGER_PATH"])
+    elif config.get("COMPACT_ACCOUNT_STORE"):
+        from compact_account_store import CompactAccountStore
+        account_store = CompactAccountStore()
+    else:
+        from in_memory_account_store import InMemoryAccountStore
+        account_store = InMemoryAccountStore()
+
+    # Responses to requests with an Idempotency-Key are kept for IDEMPOTENCY_TTL_SECONDS, in the SQLite database if there is one
+    idempotency_ttl = config.get("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60)
+    if database_path:
+        from sqlite_idempotency_store import SqliteIdempotencyStore
+        idempotency_store = SqliteIdempotencyStore(database_path, ttl_seconds=idempotency_ttl)
+    else:
+        from in_memory_idempotency_store import InMemoryIdempotencyStore
+        idempotency_store = InMemoryIdempotencyStore(max_entries=config.get("IDEMPOTENCY_CACHE_SIZE", 100000), ttl_seconds=idempotency_ttl)
+
+    # Transaction history lives as long as the balances do, and is shared by the same workers
+    transactions_path = transactions_database_path(config)
+    if transactions_path:
+        from sqlite_transaction_store import SqliteTransactionStore
+        transaction_store = SqliteTransactionStore(transactions_path)
+    else:
+        from in_memory_transaction_store import InMemoryTransactionStore
+        transaction_store = InMemoryTransactionStore(max_transactions=config.get("TRANSACTION_HISTORY_SIZE", 1000000))
+
+    return InstrumentedStore(user_store), InstrumentedStore(account_store), InstrumentedStore(idempotency_store), InstrumentedStore(transaction_store)
+
+def shared_database_path(config) -> str | None:
+    """ The SQLite database of users and idempotency keys: SQLITE_DATABASE_PATH, or with only SHARED_ACCOUNTS_PATH, a database next to the shared memory file.
+    Accounts shared by every worker need users that are too, or a user signed up on one worker couldn't sign in on the next.
+    None when every worker keeps its own data in memory """
+    if config.get("SQLITE_DATABASE_PATH"):
+        return config["SQLITE_DATABASE_PATH"]
+    return f"{config['SHARED_ACCOUNTS_PATH']}.db" if config.get("SHARED_ACCOUNTS_PATH") else None
+
+def transactions_database_path(config) -> str | None:
+    """ The SQLite database that keeps the transaction history: TRANSACTIONS_DATABASE_PATH, or else the database of shared_database_path().
+    Without one, a ledger gets a database next to it, so its history survives restarts like its balances.
+    None when the accounts themselves only live in each worker's memory """
+    database_path = config.get("TRANSACTIONS_DATABASE_PATH") or shared_database_path(config)
+    if database_path:
+        return database_path
+    return f"{config['LEDGER_PATH']}.transactions.db" if config.get("LEDGER_PATH") else None
+
+def stores_block_on_io(config) -> bool:
+    """ Whether calls to the stores from create_stores(config) may wait on the disk, rather than only touch memory """
+    # A shared memory file only touches memory itself, but its transfers wait on the other processes' locks, and its history is in SQLite
+    return bool(config.get("SQLITE_DATABASE_PATH") or config.get("LEDGER_PATH") or config.get("SHARED_ACCOUNTS_PATH") or config.get("TRANSACTIONS_DATABASE_PATH"))
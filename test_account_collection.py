@@ -1,18 +1,47 @@
 """ This module tests the AccountCollection class"""
+import os
 import uuid
+import random
+import threading
+import multiprocessing
 from dataclasses import dataclass
 import pytest
-from account_collection import AccountCollection, InvalidInitialBalanceError, AccountNotFoundError, SelfTransferError, IllegalTransferAmountError
+from account_collection import AccountCollection, InvalidInitialBalanceError, AccountNotFoundError, SelfTransferError, IllegalTransferAmountError, TransferRequest, EmptyBatchError, InvalidPageLimitError, InvalidCursorError, InvalidAccountBatchError, TransferBatchTooLargeError
 from in_memory_account_store import InMemoryAccountStore, Account
+from sqlite_account_store import SqliteAccountStore
+from ledger_account_store import LedgerAccountStore, LedgerInUseError
+from compact_account_store import CompactAccountStore
+from shared_memory_account_store import SharedMemoryAccountStore
+from account_store import AccountStoreConflictError, AccountStoreUpdateError, UserSummary
+import sqlite3
 
 @dataclass
 class TestUser:
     id: str
     account: Account
 
+@pytest.fixture(params=["in_memory", "compact", "sqlite", "ledger", "shared"])
+def account_store(request, tmp_path):
+    if request.param == "shared":
+        store = SharedMemoryAccountStore(str(tmp_path / "accounts.shm"), capacity=20000)
+        yield store
+        store.close()
+    elif request.param == "sqlite":
+        store = SqliteAccountStore(str(tmp_path / "accounts.db"))
+        yield store
+        store.close()
+    elif request.param == "ledger":
+        store = LedgerAccountStore(str(tmp_path / "accounts.ledger"), snapshot_interval=3, fsync=False)
+        yield store
+        store.close()
+    elif request.param == "compact":
+        yield CompactAccountStore()
+    else:
+        yield InMemoryAccountStore()
+
 @pytest.fixture
-def empty_account_collection():    
-    return AccountCollection(InMemoryAccountStore())
+def empty_account_collection(account_store):    
+    return AccountCollection(account_store)
 
 def test_listing_accounts_for_user_before_creating_any_yields_empty_list(empty_account_collection):
     user_id = str(uuid.uuid4())
@@ -50,8 +79,8 @@ def test_cannot_create_account_with_not_a_number_balance(empty_account_collectio
     assert exc_info.value.payload["balance"] == "5"
 
 @pytest.fixture
-def account_collection_with_single_account():
-    account_collection = AccountCollection(InMemoryAccountStore())
+def account_collection_with_single_account(account_store):
+    account_collection = AccountCollection(account_store)
     user_id = str(uuid.uuid4())
     account = account_collection.create_account(user_id, 5)
     return (user_id, account.id, account_collection)
@@ -78,8 +107,8 @@ def test_user_cannot_get_non_existent_account(account_collection_with_single_acc
     assert exc_info.value.payload["account_id"] == non_existing_account_id
 
 @pytest.fixture
-def account_collection_with_accounts_for_two_users():
-    account_collection = AccountCollection(InMemoryAccountStore())
+def account_collection_with_accounts_for_two_users(account_store):
+    account_collection = AccountCollection(account_store)
     user1_id = str(uuid.uuid4())
     account1 = account_collection.create_account(user1_id, 5)
     user1 = TestUser(user1_id, account1)
@@ -184,4 +213,450 @@ def test_user_cannot_transfer_amount_that_would_leave_account_with_negative_bala
     with pytest.raises(IllegalTransferAmountError) as exc_info:
         collection.transfer(user1.id, user1.account.id, user2.account.id, 6)
     assert exc_info.value.payload['amount'] == 6
-    assert exc_info.value.payload['balance'] == 5
\ No newline at end of file
+    assert exc_info.value.payload['balance'] == 5
+
+def test_listing_accounts_returns_all_of_a_users_accounts_in_creation_order(account_collection_with_accounts_for_two_users):
+    user1, _, collection = account_collection_with_accounts_for_two_users
+    second_account = collection.create_account(user1.id, 7)
+    third_account = collection.create_account(user1.id, 9)
+
+    accounts = collection.get_user_accounts(user1.id)
+    assert([account.id for account in accounts] == [user1.account.id, second_account.id, third_account.id])
+
+def test_transfer_bumps_the_version_of_both_accounts(account_collection_with_accounts_for_two_users):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+    assert(user1.account.version == 0)
+
+    returned_account = collection.transfer(user1.id, user1.account.id, user2.account.id, 1)
+
+    assert(returned_account.version == 1)
+    assert(collection.get_user_account(user1.id, user1.account.id).version == 1)
+    assert(collection.get_user_account(user2.id, user2.account.id).version == 1)
+
+def test_store_rejects_an_update_based_on_a_stale_version(account_store):
+    account = account_store.create_account(str(uuid.uuid4()), 5)
+    stale_account = Account(account.id, account.user_id, 5, version=0)
+    account_store.update_account(Account(account.id, account.user_id, 4, version=0))
+
+    with pytest.raises(AccountStoreConflictError):
+        account_store.update_account(Account(stale_account.id, stale_account.user_id, 3, version=stale_account.version))
+    assert(account_store.get_account(account.id).balance == 4)
+
+def test_store_only_finds_accounts_by_their_id_as_handed_out(account_store):
+    account = account_store.create_account(str(uuid.uuid4()), 5)
+
+    for spelling in [account.id.upper(), "{" + account.id + "}", account.id.replace("-", ""), "urn:uuid:" + account.id]:
+        assert(account_store.get_account(spelling) is None)
+    assert(account_store.get_account(account.id).balance == 5)
+
+
+# PAGINATION TESTS
+def test_user_can_page_through_all_of_their_accounts(account_collection_with_accounts_for_two_users):
+    user1, _, collection = account_collection_with_accounts_for_two_users
+    account_ids = [user1.account.id] + [collection.create_account(user1.id, i).id for i in range(6)]
+
+    pages = []
+    after = None
+    while True:
+        page = collection.get_user_accounts_page(user1.id, 3, after)
+        pages.append([account.id for account in page])
+        if len(page) < 3:
+            break
+        after = page[-1].id
+
+    assert(pages == [account_ids[0:3], account_ids[3:6], account_ids[6:7]])
+    assert([account.id for account in collection.iter_user_accounts(user1.id, page_size=2)] == account_ids)
+
+def test_user_cannot_page_from_another_users_account(account_collection_with_accounts_for_two_users):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+
+    with pytest.raises(InvalidCursorError) as exc_info:
+        collection.get_user_accounts_page(user1.id, 10, user2.account.id)
+    assert exc_info.value.payload['after'] == user2.account.id
+
+@pytest.mark.parametrize("limit", [0, -1, 1001, "10"])
+def test_user_cannot_request_a_page_with_an_illegal_limit(account_collection_with_single_account, limit):
+    user_id, _, collection = account_collection_with_single_account
+
+    with pytest.raises(InvalidPageLimitError) as exc_info:
+        collection.get_user_accounts_page(user_id, limit)
+    assert exc_info.value.payload['limit'] == limit
+
+
+# BATCH TRANSFER TESTS
+def test_user_can_perform_a_batch_of_legal_transfers(account_collection_with_accounts_for_two_users):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+    second_account = collection.create_account(user1.id, 0)
+
+    collection.transfer_many(user1.id, [
+        TransferRequest(user1.account.id, second_account.id, 3),
+        TransferRequest(second_account.id, user2.account.id, 2),
+    ])
+
+    assert(collection.get_user_account(user1.id, user1.account.id).balance == 2)
+    assert(collection.get_user_account(user1.id, second_account.id).balance == 1)
+    assert(collection.get_user_account(user2.id, user2.account.id).balance == 7)
+
+def test_batch_with_one_illegal_transfer_leaves_all_accounts_untouched(account_collection_with_accounts_for_two_users):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+
+    with pytest.raises(IllegalTransferAmountError) as exc_info:
+        collection.transfer_many(user1.id, [
+            TransferRequest(user1.account.id, user2.account.id, 3),
+            TransferRequest(user1.account.id, user2.account.id, 3),
+        ])
+    assert exc_info.value.payload['amount'] == 3
+    assert exc_info.value.payload['balance'] == 2
+
+    assert(collection.get_user_account(user1.id, user1.account.id).balance == 5)
+    assert(collection.get_user_account(user2.id, user2.account.id).balance == 5)
+
+def test_user_cannot_batch_transfer_from_another_users_account(account_collection_with_accounts_for_two_users):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+
+    with pytest.raises(AccountNotFoundError) as exc_info:
+        collection.transfer_many(user1.id, [TransferRequest(user2.account.id, user1.account.id, 1)])
+    assert exc_info.value.payload['account_id'] == user2.account.id
+
+def test_user_cannot_submit_an_empty_batch(account_collection_with_accounts_for_two_users):
+    user1, _, collection = account_collection_with_accounts_for_two_users
+
+    with pytest.raises(EmptyBatchError):
+        collection.transfer_many(user1.id, [])
+
+def test_user_cannot_submit_a_batch_above_the_limit(account_collection_with_accounts_for_two_users, monkeypatch):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+    monkeypatch.setattr(AccountCollection, "max_transfer_batch", 2)
+
+    with pytest.raises(TransferBatchTooLargeError) as exc_info:
+        collection.transfer_many(user1.id, [TransferRequest(user1.account.id, user2.account.id, 1)] * 3)
+    assert exc_info.value.payload['count'] == 3
+    assert(collection.get_user_account(user1.id, user1.account.id).balance == 5)
+
+
+# BULK CREATION TESTS
+def test_user_can_create_accounts_in_bulk(account_collection_with_single_account):
+    (user_id, account_id, account_collection) = account_collection_with_single_account
+    accounts = account_collection.create_accounts(user_id, [1, 0, 3])
+    assert([account.balance for account in accounts] == [1, 0, 3])
+    assert(len({account.id for account in accounts}) == 3)
+    assert([account.id for account in account_collection.get_user_accounts(user_id)] == [account_id] + [account.id for account in accounts])
+    assert([account.id for account in account_collection.get_user_accounts_page(user_id, 2, accounts[0].id)] == [accounts[1].id, accounts[2].id])
+    account_collection.transfer(user_id, accounts[2].id, account_id, 3)
+    assert(account_collection.get_user_account(user_id, account_id).balance == 8)
+
+@pytest.mark.parametrize("balances", [[], [1, -1], [1, 2.5], "5", [0] * 10001])
+def test_bulk_creation_with_an_illegal_balance_creates_nothing(account_collection_with_single_account, balances):
+    (user_id, account_id, account_collection) = account_collection_with_single_account
+    with pytest.raises((InvalidAccountBatchError, InvalidInitialBalanceError)):
+        account_collection.create_accounts(user_id, balances)
+    assert([account.id for account in account_collection.get_user_accounts(user_id)] == [account_id])
+
+# SUMMARY TESTS
+def test_user_summaries_follow_creation_and_transfers(account_collection_with_accounts_for_two_users):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+    assert(collection.get_user_summary(user1.id) == UserSummary(user1.id, 1, 5))
+    assert(collection.get_user_summary("no-such-user") == UserSummary("no-such-user", 0, 0))
+
+    collection.transfer(user1.id, user1.account.id, user2.account.id, 2)
+    accounts = collection.create_accounts(user1.id, [10, 20])
+    collection.transfer_many(user1.id, [TransferRequest(accounts[0].id, user2.account.id, 4), TransferRequest(accounts[1].id, user1.account.id, 5)])
+
+    assert(collection.get_user_summary(user1.id) == UserSummary(user1.id, 3, 29))
+    assert(collection.get_user_summary(user2.id) == UserSummary(user2.id, 1, 11))
+    assert(collection.verify_user_summaries() == [])
+
+def test_verification_reports_a_drifted_summary(tmp_path):
+    path = str(tmp_path / "accounts.db")
+    collection = AccountCollection(SqliteAccountStore(path))
+    user_id = str(uuid.uuid4())
+    collection.create_accounts(user_id, [3, 4])
+    with sqlite3.connect(path) as connection:
+        connection.execute("UPDATE user_summaries SET total_balance = 100")
+
+    drifts = collection.verify_user_summaries()
+    assert([(drift.user_id, drift.stored, drift.actual) for drift in drifts] == [(user_id, UserSummary(user_id, 2, 100), UserSummary(user_id, 2, 7))])
+
+def test_sqlite_store_fills_in_summaries_for_an_existing_database(tmp_path):
+    path = str(tmp_path / "accounts.db")
+    collection = AccountCollection(SqliteAccountStore(path))
+    user_id = str(uuid.uuid4())
+    collection.create_accounts(user_id, [3, 4])
+    with sqlite3.connect(path) as connection:
+        connection.executescript("DROP TRIGGER accounts_summary_insert; DROP TRIGGER accounts_summary_update; DROP TABLE user_summaries")
+
+    reopened_collection = AccountCollection(SqliteAccountStore(path))
+    assert(reopened_collection.get_user_summary(user_id) == UserSummary(user_id, 2, 7))
+
+# DURABILITY TESTS
+@pytest.mark.parametrize("snapshot_interval", [1, 4, 1000])
+def test_ledger_store_restores_accounts_after_restart(tmp_path, snapshot_interval):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, snapshot_interval=snapshot_interval, fsync=False)
+    collection = AccountCollection(store)
+    user_id = str(uuid.uuid4())
+    account1 = collection.create_account(user_id, 5)
+    account2 = collection.create_account(user_id, 5)
+    for _ in range(3):
+        collection.transfer(user_id, account1.id, account2.id, 1)
+    account3, account4 = collection.create_accounts(user_id, [6, 7])
+    store.close()
+
+    restarted_collection = AccountCollection(LedgerAccountStore(path, snapshot_interval=snapshot_interval, fsync=False))
+    accounts = restarted_collection.get_user_accounts(user_id)
+    assert([(account.id, account.balance) for account in accounts] == [(account1.id, 2), (account2.id, 8), (account3.id, 6), (account4.id, 7)])
+    assert(restarted_collection.get_user_summary(user_id) == UserSummary(user_id, 4, 23))
+
+def test_ledger_store_ignores_a_torn_record_at_the_end_of_the_ledger(tmp_path):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, fsync=False)
+    collection = AccountCollection(store)
+    user_id = str(uuid.uuid4())
+    account = collection.create_account(user_id, 5)
+    collection.create_account(user_id, 7)
+    store.close()
+
+    with open(path, "r+b") as ledger_file:
+        ledger_file.truncate(ledger_file.seek(0, 2) - 3)
+
+    restarted_collection = AccountCollection(LedgerAccountStore(path, fsync=False))
+    assert([a.id for a in restarted_collection.get_user_accounts(user_id)] == [account.id])
+    new_account = restarted_collection.create_account(user_id, 1)
+    assert([a.id for a in restarted_collection.get_user_accounts(user_id)] == [account.id, new_account.id])
+
+def test_ledger_store_cuts_off_a_record_that_failed_to_sync(tmp_path, monkeypatch):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path)
+    user_id = str(uuid.uuid4())
+    account = store.create_account(user_id, 5)
+    size = os.path.getsize(path)
+
+    def failing_fsync(fd):
+        raise OSError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "fsync", failing_fsync)
+        with pytest.raises(AccountStoreUpdateError):
+            store.update_account(Account(account.id, user_id, 9, account.version))
+    assert(os.path.getsize(path) == size)
+    store.update_account(Account(account.id, user_id, 8, account.version))
+    store.close()
+
+    restarted_store = LedgerAccountStore(path)
+    assert(restarted_store.get_account(account.id).balance == 8)
+
+def test_ledger_store_goes_on_from_the_snapshot_when_the_ledger_is_gone(tmp_path):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, snapshot_interval=1, fsync=False)
+    collection = AccountCollection(store)
+    user_id = str(uuid.uuid4())
+    account1, account2 = collection.create_accounts(user_id, [5, 5])
+    store.close()
+    os.remove(path)
+
+    store = LedgerAccountStore(path, snapshot_interval=1000, fsync=False)
+    AccountCollection(store).transfer(user_id, account1.id, account2.id, 2)
+    store.close()
+    restarted_collection = AccountCollection(LedgerAccountStore(path, fsync=False))
+    assert([a.balance for a in restarted_collection.get_user_accounts(user_id)] == [3, 7])
+
+def test_ledger_store_refuses_a_ledger_that_changes_unknown_accounts(tmp_path):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, fsync=False)
+    collection = AccountCollection(store)
+    user_id = str(uuid.uuid4())
+    account1, account2 = collection.create_accounts(user_id, [5, 5])
+    creates_size = os.path.getsize(path)
+    collection.transfer(user_id, account1.id, account2.id, 2)
+    store.close()
+    # Only the transfer's record is left, without the accounts it changes
+    with open(path, "r+b") as ledger_file:
+        ledger_file.seek(creates_size)
+        transfer = ledger_file.read()
+        ledger_file.seek(0)
+        ledger_file.truncate()
+        ledger_file.write(transfer)
+
+    with pytest.raises(ValueError, match="unknown account"):
+        LedgerAccountStore(path, fsync=False)
+
+def test_ledger_store_compacts_the_ledger_behind_a_snapshot(tmp_path):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, fsync=False)
+    collection = AccountCollection(store)
+    user_id = str(uuid.uuid4())
+    account1, account2 = collection.create_accounts(user_id, [50, 50])
+    for _ in range(20):
+        collection.transfer(user_id, account1.id, account2.id, 1)
+    full_size = os.path.getsize(path)
+    store.snapshot()
+    assert(os.path.getsize(path) < full_size)
+    collection.transfer(user_id, account1.id, account2.id, 1)
+    store.close()
+
+    restarted_collection = AccountCollection(LedgerAccountStore(path, fsync=False))
+    assert([a.balance for a in restarted_collection.get_user_accounts(user_id)] == [29, 71])
+
+def test_ledger_store_takes_writes_while_a_snapshot_is_written(tmp_path, monkeypatch):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, snapshot_interval=1, fsync=False)
+    collection = AccountCollection(store)
+    user_id = str(uuid.uuid4())
+    writing, release = threading.Event(), threading.Event()
+    write_snapshot = LedgerAccountStore._LedgerAccountStore__write_snapshot
+    def slow_write_snapshot(self, offset, accounts):
+        writing.set()
+        release.wait(5)
+        write_snapshot(self, offset, accounts)
+    monkeypatch.setattr(LedgerAccountStore, "_LedgerAccountStore__write_snapshot", slow_write_snapshot)
+
+    account1, account2 = collection.create_accounts(user_id, [5, 5])
+    assert(writing.wait(5))
+    collection.transfer(user_id, account1.id, account2.id, 2)
+    release.set()
+    store.close()
+
+    restarted_collection = AccountCollection(LedgerAccountStore(path, fsync=False))
+    assert([a.balance for a in restarted_collection.get_user_accounts(user_id)] == [3, 7])
+
+def test_ledger_store_reads_a_ledger_without_a_header(tmp_path):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, fsync=False)
+    user_id = str(uuid.uuid4())
+    account1, account2 = AccountCollection(store).create_accounts(user_id, [5, 6])
+    store.close()
+    # Ledgers written before compaction start right with their first record
+    with open(path, "rb") as ledger_file:
+        records = ledger_file.read()[16:]
+    with open(path, "wb") as ledger_file:
+        ledger_file.write(records)
+
+    restarted_collection = AccountCollection(LedgerAccountStore(path, fsync=False))
+    assert([(a.id, a.balance) for a in restarted_collection.get_user_accounts(user_id)] == [(account1.id, 5), (account2.id, 6)])
+
+def test_ledger_store_refuses_a_compacted_ledger_without_its_snapshot(tmp_path):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, fsync=False)
+    AccountCollection(store).create_accounts(str(uuid.uuid4()), [5, 5])
+    store.snapshot()
+    store.close()
+    os.remove(path + ".snapshot")
+
+    with pytest.raises(ValueError, match="compacted"):
+        LedgerAccountStore(path, fsync=False)
+
+def test_ledger_store_can_only_be_opened_once_at_a_time(tmp_path):
+    path = str(tmp_path / "accounts.ledger")
+    store = LedgerAccountStore(path, fsync=False)
+    with pytest.raises(LedgerInUseError):
+        LedgerAccountStore(path, fsync=False)
+    store.close()
+    LedgerAccountStore(path, fsync=False).close()
+
+def _transfer_in_worker(path, user_id, account_ids, seed):
+    collection = AccountCollection(SharedMemoryAccountStore(path))
+    rng = random.Random(seed)
+    for _ in range(200):
+        from_account_id, to_account_id = rng.sample(account_ids, 2)
+        collection.transfer(user_id, from_account_id, to_account_id, 1)
+    collection.create_account(user_id, 0)
+
+def test_shared_memory_store_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "accounts.shm")
+    collection = AccountCollection(SharedMemoryAccountStore(path, capacity=1000))
+    user_id = str(uuid.uuid4())
+    account_ids = [account.id for account in collection.create_accounts(user_id, [1000] * 5)]
+
+    workers = [multiprocessing.get_context("fork").Process(target=_transfer_in_worker, args=(path, user_id, account_ids, seed)) for seed in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert(all(worker.exitcode == 0 for worker in workers))
+    accounts = collection.get_user_accounts(user_id)
+    assert(len(accounts) == 9)
+    assert(sum(account.balance for account in accounts) == 5000)
+    assert(sum(account.version for account in accounts) == 4 * 200 * 2)
+
+
+# CONCURRENCY TESTS
+def test_concurrent_transfers_conserve_the_total_balance(account_store):
+    collection = AccountCollection(account_store, lock_stripes=8)
+    user_id = str(uuid.uuid4())
+    account_ids = [collection.create_account(user_id, 100).id for _ in range(10)]
+    thread_count = 8
+    transfers_per_thread = 500
+
+    def make_transfers(seed):
+        rng = random.Random(seed)
+        for _ in range(transfers_per_thread):
+            from_account_id, to_account_id = rng.sample(account_ids, 2)
+            try:
+                collection.transfer(user_id, from_account_id, to_account_id, rng.randint(1, 30))
+            except IllegalTransferAmountError:
+                pass
+
+    threads = [threading.Thread(target=make_transfers, args=(seed,)) for seed in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    balances = [account.balance for account in collection.get_user_accounts(user_id)]
+    assert(sum(balances) == 100 * len(account_ids))
+    assert(all(balance >= 0 for balance in balances))
+    assert(collection.get_user_summary(user_id) == UserSummary(user_id, len(account_ids), 100 * len(account_ids)))
+
+def test_concurrent_transfers_cannot_overdraw_an_account(account_collection_with_accounts_for_two_users):
+    user1, user2, collection = account_collection_with_accounts_for_two_users
+    successful_transfers = []
+
+    def drain():
+        try:
+            collection.transfer(user1.id, user1.account.id, user2.account.id, 1)
+            successful_transfers.append(1)
+        except IllegalTransferAmountError:
+            pass
+
+    threads = [threading.Thread(target=drain) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert(len(successful_transfers) == 5)
+    assert(collection.get_user_account(user1.id, user1.account.id).balance == 0)
+    assert(collection.get_user_account(user2.id, user2.account.id).balance == 10)
+
+def test_reads_never_see_a_half_applied_transfer(account_store):
+    collection = AccountCollection(account_store, lock_stripes=8)
+    user_id = str(uuid.uuid4())
+    account_ids = [account.id for account in collection.create_accounts(user_id, [100] * 10)]
+    done = threading.Event()
+    totals = set()
+
+    def make_transfers(seed):
+        rng = random.Random(seed)
+        for _ in range(300):
+            from_account_id, to_account_id = rng.sample(account_ids, 2)
+            try:
+                collection.transfer(user_id, from_account_id, to_account_id, rng.randint(1, 30))
+            except IllegalTransferAmountError:
+                pass
+
+    def read_totals():
+        while not done.is_set():
+            totals.add(sum(account.balance for account in collection.get_user_accounts(user_id)))
+            totals.add(sum(account.balance for account in collection.get_user_accounts_page(user_id, 10)))
+
+    writers = [threading.Thread(target=make_transfers, args=(seed,)) for seed in range(4)]
+    readers = [threading.Thread(target=read_totals) for _ in range(2)]
+    for thread in writers + readers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    assert(totals == {100 * len(account_ids)})
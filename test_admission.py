@@ -0,0 +1,62 @@
+""" This module tests admission control"""
+import base64
+import pytest
+import admission
+from admission import AdmissionControl, RateLimiter, ServiceBusyError, client_key
+from app import create_app
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+def test_rate_limiter_allows_a_burst_and_then_the_rate(clock):
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.take("client") for _ in range(3)] == [0, 0, 0]
+    assert limiter.take("client") == pytest.approx(0.5)
+    assert limiter.take("other client") == 0
+
+    clock[0] += 0.5
+    assert limiter.take("client") == 0
+    assert limiter.take("client") > 0
+
+def test_rate_limiter_only_forgets_clients_whose_bucket_has_filled_up(clock):
+    limiter = RateLimiter(rate=1, burst=1, max_clients=2)
+    limiter.take("busy client")
+    clock[0] += 0.5
+    limiter.take("idle client")
+    clock[0] += 0.6
+    limiter.take("new client")
+    # The idle client's bucket hasn't filled up yet, so it must still be there
+    assert limiter.take("idle client") > 0
+    assert limiter.take("busy client") == 0
+
+def test_concurrency_limit_turns_requests_away_until_a_slot_is_released():
+    control = AdmissionControl({"GET /auth": {"concurrency": 1, "retry_after": 2}})
+    slot = control.admit("GET", "/auth", lambda: None)
+    with pytest.raises(ServiceBusyError) as exc_info:
+        control.admit("GET", "/auth", lambda: None)
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "2"}
+    assert control.admit("GET", "/accounts", lambda: None) is None
+
+    slot.release()
+    assert control.admit("GET", "/auth", lambda: None) is slot
+
+def test_clients_are_told_apart_by_username_token_or_address():
+    basic = "Basic " + base64.b64encode(b"someone:secret").decode("ascii")
+    assert client_key(basic, "10.0.0.1") == client_key("Basic " + base64.b64encode(b"someone:other").decode("ascii"), "10.0.0.2")
+    assert client_key("Bearer a", "10.0.0.1") != client_key("Bearer b", "10.0.0.1")
+    assert client_key(None, "10.0.0.1") == ("address", "10.0.0.1")
+    assert client_key("Basic !!!", "10.0.0.1") == ("address", "10.0.0.1")
+
+def test_rate_limited_route_answers_429_with_retry_after(config):
+    app = create_app({**config, "ADMISSION_LIMITS": {"POST /users": {"rate": 0.01, "burst": 1}}})
+    client = app.test_client()
+    assert client.post("/users", json={"username": "first"}).status_code == 200
+
+    response = client.post("/users", json={"username": "second"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "100"
+    assert response.get_json()["retry_after"] == 100
@@ -0,0 +1,86 @@
+""" This module tests the Flask app built by create_app"""
+import base64
+import multiprocessing
+import pytest
+from account_collection import AccountCollection, TransferConflictError
+from app import create_app
+
+@pytest.fixture
+def app(config):
+    return create_app(config)
+
+def test_stores_are_only_built_by_the_first_request_that_needs_them(app, signed_in):
+    services = app.extensions["services"]
+    assert "account_collection" not in vars(services)
+    assert app.test_client().get("/metrics").status_code == 200
+    assert "account_collection" not in vars(services)
+
+    client = app.test_client()
+    bearer = signed_in(client, "flaskuser")
+    from_account = client.post("/accounts", json={"balance": 5}, headers=bearer).get_json()["account"]
+    to_account = client.post("/accounts", json={"balance": 0}, headers=bearer).get_json()["account"]
+    response = client.patch(f"/accounts/{from_account['id']}", json={"to_account_id": to_account["id"], "amount": 2}, headers=bearer)
+    assert response.status_code == 200
+    assert response.get_json()["account"]["balance"] == 3
+
+@pytest.mark.parametrize("bcrypt_workers, pooled", [(None, True), (0, False)])
+def test_passwords_are_hashed_in_a_process_pool_unless_turned_off(config, signed_in, bcrypt_workers, pooled):
+    if bcrypt_workers is not None:
+        config["BCRYPT_WORKERS"] = bcrypt_workers
+    workers = set(multiprocessing.active_children())
+    client = create_app(config).test_client()
+    bearer = signed_in(client, "flaskuser")
+    assert client.post("/accounts", json={"balance": 5}, headers=bearer).status_code == 200
+    assert bool(set(multiprocessing.active_children()) - workers) == pooled
+
+def test_apps_do_not_share_their_stores(app, config, signed_in):
+    signed_in(app.test_client(), "flaskuser")
+    assert create_app(config).test_client().get("/users/flaskuser").status_code == 404
+    assert app.test_client().get("/users/flaskuser").status_code == 200
+
+def test_apps_on_one_shared_accounts_file_share_their_users(config, signed_in, tmp_path):
+    # Two apps on one shared memory file stand in for two gunicorn workers
+    shared_config = {**config, "SHARED_ACCOUNTS_PATH": str(tmp_path / "accounts"), "SHARED_ACCOUNTS_CAPACITY": 16}
+    pwd = create_app(shared_config).test_client().post("/users", json={"username": "shareduser"}).get_json()["pwd"]
+    other_worker = create_app(shared_config).test_client()
+    basic = base64.b64encode(f"shareduser:{pwd}".encode("ascii")).decode("ascii")
+    assert other_worker.get("/auth", headers={"Authorization": f"Basic {basic}"}).status_code == 200
+    assert other_worker.post("/users", json={"username": "shareduser"}).status_code == 400
+
+def test_retry_with_the_same_key_runs_again_after_a_conflict(app, signed_in, monkeypatch):
+    client = app.test_client()
+    bearer = signed_in(client, "flaskuser")
+    from_account = client.post("/accounts", json={"balance": 5}, headers=bearer).get_json()["account"]
+    to_account = client.post("/accounts", json={"balance": 0}, headers=bearer).get_json()["account"]
+    transfer = AccountCollection.transfer
+    conflicts = [TransferConflictError(from_account["id"])]
+
+    def transfer_after_a_conflict(self, *args, **kwargs):
+        if conflicts:
+            raise conflicts.pop()
+        return transfer(self, *args, **kwargs)
+    monkeypatch.setattr(AccountCollection, "transfer", transfer_after_a_conflict)
+
+    headers = {**bearer, "Idempotency-Key": "conflicted"}
+    body = {"to_account_id": to_account["id"], "amount": 2}
+    assert client.patch(f"/accounts/{from_account['id']}", json=body, headers=headers).status_code == 409
+    response = client.patch(f"/accounts/{from_account['id']}", json=body, headers=headers)
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    assert response.get_json()["account"]["balance"] == 3
+
+@pytest.mark.parametrize("to_account_id", [5, None])
+def test_transfer_to_an_id_that_is_not_a_string_is_not_found(app, signed_in, to_account_id):
+    client = app.test_client()
+    bearer = signed_in(client, "flaskuser")
+    from_account = client.post("/accounts", json={"balance": 5}, headers=bearer).get_json()["account"]
+    response = client.patch(f"/accounts/{from_account['id']}", json={"to_account_id": to_account_id, "amount": 1}, headers=bearer)
+    assert response.status_code == 404
+
+@pytest.mark.parametrize("transfer", [{"from_account_id": [1], "to_account_id": "x", "amount": 1}, {"from_account_id": "x", "to_account_id": {}, "amount": 1},
+                                      {"from_account_id": "x", "to_account_id": "y", "amount": "1"}, {"from_account_id": "x", "to_account_id": "y", "amount": 0}])
+def test_batch_with_a_malformed_transfer_is_rejected(app, signed_in, transfer):
+    client = app.test_client()
+    bearer = signed_in(client, "flaskuser")
+    response = client.post("/transfers/batch", json={"transfers": [transfer]}, headers=bearer)
+    assert response.status_code == 400
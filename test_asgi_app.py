@@ -0,0 +1,144 @@
+""" This module tests the routes of the ASGI app"""
+import asyncio
+import base64
+import json
+import pytest
+from asgi_app import create_app
+
+async def call(app, method: str, path: str, body=None, headers: dict = None) -> tuple[int, dict, bytes]:
+    """ Sends one request to the app, and returns the status, headers and body of the response """
+    path, _, query_string = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path, "query_string": query_string.encode("ascii"),
+             "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items()]}
+    messages = [{"type": "http.request", "body": json.dumps(body).encode("utf-8") if body is not None else b""}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    response_headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in sent[0]["headers"]}
+    return sent[0]["status"], response_headers, b"".join(message.get("body", b"") for message in sent[1:])
+
+@pytest.fixture
+def app(config):
+    return create_app(config)
+
+async def signed_in(app, username: str) -> dict:
+    _, _, body = await call(app, "POST", "/users", {"username": username})
+    basic = base64.b64encode(f"{username}:{json.loads(body)['pwd']}".encode("ascii")).decode("ascii")
+    _, _, body = await call(app, "GET", "/auth", headers={"Authorization": f"Basic {basic}"})
+    return {"Authorization": f"Bearer {json.loads(body)['token']}"}
+
+def test_can_sign_up_and_transfer(app):
+    async def scenario():
+        bearer = await signed_in(app, "asgiuser")
+        _, _, body = await call(app, "POST", "/accounts", {"balance": 10}, bearer)
+        from_account_id = json.loads(body)["account"]["id"]
+        _, _, body = await call(app, "POST", "/accounts", {"balance": 0}, bearer)
+        to_account_id = json.loads(body)["account"]["id"]
+
+        status, _, body = await call(app, "PATCH", f"/accounts/{from_account_id}", {"to_account_id": to_account_id, "amount": 3}, bearer)
+        assert status == 200
+        assert json.loads(body)["account"]["balance"] == 7
+
+        status, _, body = await call(app, "GET", "/accounts?stream=true", headers=bearer)
+        assert [account["balance"] for account in json.loads(body)["accounts"]] == [7, 3]
+    asyncio.run(scenario())
+
+def test_errors_are_answered_with_json(app):
+    async def scenario():
+        status, _, body = await call(app, "GET", "/accounts")
+        assert status == 401
+        assert json.loads(body) == {"msg": "Missing Authorization Header"}
+
+        bearer = await signed_in(app, "asgierrors")
+        status, _, body = await call(app, "GET", "/accounts/doesnotexist", headers=bearer)
+        assert status == 404
+        assert json.loads(body) == {"message": "Account not found.", "account_id": "doesnotexist"}
+
+        status, _, _ = await call(app, "DELETE", "/accounts", headers=bearer)
+        assert status == 405
+    asyncio.run(scenario())
+
+def test_retried_transfer_is_replayed_and_unchanged_account_is_not_modified(app):
+    async def scenario():
+        bearer = await signed_in(app, "asgiretry")
+        _, _, body = await call(app, "POST", "/accounts", {"balance": 10}, bearer)
+        from_account_id = json.loads(body)["account"]["id"]
+        _, _, body = await call(app, "POST", "/accounts", {"balance": 0}, bearer)
+        to_account_id = json.loads(body)["account"]["id"]
+
+        headers = {**bearer, "Idempotency-Key": "retry-1"}
+        transfer = {"to_account_id": to_account_id, "amount": 4}
+        first = await call(app, "PATCH", f"/accounts/{from_account_id}", transfer, headers)
+        retry = await call(app, "PATCH", f"/accounts/{from_account_id}", transfer, headers)
+        assert retry[0] == first[0] == 200
+        assert retry[1]["idempotent-replayed"] == "true"
+        assert json.loads(retry[2]) == json.loads(first[2])
+
+        _, response_headers, _ = await call(app, "GET", f"/accounts/{from_account_id}", headers=bearer)
+        status, _, _ = await call(app, "GET", f"/accounts/{from_account_id}", headers={**bearer, "If-None-Match": response_headers["etag"]})
+        assert status == 304
+    asyncio.run(scenario())
+
+def test_can_page_through_the_transactions_of_an_account(app):
+    async def scenario():
+        bearer = await signed_in(app, "asgihistory")
+        _, _, body = await call(app, "POST", "/accounts/batch", {"balances": [10, 0]}, bearer)
+        from_account_id, to_account_id = [account["id"] for account in json.loads(body)["accounts"]]
+        for _ in range(2):
+            await call(app, "PATCH", f"/accounts/{from_account_id}", {"to_account_id": to_account_id, "amount": 1}, bearer)
+
+        status, _, body = await call(app, "GET", f"/accounts/{from_account_id}/transactions?limit=2&from=2000-01-01", headers=bearer)
+        assert status == 200
+        page = json.loads(body)
+        assert [(t["amount"], t["balance"]) for t in page["transactions"]] == [(10, 10), (-1, 9)]
+        status, _, body = await call(app, "GET", f"/accounts/{from_account_id}/transactions?limit=2&after={page['next_after']}", headers=bearer)
+        assert [(t["amount"], t["balance"]) for t in json.loads(body)["transactions"]] == [(-1, 8)]
+        assert json.loads(body)["next_after"] is None
+
+        status, _, _ = await call(app, "GET", f"/accounts/{from_account_id}/transactions?to=soon", headers=bearer)
+        assert status == 400
+    asyncio.run(scenario())
+
+def test_users_can_only_see_their_own_summary(app):
+    async def scenario():
+        bearer = await signed_in(app, "asgisummary")
+        await signed_in(app, "asgiother")
+        await call(app, "POST", "/accounts/batch", {"balances": [10, 5]}, bearer)
+
+        status, _, body = await call(app, "GET", "/users/asgisummary/summary", headers=bearer)
+        assert status == 200
+        summary = json.loads(body)["summary"]
+        assert (summary["account_count"], summary["total_balance"]) == (2, 15)
+        status, _, _ = await call(app, "GET", "/users/asgiother/summary", headers=bearer)
+        assert status == 404
+    asyncio.run(scenario())
+
+def test_routes_over_their_concurrency_limit_answer_503_with_retry_after(config):
+    app = create_app({**config, "ADMISSION_LIMITS": {"POST /users": {"concurrency": 1, "retry_after": 3}}})
+    async def scenario():
+        # Holds the only slot, as a request still hashing its password would
+        slot = app._AccountsApp__admission.admit("POST", "/users", lambda: None)
+        status, headers, body = await call(app, "POST", "/users", {"username": "asgibusy"})
+        assert status == 503
+        assert headers["retry-after"] == "3"
+        assert json.loads(body)["retry_after"] == 3
+
+        slot.release()
+        status, _, _ = await call(app, "POST", "/users", {"username": "asgibusy"})
+        assert status == 200
+    asyncio.run(scenario())
+
+def test_transfer_to_an_id_that_is_not_a_string_is_not_found(app):
+    async def scenario():
+        bearer = await signed_in(app, "asgitypes")
+        _, _, body = await call(app, "POST", "/accounts", {"balance": 5}, bearer)
+        account_id = json.loads(body)["account"]["id"]
+        status, _, _ = await call(app, "PATCH", f"/accounts/{account_id}", {"to_account_id": 5, "amount": 1}, bearer)
+        assert status == 404
+    asyncio.run(scenario())
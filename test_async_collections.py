@@ -0,0 +1,111 @@
+""" This module tests the AsyncAccountCollection and AsyncUserCollection classes"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import random
+import uuid
+import pytest
+from account_collection import AccountNotFoundError, IllegalTransferAmountError, TransferRequest
+from user_collection import UserAlreadyExistsError, AuthenticationError
+from async_account_collection import AsyncAccountCollection
+from async_account_store import AsyncAccountStoreAdapter
+from async_user_collection import AsyncUserCollection
+from async_user_store import AsyncUserStoreAdapter
+from in_memory_account_store import InMemoryAccountStore
+from in_memory_user_store import InMemoryUserStore
+from shared_memory_account_store import SharedMemoryAccountStore
+from sqlite_account_store import SqliteAccountStore
+from sqlite_user_store import SqliteUserStore
+
+@pytest.fixture(params=["in_memory", "sqlite"])
+def stores(request, tmp_path):
+    if request.param == "sqlite":
+        executor = ThreadPoolExecutor(max_workers=8)
+        account_store = SqliteAccountStore(str(tmp_path / "accounts.db"))
+        user_store = SqliteUserStore(str(tmp_path / "accounts.db"))
+        yield AsyncUserStoreAdapter(user_store, executor), AsyncAccountStoreAdapter(account_store, executor)
+        executor.shutdown()
+        account_store.close()
+    else:
+        yield AsyncUserStoreAdapter(InMemoryUserStore(), inline=True), AsyncAccountStoreAdapter(InMemoryAccountStore(), inline=True)
+
+def test_can_transfer_between_accounts(stores):
+    async def scenario():
+        collection = AsyncAccountCollection(stores[1])
+        user_id = str(uuid.uuid4())
+        from_account = await collection.create_account(user_id, 10)
+        to_account = await collection.create_account(str(uuid.uuid4()), 0)
+        updated = await collection.transfer(user_id, from_account.id, to_account.id, 4)
+        assert updated.balance == 6
+        assert (await collection.get_user_account(to_account.user_id, to_account.id)).balance == 4
+    asyncio.run(scenario())
+
+def test_cannot_overdraw_or_use_another_users_account(stores):
+    async def scenario():
+        collection = AsyncAccountCollection(stores[1])
+        user_id = str(uuid.uuid4())
+        from_account = await collection.create_account(user_id, 10)
+        to_account = await collection.create_account(str(uuid.uuid4()), 0)
+        with pytest.raises(IllegalTransferAmountError):
+            await collection.transfer(user_id, from_account.id, to_account.id, 11)
+        with pytest.raises(AccountNotFoundError):
+            await collection.transfer(to_account.user_id, from_account.id, to_account.id, 1)
+    asyncio.run(scenario())
+
+def test_concurrent_transfers_never_lose_money(stores):
+    async def scenario():
+        collection = AsyncAccountCollection(stores[1], lock_stripes=4)
+        user_id = str(uuid.uuid4())
+        accounts = [await collection.create_account(user_id, 100) for _ in range(5)]
+        transfers = [collection.transfer(user_id, accounts[i % 5].id, accounts[(i + 1) % 5].id, 1) for i in range(200)]
+        await asyncio.gather(*transfers, return_exceptions=True)
+        balances = [account.balance for account in await collection.get_user_accounts(user_id)]
+        assert sum(balances) == 500
+        assert all(balance >= 0 for balance in balances)
+    asyncio.run(scenario())
+
+def test_batch_and_pages(stores):
+    async def scenario():
+        collection = AsyncAccountCollection(stores[1])
+        user_id = str(uuid.uuid4())
+        accounts = [await collection.create_account(user_id, 10) for _ in range(5)]
+        await collection.transfer_many(user_id, [TransferRequest(accounts[0].id, accounts[1].id, 10), TransferRequest(accounts[1].id, accounts[2].id, 20)])
+        streamed = [account async for account in collection.iter_user_accounts(user_id, page_size=2)]
+        assert [account.balance for account in streamed] == [0, 0, 30, 10, 10]
+    asyncio.run(scenario())
+
+def test_can_create_and_authenticate_users(stores):
+    async def scenario():
+        collection = AsyncUserCollection(stores[0])
+        user, pwd = await collection.create_user("asyncuser")
+        assert (await collection.authenticate("asyncuser", pwd)).id == user.id
+        with pytest.raises(AuthenticationError):
+            await collection.authenticate("asyncuser", "AAAAAAAAAAAAAAAAAAAAAA==")
+        with pytest.raises(UserAlreadyExistsError):
+            await collection.create_user("asyncuser")
+    asyncio.run(scenario())
+
+def _transfer_async_in_worker(path, user_id, account_ids, seed):
+    async def scenario():
+        collection = AsyncAccountCollection(AsyncAccountStoreAdapter(SharedMemoryAccountStore(path), inline=True), lock_stripes=4)
+        rng = random.Random(seed)
+        await asyncio.gather(*(collection.transfer(user_id, *rng.sample(account_ids, 2), 1) for _ in range(200)))
+    asyncio.run(scenario())
+
+def test_transfers_lock_accounts_across_processes_on_a_shared_store(tmp_path):
+    path = str(tmp_path / "accounts.shm")
+    store = SharedMemoryAccountStore(path, capacity=100)
+    user_id = str(uuid.uuid4())
+    account_ids = [account.id for account in store.create_accounts(user_id, [1000] * 5)]
+
+    workers = [multiprocessing.get_context("fork").Process(target=_transfer_async_in_worker, args=(path, user_id, account_ids, seed)) for seed in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # A transfer that raced one in another process would have failed its version check
+    assert all(worker.exitcode == 0 for worker in workers)
+    accounts = store.get_accounts(user_id)
+    assert sum(account.balance for account in accounts) == 5000
+    assert sum(account.version for account in accounts) == 4 * 200 * 2
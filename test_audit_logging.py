@@ -0,0 +1,135 @@
+""" This module tests the BatchingAuditHandler class"""
+import json
+import logging
+import os
+import pytest
+import audit_index
+from audit_logging import AuditFormatter, BatchingAuditHandler
+
+@pytest.fixture
+def audit_logger():
+    logger = logging.getLogger("test_audit")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    yield logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+def test_all_records_are_written_when_handler_is_closed(audit_logger, tmp_path):
+    path = tmp_path / "audit.log"
+    handler = BatchingAuditHandler(str(path), batchSize=7, flushInterval=10)
+    audit_logger.addHandler(handler)
+
+    for i in range(100):
+        audit_logger.info("Transfered an amount. i=%s", i)
+    audit_logger.removeHandler(handler)
+    handler.close()
+
+    assert(path.read_text().splitlines() == [f"Transfered an amount. i={i}" for i in range(100)])
+
+def test_flush_waits_for_queued_records_to_be_written(audit_logger, tmp_path):
+    path = tmp_path / "audit.log"
+    handler = BatchingAuditHandler(str(path), flushInterval=10, fsync=True)
+    audit_logger.addHandler(handler)
+
+    audit_logger.info("Account created. account_id=1")
+    handler.flush()
+
+    assert(path.read_text() == "Account created. account_id=1\n")
+
+def test_audit_file_is_rotated_when_it_grows_past_max_bytes(audit_logger, tmp_path):
+    path = tmp_path / "audit.log"
+    handler = BatchingAuditHandler(str(path), maxBytes=100, backupCount=2, batchSize=1)
+    audit_logger.addHandler(handler)
+
+    for i in range(20):
+        audit_logger.info("Account created. account_id=%s", i)
+    handler.flush()
+
+    assert(path.exists())
+    assert((tmp_path / "audit.log.1").exists())
+    assert((tmp_path / "audit.log.2").exists())
+    assert(not (tmp_path / "audit.log.3").exists())
+    assert(path.read_text().splitlines()[-1] == "Account created. account_id=19")
+
+def indexed_handler(path, **kwargs) -> BatchingAuditHandler:
+    handler = BatchingAuditHandler(str(path), index=True, **kwargs)
+    handler.setFormatter(AuditFormatter())
+    return handler
+
+def test_records_are_structured_and_found_through_the_index(audit_logger, tmp_path, monkeypatch):
+    path = tmp_path / "audit.log"
+    handler = indexed_handler(path, flushInterval=10)
+    audit_logger.addHandler(handler)
+
+    monkeypatch.setattr(logging.time, "time", lambda: 1000.0)
+    audit_logger.info("Account created. account_id=%s, user_id=%s", "a1", "u1")
+    monkeypatch.setattr(logging.time, "time", lambda: 2000.0)
+    audit_logger.info("Transfered an amount between two accounts. from_account_id=%s, to_account_id=%s, user_id=%s, amount=%s", "a1", "a2", "u1", 5)
+    audit_logger.info("Accounts created in bulk. user_id=%s, accounts=%s", "u2", "a3:0;a4:0", extra={"account_ids": ["a3", "a4"]})
+    handler.flush()
+
+    record = json.loads(path.read_text().splitlines()[1])
+    assert {name: record[name] for name in ("from_account_id", "to_account_id", "user_id", "amount")} == {"from_account_id": "a1", "to_account_id": "a2", "user_id": "u1", "amount": 5}
+    assert record["message"] == "Transfered an amount between two accounts. from_account_id=a1, to_account_id=a2, user_id=u1, amount=5"
+
+    assert [record["message"][:20] for record in audit_index.search(str(path), account_ids=["a1"])] == ["Account created. acc", "Transfered an amount"]
+    assert len(list(audit_index.search(str(path), account_ids=["a1"], since=1500))) == 1
+    assert len(list(audit_index.search(str(path), account_ids=["a1"], until=1500))) == 1
+    assert [record["user_id"] for record in audit_index.search(str(path), account_ids=["a4"], user_ids=["u1"])] == ["u1", "u1", "u2"]
+
+def test_rotated_segments_stay_searchable_once_compressed(audit_logger, tmp_path):
+    path = tmp_path / "audit.log"
+    handler = indexed_handler(path, maxBytes=1000, backupCount=3, batchSize=1)
+    audit_logger.addHandler(handler)
+    for i in range(40):
+        audit_logger.info("Account created. account_id=%s, user_id=%s", i, i % 4)
+    handler.flush()
+    segments = audit_index.segments(str(path))
+    assert segments == [f"{path}.3", f"{path}.2", f"{path}.1", str(path)]
+    assert all(os.path.exists(segment + ".idx") for segment in segments)
+    found = [record["account_id"] for record in audit_index.search(str(path), user_ids=["1"])]
+    assert found == [i for i in range(40) if i % 4 == 1][-len(found):]
+
+    for segment in segments[:-1]:
+        audit_index.compress_segment(segment, chunk_bytes=200)
+    assert not os.path.exists(segments[0]) and os.path.exists(segments[0] + ".gz")
+    assert [record["account_id"] for record in audit_index.search(str(path), user_ids=["1"])] == found
+
+    # Rotation moves the compressed segments and their indexes along, and the index of a compressed segment can be rebuilt
+    for i in range(40, 50):
+        audit_logger.info("Account created. account_id=%s, user_id=%s", i, i % 4)
+    handler.flush()
+    audit_index.reindex_segment(f"{path}.3")
+    found = [record["account_id"] for record in audit_index.search(str(path), user_ids=["1"])]
+    assert found == [i for i in range(50) if i % 4 == 1][-len(found):]
+
+def test_writers_sharing_a_file_index_where_their_records_really_are(audit_logger, tmp_path):
+    path = tmp_path / "audit.log"
+    # Two handlers on one file stand in for two worker processes, each with its own stream and index connection
+    handlers = [indexed_handler(path, maxBytes=2000, backupCount=5, batchSize=1) for _ in range(2)]
+    for i in range(60):
+        record = logging.LogRecord("test_audit", logging.INFO, __file__, 0, "Account created. account_id=%s, user_id=%s", (i, i % 3), None)
+        handlers[i % 2].handle(record)
+        handlers[i % 2].flush()
+    for handler in handlers:
+        handler.close()
+
+    found = [record["account_id"] for record in audit_index.search(str(path), user_ids=["2"])]
+    assert found == [i for i in range(60) if i % 3 == 2]
+
+def test_compressed_segment_without_chunks_in_its_index_is_an_error(audit_logger, tmp_path):
+    path = tmp_path / "audit.log"
+    handler = indexed_handler(path, maxBytes=500, backupCount=1, batchSize=1)
+    audit_logger.addHandler(handler)
+    for i in range(10):
+        audit_logger.info("Account created. account_id=%s, user_id=%s", i, "u1")
+    handler.flush()
+    audit_index.compress_segment(f"{path}.1")
+    index = audit_index.AuditIndex(f"{path}.1.idx")
+    index.set_chunks([])
+    index.close()
+
+    with pytest.raises(ValueError, match="reindex"):
+        list(audit_index.search(str(path), user_ids=["u1"]))
@@ -0,0 +1,116 @@
+""" This module tests the IdempotentRequests class"""
+import threading
+import time
+import pytest
+from idempotency import IdempotentRequests, IdempotencyKeyReusedError, IdempotencyOutcomeUnknownError, IdempotencyTimeoutError, InvalidIdempotencyKeyError
+from idempotency_store import StoredResponse
+from in_memory_idempotency_store import InMemoryIdempotencyStore
+from sqlite_idempotency_store import SqliteIdempotencyStore
+
+@pytest.fixture(params=["in_memory", "sqlite"])
+def idempotent_requests(request, tmp_path):
+    if request.param == "sqlite":
+        store = SqliteIdempotencyStore(str(tmp_path / "idempotency.db"))
+        yield IdempotentRequests(store)
+        store.close()
+    else:
+        yield IdempotentRequests(InMemoryIdempotencyStore())
+
+def test_retry_with_same_key_replays_the_first_response(idempotent_requests):
+    calls = []
+    def handle():
+        calls.append(1)
+        return StoredResponse("fingerprint", 200, {"balance": len(calls)})
+
+    first, first_replayed = idempotent_requests.run("user", "key", "fingerprint", handle)
+    second, second_replayed = idempotent_requests.run("user", "key", "fingerprint", handle)
+
+    assert(len(calls) == 1)
+    assert((first_replayed, second_replayed) == (False, True))
+    assert(second == first)
+
+def test_same_key_from_different_users_runs_separately(idempotent_requests):
+    calls = []
+    def handle():
+        calls.append(1)
+        return StoredResponse("fingerprint", 200, {})
+
+    idempotent_requests.run("user1", "key", "fingerprint", handle)
+    idempotent_requests.run("user2", "key", "fingerprint", handle)
+    assert(len(calls) == 2)
+
+def test_key_cannot_be_reused_for_a_different_request(idempotent_requests):
+    idempotent_requests.run("user", "key", "fingerprint", lambda: StoredResponse("fingerprint", 200, {}))
+
+    with pytest.raises(IdempotencyKeyReusedError) as exc_info:
+        idempotent_requests.run("user", "key", "other", lambda: StoredResponse("other", 200, {}))
+    assert exc_info.value.payload["key"] == "key"
+
+def test_key_cannot_be_empty(idempotent_requests):
+    with pytest.raises(InvalidIdempotencyKeyError):
+        idempotent_requests.run("user", "", "fingerprint", lambda: StoredResponse("fingerprint", 200, {}))
+
+def test_concurrent_duplicates_wait_for_the_first_request(idempotent_requests):
+    calls = []
+    def handle():
+        calls.append(1)
+        time.sleep(0.05)
+        return StoredResponse("fingerprint", 200, {})
+    replayed = []
+
+    def run():
+        replayed.append(idempotent_requests.run("user", "key", "fingerprint", handle)[1])
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert(len(calls) == 1)
+    assert(sorted(replayed) == [False] + [True] * 7)
+
+def test_request_that_failed_unexpectedly_runs_again_on_retry(idempotent_requests):
+    def fail():
+        raise RuntimeError("store is down")
+    with pytest.raises(RuntimeError):
+        idempotent_requests.run("user", "key", "fingerprint", fail)
+
+    response, replayed = idempotent_requests.run("user", "key", "fingerprint", lambda: StoredResponse("fingerprint", 200, {"ok": True}))
+    assert(not replayed)
+    assert(response.body == {"ok": True})
+
+def test_duplicates_on_different_workers_run_once(tmp_path):
+    # Every worker has a store of its own on the same database file
+    stores = [SqliteIdempotencyStore(str(tmp_path / "idempotency.db")) for _ in range(4)]
+    calls = []
+    def handle():
+        calls.append(1)
+        time.sleep(0.05)
+        return StoredResponse("fingerprint", 200, {})
+    replayed = []
+
+    def run(store):
+        replayed.append(IdempotentRequests(store).run("user", "key", "fingerprint", handle)[1])
+    threads = [threading.Thread(target=run, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for store in stores:
+        store.close()
+
+    assert(len(calls) == 1)
+    assert(sorted(replayed) == [False, True, True, True])
+
+def test_claim_that_never_completed_is_not_run_again(tmp_path):
+    store = SqliteIdempotencyStore(str(tmp_path / "idempotency.db"))
+    # A worker that died between moving the money and storing the response leaves its claim behind
+    assert(store.claim("user", "key", "fingerprint") is None)
+    def handle():
+        raise AssertionError("must not run")
+
+    with pytest.raises(IdempotencyTimeoutError):
+        IdempotentRequests(store, wait_timeout=0.05).run("user", "key", "fingerprint", handle)
+    with pytest.raises(IdempotencyOutcomeUnknownError):
+        IdempotentRequests(store, abandoned_after=0).run("user", "key", "fingerprint", handle)
+    store.close()
@@ -0,0 +1,32 @@
+""" This module tests the JSON encoding of response bodies"""
+from dataclasses import asdict
+import json
+import uuid
+import pytest
+import json_encoding
+from account_store import Account
+from app import create_app
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(json_encoding, "orjson", None)
+    elif json_encoding.orjson is None:
+        pytest.skip("orjson is not installed")
+    return request.param
+
+def test_bodies_decode_to_what_asdict_gives(backend):
+    account = Account(str(uuid.uuid4()), str(uuid.uuid4()), 2**70 if backend == "orjson" else 5, 3)
+    body = {"accounts": [account], "next_after": None, "id": uuid.UUID(account.id)}
+    assert json.loads(json_encoding.dumps(body)) == {"accounts": [asdict(account)], "next_after": None, "id": account.id}
+
+def test_streamed_accounts_are_the_same_body_as_the_listed_ones(backend, config, signed_in):
+    client = create_app(config).test_client()
+    bearer = signed_in(client, "jsonuser")
+    for balance in range(3):
+        client.post("/accounts", json={"balance": balance}, headers=bearer)
+
+    listed = client.get("/accounts", headers=bearer)
+    streamed = client.get("/accounts?stream=true", headers=bearer)
+    assert [account["balance"] for account in listed.get_json()["accounts"]] == [0, 1, 2]
+    assert streamed.get_data() == listed.get_data()
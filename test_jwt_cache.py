@@ -0,0 +1,84 @@
+""" This module tests the VerifiedTokenCache class and the cached_jwt_required decorator"""
+from datetime import timedelta
+import pytest
+from flask import Flask, jsonify
+from flask_jwt_extended import JWTManager, create_access_token, get_current_user, get_jwt_identity
+from jwt_cache import VerifiedTokenCache, cached_jwt_required
+
+@pytest.fixture
+def cached_app():
+    app = Flask(__name__)
+    app.config["JWT_SECRET_KEY"] = "test-secret-that-is-long-enough-for-hs256"
+    app.config["JWT_TOKEN_LOCATION"] = ["headers"]
+    JWTManager(app)
+    cache = VerifiedTokenCache(max_entries=2)
+
+    @app.route("/whoami")
+    @cached_jwt_required(cache)
+    def whoami():
+        return jsonify({"user_id": get_jwt_identity()})
+
+    return app, cache
+
+def bearer(app, identity: str, expires_delta=None) -> dict:
+    with app.app_context():
+        return {"Authorization": f"Bearer {create_access_token(identity=identity, expires_delta=expires_delta)}"}
+
+def test_token_is_only_fully_verified_once(cached_app, monkeypatch):
+    app, cache = cached_app
+    headers = bearer(app, "user1")
+    client = app.test_client()
+
+    assert(client.get("/whoami", headers=headers).get_json() == {"user_id": "user1"})
+    # Any further full verification would now fail, so the second request must be answered from the cache
+    monkeypatch.setitem(app.config, "JWT_SECRET_KEY", "a-completely-different-secret-key-value")
+    assert(client.get("/whoami", headers=headers).get_json() == {"user_id": "user1"})
+
+def test_current_user_is_loaded_for_every_request(cached_app):
+    app, _ = cached_app
+    lookups = []
+    def lookup(jwt_header, jwt_data):
+        lookups.append(jwt_data["sub"])
+        return {"name": jwt_data["sub"]}
+    app.extensions["flask-jwt-extended"].user_lookup_loader(lookup)
+    cache = VerifiedTokenCache()
+
+    @app.route("/me")
+    @cached_jwt_required(cache)
+    def me():
+        return jsonify(get_current_user())
+
+    headers = bearer(app, "user1")
+    client = app.test_client()
+    assert(client.get("/me", headers=headers).get_json() == {"name": "user1"})
+    assert(client.get("/me", headers=headers).get_json() == {"name": "user1"})
+    assert(lookups == ["user1", "user1"])
+    assert(cache.get(headers["Authorization"].split()[1]) is None)
+
+def test_invalid_token_is_rejected_and_not_cached(cached_app):
+    app, cache = cached_app
+    token = bearer(app, "user1")["Authorization"].split()[1]
+    forged = {"Authorization": f"Bearer {token[:-2]}xx"}
+    client = app.test_client()
+
+    assert(client.get("/whoami", headers=forged).status_code == 422)
+    assert(cache.get(token[:-2] + "xx") is None)
+
+def test_expired_token_is_not_served_from_cache(cached_app):
+    app, cache = cached_app
+    headers = bearer(app, "user1", expires_delta=timedelta(seconds=-1))
+    token = headers["Authorization"].split()[1]
+    with app.app_context():
+        # Pretend the token was verified while it was still valid
+        cache.add(token, {"alg": "HS256"}, {"sub": "user1", "exp": 1})
+
+    assert(app.test_client().get("/whoami", headers=headers).status_code == 401)
+
+def test_cache_keeps_at_most_max_entries_tokens(cached_app):
+    app, cache = cached_app
+    tokens = [bearer(app, f"user{i}")["Authorization"].split()[1] for i in range(3)]
+    for token in tokens:
+        cache.add(token, {}, {"sub": token})
+
+    assert(cache.get(tokens[0]) is None)
+    assert(cache.get(tokens[2]) == ({}, {"sub": tokens[2]}))
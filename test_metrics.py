@@ -0,0 +1,89 @@
+""" This module tests the metrics module"""
+import json
+import os
+import subprocess
+import sys
+import threading
+from metrics import MetricsRegistry, InstrumentedStore, STORE_CALL_DURATION
+from in_memory_account_store import InMemoryAccountStore
+
+def test_histogram_adds_up_observations_from_all_threads():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_duration_seconds", "Test durations.", ["route"], buckets=(0.1, 1.0))
+
+    def observe():
+        for _ in range(100):
+            histogram.observe(0.5, "/accounts")
+    threads = [threading.Thread(target=observe) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    histogram.observe(0.05, "/accounts")
+    histogram.observe(5, "/accounts")
+
+    lines = registry.render().splitlines()
+    assert('test_duration_seconds_bucket{route="/accounts",le="0.1"} 1' in lines)
+    assert('test_duration_seconds_bucket{route="/accounts",le="1.0"} 401' in lines)
+    assert('test_duration_seconds_bucket{route="/accounts",le="+Inf"} 402' in lines)
+    assert('test_duration_seconds_count{route="/accounts"} 402' in lines)
+
+def test_finished_threads_do_not_leave_their_shards_behind():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_duration_seconds", "Test durations.", ["route"], buckets=(0.1, 1.0))
+
+    # One thread per request, like the development server
+    for _ in range(200):
+        thread = threading.Thread(target=histogram.observe, args=(0.5, "/accounts"))
+        thread.start()
+        thread.join()
+    histogram.observe(0.05, "/accounts")
+
+    assert len(histogram._Histogram__shards) <= 2
+    assert histogram.snapshot()[("/accounts",)][:3] == [1, 200, 0]
+
+def test_render_adds_up_metrics_shared_by_other_workers(tmp_path):
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_duration_seconds", "Test durations.", ["route"], buckets=(1.0,))
+    registry.gauge("test_queue_depth", "Test queue depth.", lambda: 2)
+    registry.share_through(str(tmp_path), interval=3600)
+    histogram.observe(0.5, "/accounts")
+
+    # Another worker, which is still running, has written its own snapshot
+    other_snapshot = {"histograms": {"test_duration_seconds": {json.dumps(["/accounts"]): [3, 0, 1.5]}}, "gauges": {"test_queue_depth": 5}}
+    (tmp_path / f"metrics-{os.getppid()}.json").write_text(json.dumps(other_snapshot))
+
+    lines = registry.render().splitlines()
+    assert('test_duration_seconds_count{route="/accounts"} 4' in lines)
+    assert('test_duration_seconds_sum{route="/accounts"} 2.0' in lines)
+    assert('test_queue_depth 7' in lines)
+
+def test_render_folds_the_files_of_exited_workers_into_one(tmp_path):
+    registry = MetricsRegistry()
+    registry.histogram("test_duration_seconds", "Test durations.", ["route"], buckets=(1.0,))
+    registry.share_through(str(tmp_path), interval=3600)
+    snapshot = {"histograms": {"test_duration_seconds": {json.dumps(["/accounts"]): [3, 0, 1.5]}}, "gauges": {}}
+    for _ in range(2):
+        exited_worker = subprocess.Popen([sys.executable, "-c", ""])
+        exited_worker.wait()
+        (tmp_path / f"metrics-{exited_worker.pid}.json").write_text(json.dumps(snapshot))
+
+        # Rendered twice, so the folded counts must not be counted again
+        for _ in range(2):
+            lines = registry.render().splitlines()
+    assert('test_duration_seconds_count{route="/accounts"} 6' in lines)
+    assert(sorted(path.name for path in tmp_path.glob("metrics-*.json")) == ["metrics-retired.json"])
+
+def create_account_call_count() -> int:
+    counts = STORE_CALL_DURATION.snapshot().get(("InMemoryAccountStore", "create_account"))
+    # Every entry but the last is a bucket count, the last one is the sum of the durations
+    return sum(counts[:-1]) if counts else 0
+
+def test_instrumented_store_times_calls_and_passes_results_through():
+    store = InstrumentedStore(InMemoryAccountStore())
+    calls_before = create_account_call_count()
+
+    account = store.create_account("user", 5)
+
+    assert(store.get_account(account.id) == account)
+    assert(create_account_call_count() == calls_before + 1)
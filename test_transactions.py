@@ -0,0 +1,93 @@
+""" This module tests the transaction history kept by AccountCollection"""
+import uuid
+import pytest
+from account_collection import AccountCollection, AccountNotFoundError, InvalidTransactionCursorError, InvalidTransactionTimeError, TransferRequest
+from in_memory_account_store import InMemoryAccountStore
+from in_memory_transaction_store import InMemoryTransactionStore
+from sqlite_transaction_store import SqliteTransactionStore
+from stores import transactions_database_path
+
+@pytest.fixture(params=["in_memory", "sqlite"])
+def transaction_store(request, tmp_path):
+    if request.param == "sqlite":
+        store = SqliteTransactionStore(str(tmp_path / "transactions.db"))
+        yield store
+        store.close()
+    else:
+        yield InMemoryTransactionStore()
+
+@pytest.fixture
+def collection(transaction_store):
+    return AccountCollection(InMemoryAccountStore(), transaction_store=transaction_store)
+
+def test_transfers_are_recorded_on_both_accounts(collection):
+    user_id = str(uuid.uuid4())
+    account1, account2 = collection.create_accounts(user_id, [10, 0])
+    collection.transfer(user_id, account1.id, account2.id, 3)
+    collection.transfer_many(user_id, [TransferRequest(account1.id, account2.id, 2), TransferRequest(account2.id, account1.id, 1)])
+
+    history = [(t.counterparty_account_id, t.amount, t.balance) for t in collection.get_account_transactions(user_id, account1.id)]
+    assert(history == [(None, 10, 10), (account2.id, -3, 7), (account2.id, -2, 5), (account2.id, 1, 6)])
+    history = [(t.counterparty_account_id, t.amount, t.balance) for t in collection.get_account_transactions(user_id, account2.id)]
+    assert(history == [(None, 0, 0), (account1.id, 3, 3), (account1.id, 2, 5), (account1.id, -1, 4)])
+
+def test_transactions_can_be_paged_through_and_limited_to_a_time_range(collection):
+    user_id = str(uuid.uuid4())
+    account1, account2 = collection.create_accounts(user_id, [100, 0])
+    for _ in range(9):
+        collection.transfer(user_id, account1.id, account2.id, 1)
+    everything = collection.get_account_transactions(user_id, account1.id)
+    assert(len(everything) == 10)
+
+    pages, after = [], None
+    while True:
+        page = collection.get_account_transactions(user_id, account1.id, limit=3, after=after)
+        pages.append(page)
+        if len(page) < 3:
+            break
+        after = page[-1].id
+    assert([t.id for page in pages for t in page] == [t.id for t in everything])
+
+    start, end = everything[2].created_at, everything[7].created_at
+    in_range = collection.get_account_transactions(user_id, account1.id, start=start, end=end)
+    assert(in_range == [t for t in everything if start <= t.created_at < end])
+    assert(collection.get_account_transactions(user_id, account1.id, start="2999-01-01") == [])
+    assert(collection.get_account_transactions(user_id, account1.id, end="2000-01-01T00:00:00+01:00") == [])
+
+def test_user_cannot_read_the_transactions_of_another_users_account(collection):
+    account = collection.create_account(str(uuid.uuid4()), 5)
+    with pytest.raises(AccountNotFoundError):
+        collection.get_account_transactions(str(uuid.uuid4()), account.id)
+
+def test_transactions_of_one_account_cannot_be_used_as_cursor_for_another(collection):
+    user_id = str(uuid.uuid4())
+    account1, account2 = collection.create_accounts(user_id, [5, 5])
+    other_transaction = collection.get_account_transactions(user_id, account2.id)[0]
+    with pytest.raises(InvalidTransactionCursorError):
+        collection.get_account_transactions(user_id, account1.id, after=other_transaction.id)
+
+@pytest.mark.parametrize("start", ["yesterday", "2024-13-01", ""])
+def test_invalid_times_are_rejected(collection, start):
+    user_id = str(uuid.uuid4())
+    account = collection.create_account(user_id, 5)
+    with pytest.raises(InvalidTransactionTimeError):
+        collection.get_account_transactions(user_id, account.id, start=start)
+
+def test_in_memory_history_drops_the_oldest_transactions_past_its_size():
+    collection = AccountCollection(InMemoryAccountStore(), transaction_store=InMemoryTransactionStore(max_transactions=10))
+    user_id = str(uuid.uuid4())
+    account1, account2 = collection.create_accounts(user_id, [100, 0])
+    for _ in range(10):
+        collection.transfer(user_id, account1.id, account2.id, 1)
+
+    history1 = [t.balance for t in collection.get_account_transactions(user_id, account1.id)]
+    history2 = [t.balance for t in collection.get_account_transactions(user_id, account2.id)]
+    assert(len(history1) + len(history2) <= 10)
+    assert(history1 == list(range(90 + len(history1) - 1, 89, -1)))
+    assert(history2 == list(range(11 - len(history2), 11)))
+
+def test_ledger_and_shared_memory_configs_keep_their_history_in_sqlite(tmp_path):
+    assert(transactions_database_path({"LEDGER_PATH": str(tmp_path / "ledger")}) == str(tmp_path / "ledger.transactions.db"))
+    assert(transactions_database_path({"SHARED_ACCOUNTS_PATH": str(tmp_path / "accounts")}) == str(tmp_path / "accounts.db"))
+    assert(transactions_database_path({"LEDGER_PATH": "ledger", "TRANSACTIONS_DATABASE_PATH": "history.db"}) == "history.db")
+    assert(transactions_database_path({}) is None)
@@ -1,12 +1,23 @@
 """ This module tests the UserCollection class"""
 import base64
 import pytest
-from user_collection import UserCollection, InvalidUsernameError, UserNotFoundError, AuthenticationError
+from user_collection import UserCollection, InvalidUsernameError, UserNotFoundError, AuthenticationError, UserAlreadyExistsError
 from in_memory_user_store import InMemoryUserStore
+from sqlite_user_store import SqliteUserStore
+from password_hasher import PasswordHasher
+
+@pytest.fixture(params=["in_memory", "sqlite"])
+def user_store(request, tmp_path):
+    if request.param == "sqlite":
+        store = SqliteUserStore(str(tmp_path / "users.db"))
+        yield store
+        store.close()
+    else:
+        yield InMemoryUserStore()
 
 @pytest.fixture
-def empty_user_collection():    
-    return UserCollection(InMemoryUserStore())
+def empty_user_collection(user_store):    
+    return UserCollection(user_store)
 
 def test_can_create_user_with_legal_username(empty_user_collection):
     user, _ = empty_user_collection.create_user("Stenaldermand")
@@ -28,8 +39,8 @@ def test_cannot_create_user_with_a_name_above_20_characters(empty_user_collectio
         assert exc_info.value.payload["username"] == "StenaldermandOfTheSevenIsles"
 
 @pytest.fixture
-def non_empty_user_collection():
-    collection = UserCollection(InMemoryUserStore())
+def non_empty_user_collection(user_store):
+    collection = UserCollection(user_store)
     user = collection.create_user("Stenaldermand")
     return user, collection
 
@@ -78,4 +89,43 @@ def test_generated_password_is_different_between_users(non_empty_user_collection
 
     _, pwd2 = collection.create_user("Rejesalat")
 
-    assert(pwd != pwd2)
\ No newline at end of file
+    assert(pwd != pwd2)
+
+def test_cannot_create_user_with_a_taken_username(non_empty_user_collection):
+    user_result, collection = non_empty_user_collection
+    user, _ = user_result
+
+    with pytest.raises(UserAlreadyExistsError) as exc_info:
+        _ = collection.create_user(user.username)
+    assert exc_info.value.payload["username"] == user.username
+
+def test_taken_username_is_turned_away_before_hashing(user_store, monkeypatch):
+    collection = UserCollection(user_store)
+    collection.create_user("Stenaldermand")
+    def failing_hash(self, pwd):
+        raise AssertionError("hashed a password for a taken username")
+    monkeypatch.setattr(PasswordHasher, "hash", failing_hash)
+
+    with pytest.raises(UserAlreadyExistsError):
+        collection.create_user("Stenaldermand")
+
+
+def test_can_authenticate_with_passwords_hashed_in_a_process_pool(user_store):
+    password_hasher = PasswordHasher(max_workers=2)
+    collection = UserCollection(user_store, password_hasher)
+    try:
+        user, pwd = collection.create_user("Stenaldermand")
+        assert(collection.authenticate(user.username, pwd) == user)
+        with pytest.raises(AuthenticationError):
+            collection.authenticate(user.username, base64.urlsafe_b64encode("MyBirthday1234".encode("ascii")).decode('ascii'))
+    finally:
+        password_hasher.shutdown()
+
+def test_verification_cache_only_remembers_correct_passwords(user_store):
+    collection = UserCollection(user_store, PasswordHasher(verification_cache_ttl=60))
+    user, pwd = collection.create_user("Stenaldermand")
+
+    assert(collection.authenticate(user.username, pwd) == user)
+    assert(collection.authenticate(user.username, pwd) == user)
+    with pytest.raises(AuthenticationError):
+        collection.authenticate(user.username, base64.urlsafe_b64encode("MyBirthday1234".encode("ascii")).decode('ascii'))
@@ -0,0 +1,43 @@
+"""This module defines the abstract TransactionStore class"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+@dataclass
+class Transaction:
+    """ One account's side of a transfer, or the opening balance of a new account, as stored """
+    account_id: str
+    counterparty_account_id: str | None   # None for an opening balance
+    amount: int                           # Negative when money left the account
+    balance: int                          # The account's balance right after
+    created_at: str = ""                  # Set by the store, see format_timestamp
+    id: int = 0                           # Set by the store
+
+def format_timestamp(moment: datetime) -> str:
+    """ Formats a moment as ISO 8601 in UTC with microseconds. Every timestamp has the same width, so they sort as strings. Naive moments are taken to be UTC """
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+class TransactionStoreError(Exception):
+    """ Base exception for transaction stores """
+    def __init__(self, original_exception: Exception, message: str = "Operation failed unexpectedly, when attempting to record or look up transactions."):
+        self.message = message
+        self.original_exception = original_exception
+        super().__init__(message)
+    def __str__(self):
+        return f"{self.message} (originalException: {self.original_exception})"
+
+class TransactionStore(ABC):
+    """ Abstract class, which all transaction stores will inherit from.
+    Stores hand out ids in the order transactions are added, and never give a transaction an earlier created_at than one added before it,
+    so an account's transactions are in the same order by id as by time."""
+
+    @abstractmethod
+    def add_transactions(self, transactions: list[Transaction]):
+        """ Abstract method for recording transactions as one operation. Sets the id and created_at of each of them"""
+
+    @abstractmethod
+    def get_transactions(self, account_id: str, start: str | None, end: str | None, limit: int, after: int = None):
+        """ Abstract method for getting up to limit of an account's transactions with start <= created_at < end, oldest first,
+        starting after the transaction with id after. Returns None if after is not one of the account's transactions"""
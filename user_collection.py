@@ -3,7 +3,7 @@ from dataclasses import dataclass
 import secrets
 import base64
 import logging
-import bcrypt
+from password_hasher import PasswordHasher
 from user_store import UserStore, UserStoreGetError, UserStoreCreateError, StoredUser
 from errors import APIError
 
@@ -40,8 +40,9 @@ class UserCreateError(APIError):
 
 class UserCollection():
     """ Collection containing all the logic for working with users and access to the user store """
-    def __init__(self, user_store: UserStore):
+    def __init__(self, user_store: UserStore, password_hasher: PasswordHasher = None):
         self.__user_store = user_store
+        self.__password_hasher = password_hasher or PasswordHasher()
         self.root_logger = logging.getLogger("root")
         self.audit_logger = logging.getLogger("audit")
 
@@ -65,11 +66,8 @@ class UserCollection():
 
     def create_user(self, username: str) -> tuple[User, str]:
         """ Create a new user with username and generate a password for them """
-        if(not self.__is_valid_username(username)):
-            raise InvalidUsernameError(username)
-        
-        existing_user = self.__internal_get_user(username)
-        if existing_user:
+        # A taken username is turned away before paying for bcrypt. The store still checks again as it inserts.
+        if self.__internal_get_user(username):
             raise UserAlreadyExistsError(username)
 
         # Using bcrypt to generate a salted hash of the password.
@@ -78,16 +76,18 @@ class UserCollection():
         pwd_bytes = secrets.token_bytes(16) # Generating password for the user to make sure that it is strong. :^ )
         pwd_base64 = base64.urlsafe_b64encode(pwd_bytes).decode("ascii")
 
-        salt = bcrypt.gensalt()
-        hashed_pwd = bcrypt.hashpw(pwd_bytes, salt)
+        hashed_pwd = self.__password_hasher.hash(pwd_bytes)
 
         try:
-            new_user = self.__user_store.create_user(username,  base64.urlsafe_b64encode(hashed_pwd).decode('ascii'))
-            self.audit_logger.info("New User created. username=%s, user_id=%s", new_user.username, new_user.id)
+            # Uniqueness is checked by the store as part of the insert, so two concurrent sign-ups can't both claim the username
+            new_user = self.__user_store.create_user_if_absent(username,  base64.urlsafe_b64encode(hashed_pwd).decode('ascii'))
         except UserStoreCreateError as e:
             self.root_logger.warning("Creating user in store failed. username='%s' e='%s'", username, e)
             raise UserCreateError(username) from e
-        
+        if not new_user:
+            raise UserAlreadyExistsError(username)
+        self.audit_logger.info("New User created. username=%s, user_id=%s", new_user.username, new_user.id)
+
         return (self.__obscure_user(new_user), pwd_base64)
     
     def get_user(self, username: str) -> User:
@@ -106,7 +106,7 @@ class UserCollection():
             self.root_logger.info("User with given name not found. username=%s", username)
             raise UserNotFoundError(username)
     
-        if not bcrypt.checkpw(base64.urlsafe_b64decode(pwd.encode('ascii')),  base64.urlsafe_b64decode(user.hashed_pwd)):
+        if not self.__password_hasher.check(base64.urlsafe_b64decode(pwd.encode('ascii')),  base64.urlsafe_b64decode(user.hashed_pwd)):
             self.root_logger.info("User failed to authenticate. username=%s", username)
             raise AuthenticationError(username)
         
@@ -36,6 +36,10 @@ class UserStore(ABC):
     def create_user(self, username: str, hashed_pwd: bytes):
         """ Abstract method for creating user in store"""
 
+    @abstractmethod
+    def create_user_if_absent(self, username: str, hashed_pwd: bytes):
+        """ Abstract method for atomically creating a user in store, unless the username is already taken. Returns None if it is taken"""
+
     @abstractmethod
     def get_user(self, username: str):
         """ Abstract method for getting user from store"""
\ No newline at end of file
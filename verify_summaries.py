@@ -0,0 +1,34 @@
+""" Recomputes every user's account summary from their accounts and reports the users whose stored summary has drifted.
+
+    python verify_summaries.py [--config config.json]
+
+Runs against the stores the service is configured with, next to a running service. Only stores shared between processes can be checked
+from outside the service, i.e. a SQLite database or a shared memory file. Exits with 1 if any summary has drifted.
+"""
+import argparse
+import json
+import sys
+from account_collection import AccountCollection
+from stores import create_stores
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args()
+
+    with open(args.config, encoding="utf-8") as config_file:
+        config = json.load(config_file)
+    if not (config.get("SHARED_ACCOUNTS_PATH") or config.get("SQLITE_DATABASE_PATH")):
+        print("The accounts live inside the service's own processes, so they can't be checked from here", file=sys.stderr)
+        return 2
+
+    _, account_store, _, _ = create_stores(config)
+    drifts = AccountCollection(account_store).verify_user_summaries()
+    for drift in drifts:
+        print(f"user_id={drift.user_id} stored_count={drift.stored.account_count} actual_count={drift.actual.account_count} "
+              f"stored_total={drift.stored.total_balance} actual_total={drift.actual.total_balance}")
+    print(f"{len(drifts)} drifted summaries", file=sys.stderr)
+    return 1 if drifts else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+""" This module implements VersionedAccounts, the multi-version account table behind the in-memory and ledger stores """
+from collections import deque
+from collections.abc import Callable
+import threading
+import time
+from account_store import Account
+
+class _SnapshotTooOld(Exception):
+    """ Raised when a reader needs a version that is no longer kept """
+
+class VersionedAccounts():
+    """ Accounts kept as immutable versions, so that readers get a consistent point-in-time view without taking any lock.
+    Writers are serialized. They install new versions of every account they change, and then publish all of them at once by bumping the commit number.
+    A reader takes the commit number once, and sees every account as of that commit, so it never sees half of a transfer or half of a bulk creation.
+    To do that, the version an account replaced is kept for `retention` seconds. A reader has to start over if an account it reads changed twice during the read,
+    or if the read took longer than the retention, and after a few attempts it reads under the writers' lock instead."""
+
+    read_attempts = 3
+
+    def __init__(self, retention: float = 1.0):
+        self.__retention = retention
+        self.__accounts: dict[str, Account] = {}
+        # account id -> (commit of its newest version, the version before that or None for a new account, the commit of that version).
+        # Only kept for recently written accounts. Any other account's newest version is older than every running read.
+        self.__recent: dict[str, tuple[int, Account | None, int]] = {}
+        self.__recent_expiry: deque[tuple[float, str, int]] = deque()
+        self.__user_index: dict[str, list[str]] = {}
+        self.__user_index_positions: dict[str, int] = {}
+        # user id -> (account count, total balance), replaced as a whole so readers never see a count and a total that don't belong together
+        self.__user_summaries: dict[str, tuple[int, int]] = {}
+        self.__commit = 0
+        self.__write_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__accounts)
+
+    def add(self, accounts: list[Account]):
+        """ Publishes new accounts. They are listed for their users in the order given """
+        with self.__write_lock:
+            commit = self.__commit + 1
+            for account in accounts:
+                # Everything is in place before the id is listed, so a reader never finds an id it can't look up
+                self.__recent[account.id] = (commit, None, 0)
+                self.__accounts[account.id] = account
+                user_account_ids = self.__user_index.setdefault(account.user_id, [])
+                self.__user_index_positions[account.id] = len(user_account_ids)
+                user_account_ids.append(account.id)
+                account_count, total_balance = self.__user_summaries.get(account.user_id, (0, 0))
+                self.__user_summaries[account.user_id] = (account_count + 1, total_balance + account.balance)
+            self.__publish(commit, accounts)
+
+    def commit(self, accounts: list[Account], write_ahead: Callable[[], None] = None) -> bool:
+        """ Publishes new balances for accounts, whose versions must be the current ones, and bumps their versions by one.
+        Returns False without changing anything if a version isn't current, and raises KeyError for unknown accounts.
+        write_ahead is called once the versions are checked but before anything is published, e.g. to make the change durable first."""
+        with self.__write_lock:
+            current_accounts = [self.__accounts[account.id] for account in accounts]
+            for current_account, account in zip(current_accounts, accounts):
+                if current_account.version != account.version:
+                    return False
+            if write_ahead:
+                write_ahead()
+            commit = self.__commit + 1
+            recent_accounts = self.__recent
+            for current_account, account in zip(current_accounts, accounts):
+                recent = recent_accounts.get(account.id)
+                # The replaced version is recorded before the new one is installed, so a reader that finds the new version always finds the record too
+                recent_accounts[account.id] = (commit, current_account, recent[0] if recent else 0)
+                # Copies, as callers go on to use their own objects
+                self.__accounts[account.id] = Account(account.id, account.user_id, account.balance, account.version + 1)
+                if account.balance != current_account.balance:
+                    account_count, total_balance = self.__user_summaries[current_account.user_id]
+                    self.__user_summaries[current_account.user_id] = (account_count, total_balance + account.balance - current_account.balance)
+            self.__publish(commit, accounts)
+        return True
+
+    def __publish(self, commit: int, accounts: list[Account]):
+        self.__commit = commit
+        # Timed after publishing, so a record is never dropped before a read that started ahead of the commit has run for the full retention
+        now = time.monotonic()
+        expiry = self.__recent_expiry
+        for account in accounts:
+            expiry.append((now, account.id, commit))
+        while expiry and expiry[0][0] < now - self.__retention:
+            _, account_id, expired_commit = expiry.popleft()
+            # If the account was written again since, its newer record expires later
+            if self.__recent[account_id][0] == expired_commit:
+                del self.__recent[account_id]
+
+    def __read(self, read: Callable[[int], object]):
+        for _ in range(self.read_attempts):
+            started = time.monotonic()
+            try:
+                result = read(self.__commit)
+            except _SnapshotTooOld:
+                continue
+            if time.monotonic() - started < self.__retention:
+                return result
+        with self.__write_lock:
+            return read(self.__commit)
+
+    def __visible(self, account_ids: list[str], commit: int) -> list[Account]:
+        """ The accounts as of commit, leaving out those created after it """
+        accounts = []
+        for account_id in account_ids:
+            # The account is read before its record, see commit()
+            account = self.__accounts[account_id]
+            recent = self.__recent.get(account_id)
+            if recent is not None and recent[0] > commit:
+                if recent[2] > commit:
+                    raise _SnapshotTooOld()
+                account = recent[1]
+                if account is None:
+                    continue
+            accounts.append(account)
+        return accounts
+
+    def get(self, account_id: str, user_id: str = None) -> Account | None:
+        """ The current version of an account, or None if it doesn't exist or isn't owned by user_id """
+        account = self.__accounts.get(account_id)
+        if account is None:
+            return None
+        recent = self.__recent.get(account_id)
+        if recent is not None and recent[0] > self.__commit:
+            # Being written right now. Use the version from before the write.
+            visible = self.__read(lambda commit: self.__visible([account_id], commit))
+            account = visible[0] if visible else None
+        if account is None or (user_id and account.user_id != user_id):
+            return None
+        return account
+
+    def get_all(self, user_id: str) -> list[Account]:
+        """ All of a user's accounts in creation order, as of a single point in time """
+        return self.get_page(user_id, None)
+
+    def get_page(self, user_id: str, limit: int | None, after: str = None) -> list[Account] | None:
+        """ Up to limit of a user's accounts in creation order, starting after the account with id after, as of a single point in time.
+        Returns None if after is not one of the user's accounts """
+        def read(commit: int):
+            start = 0
+            if after is not None:
+                after_account = self.__accounts.get(after)
+                if after_account is None or after_account.user_id != user_id:
+                    return None
+                start = self.__user_index_positions[after] + 1
+            # Slicing copies the list in one step, so accounts created meanwhile can't shift the page
+            return self.__visible(self.__user_index.get(user_id, [])[start:None if limit is None else start + limit], commit)
+        return self.__read(read)
+
+    def accounts(self) -> list[Account]:
+        """ The current version of every account, as of a single point in time """
+        with self.__write_lock:
+            return list(self.__accounts.values())
+
+    def summary(self, user_id: str) -> tuple[int, int]:
+        """ A user's account count and total balance """
+        return self.__user_summaries.get(user_id, (0, 0))
+
+    def summaries(self) -> dict[str, tuple[int, int]]:
+        """ The account count and total balance of every user with accounts """
+        with self.__write_lock:
+            return dict(self.__user_summaries)